@@ -0,0 +1,122 @@
+"""Burst benchmark for the provider scheduler.
+
+Fires a burst of interactive and batch calls at once through
+lambda/scheduler.py against a fake provider that answers 429 above its quota,
+and reports how many calls succeed and how long each priority class waits,
+with no scheduling, with retries only and with token buckets plus retries:
+
+    python3 bench/burst.py
+    python3 bench/burst.py --calls 120 --rate 20 --burst 10
+
+Needs no packages beyond the standard library.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'lambda'))
+
+import providers  # noqa: E402
+import scheduler  # noqa: E402
+
+class TooManyRequests(Exception):
+    status_code = 429
+
+class QuotaProvider:
+    # Accepts rate calls per second with the given burst, like the provider's
+    # own limiter, and answers the rest with a 429
+    def __init__(self, rate, burst, latency):
+        self.rate = rate
+        self.burst = burst
+        self.latency = latency
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < 1:
+                self.rejected += 1
+                raise TooManyRequests("Too many requests")
+            self.tokens -= 1
+        time.sleep(self.latency)
+        return 'ok'
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def run(mode, args):
+    scheduler._store = scheduler.MemoryBucketStore()
+    scheduler.rate_limits.pop('bench', None)
+    scheduler.max_retries = 0
+    if mode in ('retries', 'scheduled'):
+        scheduler.max_retries = args.retries
+    if mode == 'scheduled':
+        scheduler.rate_limits['bench'] = {'rate': args.rate, 'burst': args.burst}
+    provider = QuotaProvider(args.rate, args.burst, args.latency)
+    priorities = [scheduler.BATCH if i % 3 == 2 else scheduler.INTERACTIVE for i in range(args.calls)]
+
+    def one(priority):
+        started = time.monotonic()
+        try:
+            scheduler.call('bench', 'key', provider, providers.Deadline(args.deadline), priority)
+            return priority, True, time.monotonic() - started
+        except providers.RateLimited:
+            return priority, False, time.monotonic() - started
+
+    started = time.monotonic()
+    # The scheduler logs every retry
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=args.calls) as executor:
+        results = list(executor.map(one, priorities))
+    elapsed = time.monotonic() - started
+    succeeded = [r for r in results if r[1]]
+    latencies = {
+        priority: [seconds * 1000 for p, ok, seconds in succeeded if p == priority]
+        for priority in (scheduler.INTERACTIVE, scheduler.BATCH)
+    }
+    return {
+        'mode': mode,
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'upstream_429': provider.rejected,
+        'throughput': len(succeeded) / elapsed,
+        'interactive_p50': percentile(latencies[scheduler.INTERACTIVE], 0.5),
+        'interactive_p99': percentile(latencies[scheduler.INTERACTIVE], 0.99),
+        'batch_p50': percentile(latencies[scheduler.BATCH], 0.5),
+        'batch_p99': percentile(latencies[scheduler.BATCH], 0.99),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=90, help="calls in the burst, a third of them batch")
+    parser.add_argument('--rate', type=float, default=15, help="provider quota, calls per second")
+    parser.add_argument('--burst', type=float, default=30)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per accepted call")
+    parser.add_argument('--deadline', type=float, default=providers.sync_deadline_seconds)
+    parser.add_argument('--retries', type=int, default=scheduler.max_retries)
+    args = parser.parse_args()
+
+    print(f"{args.calls} calls at once, quota {args.rate:g}/s with a burst of {args.burst:g}")
+    print(f"{'mode':<10} {'ok':>5} {'failed':>7} {'429s':>6} {'ok/s':>6} {'inter p50':>10} {'inter p99':>10} {'batch p50':>10} {'batch p99':>10}")
+    for mode in ('none', 'retries', 'scheduled'):
+        r = run(mode, args)
+        print(
+            f"{r['mode']:<10} {r['succeeded']:>5} {r['failed']:>7} {r['upstream_429']:>6} {r['throughput']:>6.1f} "
+            f"{r['interactive_p50']:>10.0f} {r['interactive_p99']:>10.0f} {r['batch_p50']:>10.0f} {r['batch_p99']:>10.0f}"
+        )
+
+if __name__ == '__main__':
+    main()
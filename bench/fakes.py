@@ -0,0 +1,253 @@
+"""Local stand-ins for the services the lambdas call.
+
+Each fake sleeps for a configurable latency per call and counts the bytes it
+receives and returns, so the harness can report what a request moves over
+the network without any network access.
+"""
+import json
+import threading
+import time
+from io import BytesIO
+from botocore.exceptions import ClientError
+
+# Seconds added to every call, overridable with --latency service=seconds
+DEFAULT_LATENCY = {
+    's3': 0.02,
+    'secrets': 0.05,
+    'stability': 0.3,
+    'replicate': 0.3,
+    'openai': 0.2,
+}
+
+class Traffic:
+    # Bytes sent to and received from the fakes, reset per request
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.sent = 0
+            self.received = 0
+            self.calls = 0
+
+    def record(self, sent=0, received=0):
+        with self._lock:
+            self.sent += sent
+            self.received += received
+            self.calls += 1
+
+traffic = Traffic()
+latency = dict(DEFAULT_LATENCY)
+
+def wait(service):
+    if latency.get(service):
+        time.sleep(latency[service])
+
+def read_all(data):
+    if hasattr(data, 'read'):
+        return data.read()
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data or b''
+
+class NoSuchKey(ClientError):
+    # boto3 raises its modeled errors as ClientError subclasses
+    def __init__(self, key):
+        super().__init__({'Error': {'Code': 'NoSuchKey', 'Message': f"No such key {key}"}}, 'GetObject')
+
+class FakeBody:
+    def __init__(self, data):
+        self._stream = BytesIO(data)
+
+    def read(self, *args):
+        return self._stream.read(*args)
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        wait('s3')
+        data = read_all(Body)
+        traffic.record(sent=len(data))
+        self.objects[(Bucket, Key)] = (data, kwargs.get('Metadata', {}))
+        return {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        self.put_object(Bucket, Key, Fileobj, **(ExtraArgs or {}))
+
+    def get_object(self, Bucket, Key, **kwargs):
+        wait('s3')
+        if (Bucket, Key) not in self.objects:
+            traffic.record()
+            raise NoSuchKey(Key)
+        data, metadata = self.objects[(Bucket, Key)]
+        traffic.record(received=len(data))
+        return {'Body': FakeBody(data), 'Metadata': metadata, 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        wait('s3')
+        traffic.record()
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[(Bucket, Key)][0])}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        # Signed locally, no request is made
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+class FakeSecretsManager:
+    def __init__(self, secrets):
+        self.secrets = secrets
+
+    def get_secret_value(self, SecretId):
+        wait('secrets')
+        value = json.dumps(self.secrets)
+        traffic.record(received=len(value))
+        return {'SecretString': value}
+
+class FakeArtifact:
+    def __init__(self, binary, seed, artifact_type, finish_reason):
+        self.binary = binary
+        self.seed = seed
+        self.type = artifact_type
+        self.finish_reason = finish_reason
+
+class FakeAnswer:
+    def __init__(self, artifacts):
+        self.artifacts = artifacts
+
+class FakeStability:
+    # Mirrors StabilityInference.generate, answers are streamed lazily
+    def __init__(self, make_png):
+        self.make_png = make_png
+
+    def generate(self, prompt, width=512, height=512, samples=1, seed=0, init_image=None, mask_image=None, **kwargs):
+        from stability_sdk.interfaces.gooseai.generation import generation_pb2 as generation
+
+        sent = len(prompt)
+        for image in (init_image, mask_image):
+            if image is not None:
+                # The SDK sends images as PNG
+                buffered = BytesIO()
+                image.save(buffered, format='PNG')
+                sent += len(buffered.getvalue())
+        wait('stability')
+        binary = self.make_png(width, height)
+        traffic.record(sent=sent, received=len(binary) * samples)
+        seeds = seed if isinstance(seed, list) else [seed or 42] * samples
+        for i in range(samples):
+            yield FakeAnswer([FakeArtifact(binary, seeds[i % len(seeds)], generation.ARTIFACT_IMAGE, generation.NULL)])
+
+class FakePrediction:
+    def __init__(self, prediction_id, inputs, make_png):
+        self.id = prediction_id
+        self.inputs = inputs
+        self.make_png = make_png
+        self.status = 'starting'
+        self.output = None
+        self.error = None
+        self.ready_at = time.monotonic() + latency.get('replicate', 0)
+        self.reload()
+
+    def finish(self):
+        self.status = 'succeeded'
+        if 'num_outputs' in self.inputs:
+            # Stable Diffusion, one url per output
+            names = [f"out-{i}.png" for i in range(self.inputs['num_outputs'])]
+        else:
+            # Controlnet, [detected input map, generated image]
+            names = ['detected.png', 'output.png']
+        self.output = [f"https://replicate.delivery/bench/{self.id}/{name}" for name in names]
+        size = (self.inputs.get('width', 512), self.inputs.get('height', 512))
+        for url in self.output:
+            deliveries[url] = self.make_png(*size)
+
+    def wait(self):
+        time.sleep(max(0, self.ready_at - time.monotonic()))
+        self.finish()
+
+    def reload(self):
+        traffic.record()
+        if self.status == 'starting' and time.monotonic() >= self.ready_at:
+            self.finish()
+
+    def cancel(self):
+        traffic.record()
+        self.status = 'canceled'
+
+# Prediction outputs by url, as served by replicate.delivery
+deliveries = {}
+
+def fetch_output(url, deadline):
+    data = deliveries.pop(url)
+    traffic.record(received=len(data))
+    return data
+
+class FakePredictions:
+    def __init__(self, make_png):
+        self.make_png = make_png
+        self.count = 0
+
+    def create(self, version, input, webhook=None, webhook_events_filter=None):
+        self.count += 1
+        sent = 0
+        for value in input.values():
+            if hasattr(value, 'read'):
+                # The replicate client uploads file inputs
+                sent += len(value.read())
+            else:
+                sent += len(str(value))
+        traffic.record(sent=sent)
+        return FakePrediction(f"bench{self.count}", input, self.make_png)
+
+class FakeReplicate:
+    def __init__(self, make_png):
+        self.predictions = FakePredictions(make_png)
+
+class FakeCompletion:
+    # Stands in for openai.Completion in the 0.x client
+    text = (
+        "a highly detailed digital painting of the idea, soft ambient lighting, vibrant colors, "
+        "intricate details, sharp focus, trending on artstation, 8k uhd, by greg rutkowski and "
+        "alphonse mucha, cinematic composition, volumetric light, octane render, ultra realistic, "
+        "masterpiece, concept art, matte painting, studio ghibli color palette, dramatic sky"
+    )
+    token_latency = 0.002
+
+    @classmethod
+    def create(cls, prompt, max_tokens=16, stream=False, **kwargs):
+        wait('openai')
+        traffic.record(sent=len(prompt))
+        words = [word + ' ' for word in cls.text.split(' ')][:max_tokens]
+        if not stream:
+            traffic.record(received=sum(len(w) for w in words))
+            return {'choices': [{'text': ''.join(words)}]}
+
+        def chunks():
+            for word in words:
+                time.sleep(cls.token_latency)
+                traffic.record(received=len(word))
+                yield {'choices': [{'text': word}]}
+        return chunks()
+
+def install(secrets, make_png):
+    # Routes every client the lambdas create to the fakes. Must run before the
+    # handler modules are imported, upload_image creates its S3 client on import.
+    import boto3
+    import openai
+    import client_pool
+    import replicate_models
+
+    s3 = FakeS3()
+    secrets_manager = FakeSecretsManager(secrets)
+    clients = {'s3': s3, 'secretsmanager': secrets_manager}
+    boto3.client = lambda service, *args, **kwargs: clients[service]
+
+    client_pool.create_stability_client = lambda engine, api_key: client_pool.PooledClient(FakeStability(make_png), api_key)
+    client_pool.create_replicate_client = lambda api_token: client_pool.PooledClient(FakeReplicate(make_png), api_token)
+    replicate_models.fetch_output = fetch_output
+    # The pooled requests session is still created, it just never sends anything
+    openai.Completion = FakeCompletion
+    return s3
@@ -0,0 +1,78 @@
+"""Mask derivation benchmark.
+
+Times deriving an inpainting mask from a canvas' alpha channel or a key
+color (lambda/masking.py) against decoding and resizing an uploaded mask, at
+512, 1024 and 2048 pixels square:
+
+    python3 bench/masks.py
+    python3 bench/masks.py --sizes 1024 --iterations 50
+
+Needs numpy and Pillow installed locally.
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'lambda'))
+
+import image_normalize  # noqa: E402
+import masking  # noqa: E402
+
+KEY_COLOR = (255, 0, 255)
+
+def make_canvases(size):
+    # A sketch with a rectangle erased (alpha) or painted with the key color,
+    # and the matching mask upload
+    import random
+    from PIL import Image, ImageDraw
+    box = (size // 8, size // 2, size // 8 + size // 5, size // 2 + size // 7)
+    rng = random.Random(0)
+    sketch = Image.new('RGB', (size, size), (255, 255, 255))
+    draw = ImageDraw.Draw(sketch)
+    for _ in range(40):
+        points = [(rng.randrange(size), rng.randrange(size)) for _ in range(4)]
+        draw.line(points, fill=(0, 0, 0), width=rng.randint(2, 8))
+    alpha = sketch.convert('RGBA')
+    ImageDraw.Draw(alpha).rectangle(box, fill=(0, 0, 0, 0))
+    keyed = sketch.copy()
+    ImageDraw.Draw(keyed).rectangle(box, fill=KEY_COLOR)
+    mask = Image.new('L', (size, size), 255)
+    ImageDraw.Draw(mask).rectangle(box, fill=0)
+    buffered = io.BytesIO()
+    mask.save(buffered, format='PNG')
+    return alpha, keyed, buffered.getvalue()
+
+def timed(fn, iterations):
+    fn()
+    times = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='*', default=[512, 1024, 2048])
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'alpha':>8} {'color key':>10} {'no feather':>11} {'upload':>8}")
+    print(f"{'px':>6} {'ms':>8} {'ms':>10} {'ms':>11} {'ms':>8}")
+    for size in args.sizes:
+        alpha, keyed, mask_png = make_canvases(size)
+        results = [
+            timed(lambda: masking.derive_mask(alpha, 'alpha'), args.iterations),
+            timed(lambda: masking.derive_mask(keyed, KEY_COLOR), args.iterations),
+            timed(lambda: masking.derive_mask(alpha, 'alpha', feather_pixels=0), args.iterations),
+            # What a separate mask costs once it has been received
+            timed(lambda: image_normalize.resize_mask(mask_png, (size, size)), args.iterations),
+        ]
+        print(f"{size:>6} " + " ".join(f"{ms:>{width}.1f}" for ms, width in zip(results, (8, 10, 11, 8))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""Offline benchmarks for the lambda handlers.
+
+Runs each handler in process against the fakes in bench/fakes.py and reports
+latency percentiles, tracemalloc peak memory, bytes moved to and from the
+providers and the handler's own stage timings:
+
+    python3 bench/run.py
+    python3 bench/run.py generate_image/img2img --iterations 50 --latency stability=2
+
+Needs the packages from lambda/layers/*/requirements.txt plus boto3 installed
+locally, but no network or AWS credentials.
+"""
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'lambda'))
+
+BUCKET_NAME = 'bench-bucket'
+SECRET_ARNS = {
+    'STABILITY_KEY_ARN': 'arn:aws:secretsmanager:us-east-1:000000000000:secret:bench-stability',
+    'REPLICATE_KEY_ARN': 'arn:aws:secretsmanager:us-east-1:000000000000:secret:bench-replicate',
+    'OPEN_AI_KEY_ARN': 'arn:aws:secretsmanager:us-east-1:000000000000:secret:bench-openai',
+}
+SECRETS = {'STABILITY_KEY': 'bench', 'REPLICATE_API_TOKEN': 'bench', 'OPEN_AI_KEY': 'bench'}
+
+# Same configuration the stack gives the functions, read by the modules on import
+os.environ.update(SECRET_ARNS)
+os.environ.update({
+    'BUCKET_NAME': BUCKET_NAME,
+    'SEMANTIC_CACHE_BUCKET': BUCKET_NAME,
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'JOB_DISPATCH': 'local',
+})
+
+import fakes  # noqa: E402
+
+_pngs = {}
+
+def make_png(width, height):
+    # Noise compresses about as badly as a generated image does
+    from PIL import Image
+    if (width, height) not in _pngs:
+        channels = [Image.effect_noise((width, height), 48 + 16 * i) for i in range(3)]
+        buffered = io.BytesIO()
+        Image.merge('RGB', channels).save(buffered, format='PNG')
+        _pngs[(width, height)] = buffered.getvalue()
+    return _pngs[(width, height)]
+
+def make_sketch(size=1024, seed=0):
+    # Pen strokes on a transparent canvas, like the app sends
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    image = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        points = [(rng.randrange(size), rng.randrange(size)) for _ in range(4)]
+        draw.line(points, fill=(0, 0, 0, 255), width=rng.randint(2, 8))
+    buffered = io.BytesIO()
+    image.save(buffered, format='PNG')
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+def make_mask(size, box):
+    # White canvas with the region to repaint in black
+    from PIL import Image, ImageDraw
+    mask = Image.new('L', (size, size), 255)
+    ImageDraw.Draw(mask).rectangle(box, fill=0)
+    buffered = io.BytesIO()
+    mask.save(buffered, format='PNG')
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+def make_erased_canvas(size, box, seed=0):
+    # The sketch on white paper with the region to repaint erased to transparency
+    from PIL import Image, ImageDraw
+    sketch = Image.open(io.BytesIO(base64.b64decode(make_sketch(size, seed))))
+    canvas = Image.new('RGBA', sketch.size, (255, 255, 255, 255))
+    canvas.alpha_composite(sketch)
+    ImageDraw.Draw(canvas).rectangle(box, fill=(0, 0, 0, 0))
+    buffered = io.BytesIO()
+    canvas.save(buffered, format='PNG')
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+WORDS = [
+    'lighthouse', 'fox', 'castle', 'robot', 'forest', 'dragon', 'city', 'ocean', 'astronaut', 'garden',
+    'desert', 'owl', 'train', 'mountain', 'violin', 'island', 'tiger', 'library', 'volcano', 'bicycle',
+]
+
+def make_idea(i):
+    # Unrelated ideas, so neither the exact nor the near-duplicate cache can serve them
+    rng = random.Random(i)
+    return " and ".join(rng.sample(WORDS, 3)) + f" {i}"
+
+def api_event(body, headers=None):
+    return {'httpMethod': 'POST', 'headers': headers or {}, 'body': json.dumps(body)}
+
+def binary_event(image, params, accept='application/json'):
+    # Raw image body, API Gateway passes it on base64 encoded
+    return {
+        'httpMethod': 'POST',
+        'headers': {'Content-Type': 'image/png', 'X-Params': json.dumps(params), 'Accept': accept},
+        'body': base64.b64encode(image).decode('ascii'),
+        'isBase64Encoded': True,
+    }
+
+def multipart_event(params, files, accept='application/json'):
+    boundary = 'benchboundary'
+    parts = [(b'params', json.dumps(params).encode('utf-8'))] + [(name.encode('ascii'), data) for name, data in files.items()]
+    body = b''.join(
+        b'--' + boundary.encode('ascii') + b'\r\nContent-Disposition: form-data; name="' + name + b'"\r\n\r\n' + data + b'\r\n'
+        for name, data in parts
+    ) + b'--' + boundary.encode('ascii') + b'--\r\n'
+    return {
+        'httpMethod': 'POST',
+        'headers': {'Content-Type': f"multipart/form-data; boundary={boundary}", 'Accept': accept},
+        'body': base64.b64encode(body).decode('ascii'),
+        'isBase64Encoded': True,
+    }
+
+def get_scenarios():
+    sketch = make_sketch()
+    raw_sketch = base64.b64decode(sketch)
+    large_sketch = make_sketch(size=2048)
+    corner_mask = make_mask(1024, (40, 860, 240, 1000))
+    erased_canvas = make_erased_canvas(1024, (40, 860, 240, 1000))
+    return {
+        'generate_image/txt2img': ('generate_image', lambda i: api_event({
+            'prompt': f"a lighthouse on a cliff {i}",
+        })),
+        'generate_image/img2img': ('generate_image', lambda i: api_event({
+            'prompt': f"a lighthouse on a cliff {i}",
+            'image': sketch,
+        })),
+        'generate_image/s3-webp': ('generate_image', lambda i: api_event({
+            'prompt': f"a lighthouse on a cliff {i}",
+            'advancedOptions': {'resultStorage': 's3', 'outputFormat': 'webp'},
+        })),
+        'generate_image/seeded-repeat': ('generate_image', lambda i: api_event({
+            'prompt': "a lighthouse on a cliff",
+            'advancedOptions': {'seed': 1234},
+        })),
+        'generate_image/img2img-binary': ('generate_image', lambda i: binary_event(raw_sketch, {
+            'prompt': f"a lighthouse on a cliff {i}",
+        }, accept='image/png')),
+        'generate_image/inpaint-corner': ('generate_image', lambda i: api_event({
+            'prompt': f"a lighthouse on a cliff {i}",
+            'image': sketch,
+            'mask': corner_mask,
+        })),
+        'generate_image/inpaint-alpha': ('generate_image', lambda i: api_event({
+            'prompt': f"a lighthouse on a cliff {i}",
+            'image': erased_canvas,
+            'advancedOptions': {'maskSource': 'alpha'},
+        })),
+        'generate_image/tiled-2048': ('generate_image', lambda i: api_event({
+            'prompt': f"a lighthouse on a cliff {i}",
+            'image': large_sketch,
+            'advancedOptions': {'tiled': True},
+        })),
+        'controlnet/scribble': ('controlnet', lambda i: api_event({
+            'prompt': f"a lighthouse on a cliff {i}",
+            'image': sketch,
+        })),
+        'controlnet/scribble-multipart': ('controlnet', lambda i: multipart_event({
+            'prompt': f"a lighthouse on a cliff {i}",
+        }, {'image': raw_sketch})),
+        'text_to_text/unique': ('text_to_text', lambda i: api_event({
+            'prompt': make_idea(i),
+        })),
+        'text_to_text/repeat': ('text_to_text', lambda i: api_event({
+            'prompt': "a lighthouse in a storm",
+        })),
+        'upload_image/new': ('upload_image', lambda i: api_event({
+            'image': make_sketch(seed=i + 1),
+        })),
+        'upload_image/new-binary': ('upload_image', lambda i: binary_event(
+            base64.b64decode(make_sketch(seed=i + 100000)), {},
+        )),
+        'upload_image/duplicate': ('upload_image', lambda i: api_event({
+            'image': sketch,
+        })),
+        'prompt_styles/get': ('prompt_styles', lambda i: {'httpMethod': 'GET', 'headers': {}}),
+    }
+
+class StageRecorder:
+    # Captures the metrics each handler flushes instead of printing them
+    def __init__(self):
+        self.requests = []
+
+    def install(self):
+        import instrumentation
+
+        def flush(function_name, **properties):
+            # Timings only, sizes and counts are reported elsewhere
+            self.requests.append({
+                name: value
+                for name, (value, unit) in instrumentation.get_metrics().items()
+                if unit == 'Milliseconds'
+            })
+            instrumentation.reset()
+        instrumentation.flush = flush
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+def run_scenario(name, module, make_event, iterations, recorder):
+    handler = __import__(module).handler
+    latencies = []
+    peaks = []
+    sent = []
+    received = []
+    request_bytes = []
+    response_bytes = []
+    statuses = set()
+    recorder.requests = []
+    sink = io.StringIO()
+
+    # The first request pays for the secret fetch and client setup
+    for i in range(-1, iterations):
+        event = make_event(i)
+        fakes.traffic.reset()
+        tracemalloc.start()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            response = handler(event, None)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sink.seek(0)
+        sink.truncate()
+        if i < 0:
+            cold = elapsed
+            continue
+        latencies.append(elapsed * 1000)
+        peaks.append(peak)
+        sent.append(fakes.traffic.sent)
+        received.append(fakes.traffic.received)
+        request_bytes.append(len(event.get('body') or ''))
+        response_bytes.append(len(response.get('body') or ''))
+        statuses.add(response.get('statusCode'))
+
+    # Averaged over every request, a stage a request skipped counts as zero
+    warm_requests = recorder.requests[1:]
+    stages = {}
+    for request in warm_requests:
+        for stage, value in request.items():
+            stages[stage] = stages.get(stage, 0) + value
+    return {
+        'scenario': name,
+        'iterations': iterations,
+        'status': sorted(s for s in statuses if s is not None),
+        'first_ms': cold * 1000,
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        'peak_memory_kb': max(peaks) / 1024,
+        'request_kb': statistics.mean(request_bytes) / 1024,
+        'response_kb': statistics.mean(response_bytes) / 1024,
+        'upstream_sent_kb': statistics.mean(sent) / 1024,
+        'upstream_received_kb': statistics.mean(received) / 1024,
+        'stages_ms': {
+            stage: total / len(warm_requests)
+            for stage, total in sorted(stages.items())
+        },
+    }
+
+def format_report(results, latency):
+    lines = [
+        "Latency injected (s): " + ", ".join(f"{k}={v}" for k, v in sorted(latency.items())),
+        "",
+        f"{'scenario':<30} {'status':<8} {'first':>8} {'p50':>8} {'p99':>8} {'peak mem':>9} {'req':>8} {'resp':>8} {'up sent':>8} {'up recv':>8}",
+        f"{'':<30} {'':<8} {'ms':>8} {'ms':>8} {'ms':>8} {'KB':>9} {'KB':>8} {'KB':>8} {'KB':>8} {'KB':>8}",
+    ]
+    for r in results:
+        lines.append(
+            f"{r['scenario']:<30} {','.join(map(str, r['status'])):<8} {r['first_ms']:>8.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+            f"{r['peak_memory_kb']:>9.0f} {r['request_kb']:>8.1f} {r['response_kb']:>8.1f} "
+            f"{r['upstream_sent_kb']:>8.1f} {r['upstream_received_kb']:>8.1f}"
+        )
+    lines.append("")
+    lines.append("Mean stage time per request (ms)")
+    for r in results:
+        stages = ", ".join(f"{stage} {ms:.1f}" for stage, ms in r['stages_ms'].items())
+        lines.append(f"{r['scenario']:<30} {stages}")
+    return "\n".join(lines)
+
+def parse_latency(values):
+    latency = dict(fakes.DEFAULT_LATENCY)
+    for value in values:
+        service, _, seconds = value.partition('=')
+        if service not in latency:
+            raise SystemExit(f"Unknown service {service}, expected one of {', '.join(sorted(latency))}")
+        latency[service] = float(seconds)
+    return latency
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', help="scenarios to run, default all")
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--latency', action='append', default=[], metavar='SERVICE=SECONDS',
+                        help="per call latency, e.g. --latency stability=2.5")
+    parser.add_argument('--no-latency', action='store_true', help="run the fakes without any delay")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    parser.add_argument('--output', help="also write the report to this file, e.g. bench_output.txt")
+    args = parser.parse_args()
+
+    latency = {k: 0 for k in fakes.DEFAULT_LATENCY} if args.no_latency else parse_latency(args.latency)
+    fakes.latency.update(latency)
+    fakes.install(SECRETS, make_png)
+    recorder = StageRecorder()
+    recorder.install()
+
+    scenarios = get_scenarios()
+    names = args.scenarios or list(scenarios)
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        raise SystemExit(f"Unknown scenarios {', '.join(unknown)}, expected one of {', '.join(scenarios)}")
+
+    results = []
+    for name in names:
+        module, make_event = scenarios[name]
+        print(f"Running {name}", file=sys.stderr)
+        results.append(run_scenario(name, module, make_event, args.iterations, recorder))
+
+    report = json.dumps(results, indent=2) if args.json else format_report(results, latency)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import base64
+import json
+import re
+import unittest
+import instrumentation
+
+# Binary mode: images travel as raw bytes instead of base64 inside a json
+# body. A request is either a raw image (Content-Type image/*) with its
+# parameters as json in the X-Params header, or multipart/form-data with a
+# "params" json part and "image" / "mask" file parts. Responses are raw images
+# when the Accept header asks for one.
+#
+# API Gateway hands binary bodies to the lambda base64 encoded, decoding that
+# is the only full copy made. Multipart parts are memoryview slices of it.
+# Keep in sync with binaryMediaTypes in lib/async-stack.ts
+binary_media_types = (
+    'image/png',
+    'image/jpeg',
+    'image/webp',
+    'application/octet-stream',
+    'multipart/form-data',
+)
+params_header = 'x-params'
+params_part = 'params'
+image_fields = ('image', 'mask')
+
+def get_header(event, name):
+    # API Gateway keeps the client's header casing
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def get_media_type(event):
+    content_type = get_header(event, 'content-type') or ''
+    return content_type.split(';')[0].strip().lower()
+
+def is_binary(event):
+    return get_media_type(event) in binary_media_types
+
+def wants_binary(event):
+    # API Gateway only converts the response when the first Accept type is a
+    # binary media type
+    accept = (get_header(event, 'accept') or '').split(',')[0].split(';')[0].strip().lower()
+    return accept.startswith('image/') and accept in binary_media_types
+
+def decode_body(event):
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        return base64.b64decode(body)
+    return body.encode('utf-8') if isinstance(body, str) else body
+
+def parse_params(value):
+    if not value:
+        return {}
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    params = json.loads(value)
+    if not isinstance(params, dict):
+        raise ValueError("Params must be a json object")
+    return params
+
+def parse_multipart(data, boundary):
+    # Returns {part name: memoryview of the part's content}
+    view = memoryview(data)
+    delimiter = b'--' + boundary.encode('latin-1')
+    parts = {}
+    start = data.find(delimiter)
+    while start != -1:
+        start += len(delimiter)
+        if data[start:start + 2] == b'--':
+            break
+        header_end = data.find(b'\r\n\r\n', start)
+        end = data.find(b'\r\n' + delimiter, header_end + 4)
+        if header_end == -1 or end == -1:
+            raise ValueError("Malformed multipart body")
+        headers = data[start:header_end].decode('utf-8', 'replace')
+        match = re.search(r'name="([^"]*)"', headers)
+        if match:
+            parts[match.group(1)] = view[header_end + 4:end]
+        start = end + 2
+    return parts
+
+def parse_request(event):
+    # Returns the request as the same dict the json mode sends, with raw
+    # bytes (or memoryviews) in place of the base64 image fields
+    with instrumentation.stage(instrumentation.DECODE):
+        data = decode_body(event)
+    if get_media_type(event) == 'multipart/form-data':
+        match = re.search(r'boundary="?([^";]+)"?', get_header(event, 'content-type'))
+        if not match:
+            raise ValueError("Multipart body without a boundary")
+        parts = parse_multipart(data, match.group(1))
+        body = parse_params(parts.get(params_part))
+        body.update({name: part for name, part in parts.items() if name in image_fields})
+        return body
+    body = parse_params(get_header(event, params_header))
+    body['image'] = data
+    return body
+
+def load_body(event):
+    # Request body for either mode, raises ValueError for malformed requests
+    if is_binary(event):
+        return parse_request(event)
+    return parse_params(event.get('body'))
+
+def image_response(image, content_type, headers=None):
+    # image is the base64 string the json response would have carried, API
+    # Gateway decodes it and sends the client raw bytes
+    response_headers = {'Content-Type': content_type}
+    response_headers.update(headers or {})
+    return {
+        'statusCode': 200,
+        'headers': response_headers,
+        'body': image,
+        'isBase64Encoded': True,
+    }
+
+class TestBinaryIO(unittest.TestCase):
+    def test_multipart_parts_are_views(self):
+        png = b'\x89PNG\r\n\x1a\n' + bytes(range(256))
+        body = (
+            b'--xyz\r\nContent-Disposition: form-data; name="params"\r\n\r\n'
+            b'{"prompt": "a cat"}\r\n'
+            b'--xyz\r\nContent-Disposition: form-data; name="image"; filename="a.png"\r\n'
+            b'Content-Type: image/png\r\n\r\n' + png + b'\r\n--xyz--\r\n'
+        )
+        event = {
+            'headers': {'Content-Type': 'multipart/form-data; boundary=xyz'},
+            'body': base64.b64encode(body).decode('ascii'),
+            'isBase64Encoded': True,
+        }
+        request = load_body(event)
+        self.assertEqual(request['prompt'], 'a cat')
+        self.assertIsInstance(request['image'], memoryview)
+        self.assertEqual(request['image'].tobytes(), png)
+
+    def test_raw_image_with_params_header(self):
+        event = {
+            'headers': {'content-type': 'image/png', 'X-Params': '{"prompt": "a dog"}', 'Accept': 'image/webp'},
+            'body': base64.b64encode(b'png bytes').decode('ascii'),
+            'isBase64Encoded': True,
+        }
+        request = load_body(event)
+        self.assertEqual(request, {'prompt': 'a dog', 'image': b'png bytes'})
+        self.assertTrue(wants_binary(event))
+        self.assertFalse(wants_binary({'headers': {'Accept': 'application/json'}}))
+
+    def test_malformed_requests_raise_value_error(self):
+        multipart = {'headers': {'Content-Type': 'multipart/form-data'}, 'body': 'x'}
+        broken = {'headers': {'Content-Type': 'multipart/form-data; boundary=xyz'}, 'body': '--xyz\r\nname="params"'}
+        for event in (
+            multipart,
+            broken,
+            {'headers': {'Content-Type': 'image/png', 'X-Params': '{"prompt": '}, 'body': 'x'},
+            {'headers': {'Content-Type': 'image/png', 'X-Params': '["a dog"]'}, 'body': 'x'},
+            {'headers': {'Content-Type': 'application/json'}, 'body': 'not json'},
+        ):
+            with self.assertRaises(ValueError):
+                load_body(event)
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import threading
+import time
+import instrumentation
+
+# Long-lived upstream clients shared across warm invocations. Provider SDKs
+# are imported lazily so each lambda only loads the one it actually uses.
+stability_host = os.environ.get('STABILITY_HOST', 'grpc.stability.ai:443')
+keepalive_ms = int(os.environ.get('CLIENT_KEEPALIVE_MS', 30000))
+http_pool_size = int(os.environ.get('CLIENT_HTTP_POOL_SIZE', 10))
+
+_lock = threading.Lock()
+_clients = {}
+
+class PooledClient:
+    def __init__(self, client, api_key, close=None, is_healthy=None):
+        self.client = client
+        self.fingerprint = fingerprint(api_key)
+        self.created_at = time.monotonic()
+        self._close = close
+        self._is_healthy = is_healthy
+
+    def is_healthy(self):
+        if self._is_healthy is None:
+            return True
+        try:
+            return self._is_healthy()
+        except Exception:
+            return False
+
+    def close(self):
+        if self._close is None:
+            return
+        try:
+            self._close()
+        except Exception as e:
+            print(f"Error closing pooled client: {e}")
+
+def fingerprint(api_key):
+    if api_key is None:
+        return None
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+def get(provider, name, api_key, factory):
+    # Reuse the pooled client unless the key was rotated or it went unhealthy
+    pool_key = (provider, name)
+    with _lock:
+        entry = _clients.get(pool_key)
+        if entry and entry.fingerprint == fingerprint(api_key) and entry.is_healthy():
+            return entry.client
+        if entry:
+            print(f"Reconnecting {provider} client {name}")
+            entry.close()
+        with instrumentation.stage(instrumentation.CLIENT_SETUP):
+            entry = factory(api_key)
+        _clients[pool_key] = entry
+        return entry.client
+
+def reset(provider, name=None):
+    with _lock:
+        for pool_key in list(_clients):
+            if pool_key[0] == provider and (name is None or pool_key[1] == name):
+                _clients.pop(pool_key).close()
+
+def is_connection_error(error):
+    code = getattr(error, 'code', None)
+    if callable(code):
+        try:
+            if getattr(code(), 'name', '') == 'UNAVAILABLE':
+                return True
+        except Exception:
+            pass
+    return type(error).__name__ in (
+        'ConnectionError',
+        'ConnectError',
+        'RemoteProtocolError',
+        'APIConnectionError',
+    )
+
+def call_with_client(provider, name, get_client, call):
+    # A pooled connection may have been dropped while the container was
+    # frozen, so reconnect and retry once on connection failures.
+    try:
+        return call(get_client())
+    except Exception as e:
+        if not is_connection_error(e):
+            raise
+        print(f"Connection error on pooled {provider} client, reconnecting: {e}")
+        reset(provider, name)
+        return call(get_client())
+
+class SharedChannelGrpc:
+    # Stands in for the grpc module inside stability_sdk.client while a client
+    # is built, so the SDK creates its stub on our keep-alive channel instead
+    # of opening a second channel that nothing would ever close
+    def __init__(self, grpc, channel):
+        self._grpc = grpc
+        self._channel = channel
+
+    def secure_channel(self, *args, **kwargs):
+        return self._channel
+
+    def insecure_channel(self, *args, **kwargs):
+        return self._channel
+
+    def __getattr__(self, name):
+        return getattr(self._grpc, name)
+
+def create_stability_client(engine, api_key):
+    import grpc
+    from stability_sdk import client
+
+    options = [
+        ('grpc.keepalive_time_ms', keepalive_ms),
+        ('grpc.keepalive_timeout_ms', 10000),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.max_pings_without_data', 0),
+        ('grpc.max_send_message_length', 10 * 1024 * 1024),
+        ('grpc.max_receive_message_length', 10 * 1024 * 1024),
+    ]
+    credentials = grpc.composite_channel_credentials(
+        grpc.ssl_channel_credentials(),
+        grpc.access_token_call_credentials(api_key),
+    )
+    channel = grpc.secure_channel(stability_host, credentials, options=options)
+
+    # Track connectivity so a broken channel is replaced before it is used
+    state = {'value': None}
+    def on_state_change(connectivity):
+        state['value'] = connectivity
+    channel.subscribe(on_state_change, try_to_connect=True)
+
+    def is_healthy():
+        return state['value'] not in (
+            grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+            grpc.ChannelConnectivity.SHUTDOWN,
+        )
+
+    # Clients are only built here, under the pool lock, so nothing else sees
+    # the SDK module's grpc swapped out
+    client.grpc = SharedChannelGrpc(grpc, channel)
+    try:
+        stability_api = client.StabilityInference(
+            host=stability_host,
+            key=api_key, # API Key reference.
+            verbose=True, # Print debug messages.
+            engine=engine,  # Potentially use different engine for inpainting
+        )
+    finally:
+        client.grpc = grpc
+    return PooledClient(stability_api, api_key, close=channel.close, is_healthy=is_healthy)
+
+def get_stability_client(engine, api_key):
+    return get('stability', engine, api_key, lambda key: create_stability_client(engine, key))
+
+def create_http_session():
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=http_pool_size,
+        pool_maxsize=http_pool_size,
+    )
+    session.mount('https://', adapter)
+    return session
+
+def create_openai_session(api_key):
+    import openai
+    session = create_http_session()
+    # openai routes every request through this session instead of opening
+    # a new one per thread
+    openai.requestssession = session
+    return PooledClient(session, api_key, close=session.close)
+
+def get_openai_session(api_key):
+    return get('openai', 'default', api_key, create_openai_session)
+
+def create_replicate_client(api_token):
+    import replicate
+    replicate_client = replicate.Client(api_token=api_token)
+    return PooledClient(replicate_client, api_token)
+
+def get_replicate_client(api_token):
+    return get('replicate', 'default', api_token, create_replicate_client)
+
+def get_stats():
+    with _lock:
+        now = time.monotonic()
+        return {
+            f"{provider}/{name}": round(now - entry.created_at, 1)
+            for (provider, name), entry in _clients.items()
+        }
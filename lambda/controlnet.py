@@ -1,41 +1,119 @@
-import boto3
 from io import BytesIO
 import json
-import base64
-import replicate
 import os
+import binary_io
+import image_inputs
+import image_normalize
+import instrumentation
+import jobs
+import providers
+import replicate_models
+import result_cache
+import scheduler
+import secrets_cache
 
-secrets = boto3.client('secretsmanager')
-replicate_key_arn = os.environ.get('REPLICATE_KEY_ARN')
+# Controlnet resizes its input to image_resolution, anything larger is wasted upload
+image_resolution = 512
+controlnet_max_pixels = int(os.environ.get('CONTROLNET_MAX_PIXELS', image_resolution * image_resolution))
+# Replicate output urls stop working after an hour, don't cache them for longer
+controlnet_cache = result_cache.ResultCache('controlnet', ttl=min(result_cache.ttl_seconds, 3600))
 
-def set_replicate_api_key():
-    print("Get stability api key")
-    response = secrets.get_secret_value(
-        SecretId=replicate_key_arn,
-    )
-    api_key_json = json.loads(response['SecretString'])
-    api_key = api_key_json['REPLICATE_API_TOKEN']
-    os.environ["REPLICATE_API_TOKEN"] = api_key
+def submit_job(event, body, model, inputs, deadline):
+    # Replicate runs the prediction and calls our webhook when it completes,
+    # so no lambda waits on it
+    try:
+        job = jobs.create_job('controlnet', body.get('callbackUrl'))
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': str(e)}),
+        }
+    try:
+        prediction = replicate_models.with_client(
+            lambda replicate_client: replicate_models.create_prediction(
+                replicate_client,
+                model["version"],
+                inputs,
+                jobs.get_webhook_url(event, job),
+            ),
+            deadline,
+            scheduler.BATCH,
+        )
+    except providers.RateLimited as e:
+        print(f"Error: {e}")
+        jobs.update_job(job['jobId'], status=jobs.FAILED, error=str(e))
+        return {
+            "statusCode": 429,
+            'headers': { 'Content-Type': 'application/json', 'Retry-After': scheduler.retry_after_header(e) },
+            "body":  json.dumps({'error': "Too many predictions right now, please try again shortly"}),
+        }
+    except Exception as e:
+        print(f"Error: {e}")
+        jobs.update_job(job['jobId'], status=jobs.FAILED, error=str(e))
+        return {
+            "statusCode": 500,
+            'headers': { 'Content-Type': 'application/json' },
+            "body":  json.dumps({'error': str(e)}),
+        }
+    job = jobs.update_job(job['jobId'], status=jobs.RUNNING, predictionId=prediction.id)
+    print(f"Submitted job {job['jobId']} as prediction {prediction.id}")
+    return jobs.accepted_response(job)
 
-#  Requires setting REPLICATE_API_TOKEN environment variable
+@instrumentation.instrument
 def handler(event, context):
-    print("Received event: " + json.dumps(event, indent=2))
-
-    # Set up replicate
-    set_replicate_api_key()
-    # TODO: Other controlnet models
+    instrumentation.log_event(event)
+    deadline = providers.request_deadline(context)
 
     # For testing
     # body = event["body"]
     # For production
-    body = json.loads(event["body"])
+    try:
+        body = binary_io.load_body(event)
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': str(e)}),
+        }
+    if not body.get('prompt'):
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': "prompt is required"}),
+        }
 
     # Get params
     prompt = body['prompt'] 
-    base64_img = body['image']
 
-    # Get Buffered reader from base64 string
-    buffered_img = BytesIO(base64.b64decode(base64_img))
+    try:
+        img_key = None if body.get('image') else image_inputs.get_image_key(body, 'image')
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': str(e)}),
+        }
+    if img_key:
+        # Replicate fetches the uploaded image itself, the bytes never reach this lambda
+        image_input = image_inputs.get_image_url(img_key)
+        image_id = f"s3:{img_key}"
+    else:
+        # Get Buffered reader from base64 string or the raw upload
+        try:
+            img_bytes = image_inputs.read_image(body, 'image')
+        except ValueError as e:
+            return {
+                "statusCode": 400,
+                'headers': { 'Content-Type': 'application/json' },
+                "body": json.dumps({'error': str(e)}),
+            }
+        instrumentation.add_size('InputBytes', len(img_bytes))
+        image_id = result_cache.hash_bytes(img_bytes)
+        # Shrink the canvas before it is uploaded to Replicate, in whatever
+        # encoding is smallest since Replicate decodes any PNG or JPEG
+        normalized_bytes, _ = image_normalize.normalize_cached(img_bytes, controlnet_max_pixels, compact=True)
+        image_input = BytesIO(normalized_bytes)
 
     advanced_options = body.get('advancedOptions', {})
 
@@ -46,24 +124,30 @@ def handler(event, context):
     added_prompt = advanced_options.get('addedPrompt', "best quality, extremely detailed")
     ddim_steps = advanced_options.get('ddimSteps', 20)
     
-    seed = advanced_options.get('seed', -1)
+    seed = advanced_options.get('seed')
 
-    if model_type == "scribble":
-        # More optimized verison of controlnet scribble
-        model = replicate.models.get("jagilley/controlnet-scribble")
-        version = model.versions.get("435061a1b5a4c1e26740464bf786efdfa9cb3a3ac488595a2de23e143fdb0117")
-    else:
-        model = replicate.models.get("jagilley/controlnet")
-        version = model.versions.get("8ebda4c70b3ea2a2bf86e44595afb562a2cdf85525c620f1671a78113c9f325b")
+    try:
+        model = replicate_models.get_controlnet_model(model_type)
+        # -1 (or no seed) lets Replicate pick one
+        try:
+            seed = -1 if seed is None else int(seed)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid seed: {seed}")
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': str(e)}),
+        }
 
     # https://replicate.com/jagilley/controlnet-scribble/versions/435061a1b5a4c1e26740464bf786efdfa9cb3a3ac488595a2de23e143fdb0117#input
     inputs = {
-        'image': buffered_img,
+        'image': image_input,
         'prompt': prompt,
         'model_type': model_type, # canny, depth, hed, normal, mlsd, scribble, seg, openpose
         'num_samples': samples,
-        'image_resolution': "512", # 256, 512, 768
-        'detect_resolution': "512", # 256, 512, 768
+        'image_resolution': str(image_resolution), # 256, 512, 768
+        'detect_resolution': str(image_resolution), # 256, 512, 768
         'ddim_steps': ddim_steps,
         'scale': guidance_scale, # 0.1 to 30
         'seed': seed,
@@ -71,19 +155,66 @@ def handler(event, context):
         'a_prompt': added_prompt,
         'n_prompt': negative_prompt
     }
-    print(f"Input: {inputs}")
+    instrumentation.log("Input", inputs)
+
+    if body.get('async'):
+        return submit_job(event, body, model, inputs, deadline)
+
+    # Seed -1 is random, only explicitly seeded predictions are deterministic
+    cache_key = None
+    if seed != -1:
+        cache_params = {k: v for k, v in inputs.items() if k != 'image'}
+        cache_params['version'] = model["version"]
+        cache_params['image'] = image_id
+        cache_key = controlnet_cache.key(cache_params)
+        cached = controlnet_cache.get(cache_key)
+        print(f"Result cache stats: {controlnet_cache.get_stats()}")
+        if cached is not None:
+            return {
+                "statusCode": 200,
+                'headers': { 'Content-Type': 'application/json' },
+                "body": json.dumps(cached),
+            }
 
     # https://replicate.com/jagilley/controlnet-scribble/versions/435061a1b5a4c1e26740464bf786efdfa9cb3a3ac488595a2de23e143fdb0117#output-schema
     try: 
-        output = version.predict(**inputs)
+        _, output = providers.call([
+            providers.Provider('replicate', lambda deadline: replicate_models.predict(
+                model["version"], inputs, deadline, scheduler.INTERACTIVE,
+            )),
+        ], deadline)
         print(f"Output: {output}")
+        print(f"Secrets cache stats: {secrets_cache.get_stats()}")
         input_img_url = output[0]
         output_img_url = output[1]
+        if cache_key:
+            controlnet_cache.put(cache_key, {'image': output_img_url})
         return {
             "statusCode": 200,
             'headers': { 'Content-Type': 'application/json' },
             "body": json.dumps({'image': output_img_url}),
         }
+    except providers.DeadlineExceeded as e:
+        print(f"Error: {e}")
+        return {
+            "statusCode": 504,
+            'headers': { 'Content-Type': 'application/json' },
+            "body":  json.dumps({'error': "Prediction timed out, try again or use async"}),
+        }
+    except providers.ProviderUnavailable as e:
+        print(f"Error: {e}")
+        return {
+            "statusCode": 503,
+            'headers': { 'Content-Type': 'application/json' },
+            "body":  json.dumps({'error': "Replicate is unavailable, please try again shortly"}),
+        }
+    except providers.RateLimited as e:
+        print(f"Error: {e}")
+        return {
+            "statusCode": 429,
+            'headers': { 'Content-Type': 'application/json', 'Retry-After': scheduler.retry_after_header(e) },
+            "body":  json.dumps({'error': "Too many predictions right now, please try again shortly"}),
+        }
     except Exception as e:
         print(f"Error: {e}")
         return {
@@ -1,132 +1,494 @@
-import boto3
 import os
 from io import BytesIO
-import base64
 import json
-from stability_sdk import client
-import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
-from PIL import Image
+import random
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import binary_io
+import client_pool
+import image_encoding
+import image_inputs
+import image_normalize
+import instrumentation
+import jobs
+import providers
+import replicate_models
+import result_cache
+import result_store
+import scheduler
+import secrets_cache
 
-secrets = boto3.client('secretsmanager')
 stability_key_arn = os.environ.get('STABILITY_KEY_ARN')
+max_samples = int(os.environ.get('MAX_SAMPLES', 4))
+# Hedge slow Stability requests with Stable Diffusion on Replicate
+fallback_enabled = os.environ.get('FALLBACK_ENABLED', 'true').lower() == 'true'
+# Inpaint only the masked region plus context instead of the whole canvas
+dirty_rect_inpainting = os.environ.get('DIRTY_RECT_INPAINTING', 'true').lower() == 'true'
+generation_cache = result_cache.ResultCache('generate-image')
 
-def get_stability_api_key():
-    print("Get stability api key")
-    response = secrets.get_secret_value(
-        SecretId=stability_key_arn,
-    )
-    api_key_json = json.loads(response['SecretString'])
-    api_key = api_key_json['STABILITY_KEY']
-    return api_key
-
-def get_base64_string(image):
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    return img_str
+# Provider independent result, binary is None for filtered images
+Artifact = namedtuple('Artifact', ['binary', 'seed', 'filtered'])
 
+FILTERED_MESSAGE = "Your request activated the safety filters. Please change the prompt or drawing and try again."
+
+def parse_seed(value):
+    # 0 (or no seed) is random
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid seed: {value}")
+
+def process_artifact(artifact, output_format, output_quality, storage_mode):
+    if artifact.filtered:
+        return {'seed': artifact.seed, 'filtered': True}
+
+    img_bytes, content_type = image_encoding.encode_image(artifact.binary, output_format, output_quality)
+    instrumentation.add_size('OutputBytes', len(img_bytes))
+    result = {
+        'seed': artifact.seed,
+        'filtered': False,
+        'contentType': content_type,
+        'encodedSize': len(img_bytes),
+    }
+    if storage_mode == 's3':
+        # Return a short-lived link instead of pushing the bytes through the response
+        result['key'] = result_store.store_result(img_bytes, content_type)
+        result['url'] = result_store.get_presigned_url(result['key'])
+    else:
+        result['image'] = image_encoding.get_base64_string(img_bytes)
+    return result
+
+@instrumentation.instrument
 def handler(event, context):
-    print("Received event: " + json.dumps(event, indent=2))
+    instrumentation.log_event(event)
+
+    # Background invocation for an async job
+    if 'jobId' in event:
+        return run_job(event, context)
+    deadline = providers.request_deadline(context)
+
+    try:
+        body = binary_io.load_body(event)
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': str(e)}),
+        }
+    if not body.get('prompt'):
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': "prompt is required"}),
+        }
+    if body.get('async'):
+        return submit_job(context, body)
+    return generate_response(body, deadline, binary=binary_io.wants_binary(event))
+
+def submit_job(context, body):
+    body = dict(body)
+    body.pop('async')
+    callback_url = body.pop('callbackUrl', None)
+    try:
+        if callback_url:
+            jobs.check_callback_url(callback_url)
+        # Async invocation payloads are capped at 256KB, pass inline images by reference
+        for field in ('image', 'mask'):
+            if body.get(field):
+                data = image_inputs.read_image(body, field)
+                body.pop(field)
+                body[f"{field}Key"] = image_inputs.store_image(bytes(data))
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': str(e)}),
+        }
+    # Keep job records small by always storing results in S3
+    advanced_options = dict(body.get('advancedOptions', {}))
+    advanced_options['resultStorage'] = 's3'
+    body['advancedOptions'] = advanced_options
+
+    job = jobs.create_job('generate-image', callback_url)
+    jobs.dispatch(context, handler, {'jobId': job['jobId'], 'body': json.dumps(body)})
+    print(f"Submitted job {job['jobId']}")
+    return jobs.accepted_response(job)
 
-    body = json.loads(event["body"])
+def run_job(event, context):
+    job_id = event['jobId']
+    deadline = providers.request_deadline(context, providers.job_deadline_seconds)
+    jobs.update_job(job_id, status=jobs.RUNNING)
+    try:
+        response = generate_response(json.loads(event['body']), deadline, priority=scheduler.BATCH)
+        result = json.loads(response['body'])
+        if response['statusCode'] == 200:
+            jobs.update_job(job_id, status=jobs.SUCCEEDED, result=result)
+        else:
+            jobs.update_job(job_id, status=jobs.FAILED, error=result.get('error', 'Unknown error'))
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        jobs.update_job(job_id, status=jobs.FAILED, error=str(e))
 
+def result_response(result, binary=False):
+    # A single inline image goes back as raw bytes when the client asked for them
+    if binary and result.get('image'):
+        return binary_io.image_response(result['image'], result['contentType'], {'X-Seed': str(result['seed'])})
+    return {
+        "headers": {
+            "Content-Type": "application/json"
+        },
+        "statusCode": 200,
+        "body": json.dumps(result)
+    }
+
+def generate_response(body, deadline=None, binary=False, priority=scheduler.INTERACTIVE):
+    deadline = deadline or providers.request_deadline()
     # Get params
     prompt = body['prompt'] 
     width = int(body.get('width', 512))
     height = int(body.get('height', 512))
-    mask_img = body.get('mask', None)
 
     # Advanced options
     advanced_options = body.get('advancedOptions', {})
     cfg_scale = advanced_options.get('cfgScale', 7.0)
-    seed = advanced_options['seed']
     # sampler_index = advanced_options.get('samplerIndex', generation.SAMPLER_K_DPMPP_2M)
     denoising_strength = advanced_options.get('denoisingStrength', 0.6)
+    seeds = advanced_options.get('seeds')
+    try:
+        if seeds:
+            # Seed sweep, one sample per seed
+            if not isinstance(seeds, list):
+                raise ValueError("seeds must be a list")
+            seed = [parse_seed(value) for value in seeds]
+            samples = len(seed)
+        else:
+            seed = parse_seed(advanced_options.get('seed'))
+            samples = int(advanced_options.get('samples', 1))
+        output_format, output_quality = image_encoding.get_output_options(advanced_options)
+        storage_mode = result_store.get_storage_mode(advanced_options)
+        if not 1 <= samples <= max_samples:
+            raise ValueError(f"samples must be between 1 and {max_samples}")
+        # Batches return every artifact instead of only the last one
+        batch = bool(seeds) or samples > 1
+        # Large canvases are generated as overlapping tiles at full resolution
+        tiled = bool(advanced_options.get('tiled'))
+        if tiled and batch:
+            raise ValueError("Tiled generation returns a single image")
+        # Inpainting mask taken from the canvas' transparency or a key color
+        # instead of a separate mask image
+        mask_source = advanced_options.get('maskSource')
+        if mask_source:
+            import masking
+            mask_source = masking.parse_mask_source(mask_source)
+            mask_dilate = masking.parse_mask_radius(advanced_options.get('maskDilate', masking.mask_dilate_pixels), 'maskDilate')
+            mask_feather = masking.parse_mask_radius(advanced_options.get('maskFeather', masking.mask_feather_pixels), 'maskFeather')
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': str(e)}),
+        }
 
-    init_img = None
-    if body and 'image' in body:
-        init_img = body['image']
+    try:
+        init_bytes = image_inputs.read_image(body, 'image')
+        mask_bytes = image_inputs.read_image(body, 'mask') if init_bytes else None
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': str(e)}),
+        }
+    if init_bytes:
+        instrumentation.add_size('InputBytes', len(init_bytes))
+    if tiled and (not init_bytes or mask_bytes or mask_source):
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': "Tiled generation needs an image and no mask"}),
+        }
+    if mask_source and (not init_bytes or mask_bytes):
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': "maskSource needs an image and no mask"}),
+        }
+    inpainting = bool(mask_bytes or mask_source)
 
-    if mask_img:
+    if inpainting:
         engine = 'stable-inpainting-512-v2-0'
     else:
         engine = 'stable-diffusion-512-v2-1'
 
-    # Create client connection
-    stability_api = client.StabilityInference(
-        key=get_stability_api_key(), # API Key reference.
-        verbose=True, # Print debug messages.
-        engine=engine,  # Potentially use different engine for inpainting
-    )
-
-    # Resize image if too large
-    if (width * height) > 1048576:
-        width = 512
-        height = 512
-
-    # Call stability API
-    if init_img: 
-        # Image to image
-        pil_init_image = Image.open(BytesIO(base64.b64decode(init_img)))
-        pil_mask_image = None
-        if (mask_img):
-            pil_mask_image = Image.open(BytesIO(base64.b64decode(mask_img)))
-        # pil_init_image.thumbnail((512, 512))
-        answers = stability_api.generate(
-            prompt=prompt,
-            init_image=pil_init_image,
-            mask_image=pil_mask_image,
-            start_schedule=denoising_strength,
-            seed=seed,
-            steps=30,
-            cfg_scale=cfg_scale,
-            width=width,
-            height=height,
-            sampler=generation.SAMPLER_K_DPMPP_2M
-        )
-    else :
-        # Text to image
-        answers = stability_api.generate(
-            prompt=prompt,
-            seed=seed, 
-            steps=30,
-            cfg_scale=cfg_scale,
-            width=width,
-            height=height,
-            samples=1,
-            sampler=generation.SAMPLER_K_DPMPP_2M 
+    # Seed 0 asks Stability for a random seed, only explicit seeds are deterministic
+    cache_key = None
+    if seeds or seed:
+        cache_key = generation_cache.key({
+            'engine': engine,
+            'prompt': prompt,
+            'width': width,
+            'height': height,
+            'cfgScale': cfg_scale,
+            'seed': seed,
+            'samples': samples,
+            'denoisingStrength': denoising_strength if init_bytes else None,
+            'outputFormat': output_format,
+            'outputQuality': output_quality,
+            'resultStorage': storage_mode,
+            'image': result_cache.hash_bytes(init_bytes),
+            'mask': result_cache.hash_bytes(mask_bytes),
+            'maskSource': mask_source,
+            'maskDilate': mask_dilate if mask_source else None,
+            'maskFeather': mask_feather if mask_source else None,
+            'tiled': tiled,
+            'dirtyRect': dirty_rect_inpainting if inpainting else None,
+        })
+        cached = generation_cache.get(cache_key)
+        print(f"Result cache stats: {generation_cache.get_stats()}")
+        if cached is not None:
+            return result_response(result_store.refresh_urls(cached), binary)
+
+    # Shrink oversized canvases to the pixel budget instead of resetting them to 512x512
+    width, height = image_normalize.snap_dimensions(width, height)
+
+    # Deferred until a generation actually runs, cache hits, async submits and
+    # bad requests never load grpc, protobuf or PIL
+    import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
+
+    pixel_budget = image_normalize.max_pixels
+    if tiled:
+        import tiling
+        pixel_budget = tiling.max_pixels
+        # Every tile shares the seed so their noise matches across the seams
+        seed = seed or random.randint(1, 4294967295)
+
+    pil_init_image = None
+    pil_mask_image = None
+    normalized_bytes = None
+    if init_bytes:
+        from PIL import Image
+
+        # Generate at the normalized canvas size so the init image always matches
+        normalized_bytes, (width, height) = image_normalize.normalize_cached(
+            init_bytes, pixel_budget, keep_alpha=mask_source == 'alpha')
+        pil_init_image = Image.open(BytesIO(normalized_bytes))
+        if (mask_bytes):
+            pil_mask_image = image_normalize.resize_mask(mask_bytes, (width, height))
+        elif mask_source:
+            try:
+                pil_init_image, pil_mask_image = masking.derive_mask(pil_init_image, mask_source, mask_dilate, mask_feather)
+            except ValueError as e:
+                return {
+                    "statusCode": 400,
+                    'headers': { 'Content-Type': 'application/json' },
+                    "body": json.dumps({'error': str(e)}),
+                }
+
+    crop_box = None
+    if pil_mask_image is not None and dirty_rect_inpainting:
+        import masking
+        crop_box = masking.plan_crop(pil_mask_image)
+        if crop_box:
+            print(f"Inpainting {crop_box} of the {width}x{height} canvas")
+
+    def generate(stability_api, init_image, mask_image, size, samples):
+        # Call stability API
+        if init_image:
+            # Image to image
+            # pil_init_image.thumbnail((512, 512))
+            answers = stability_api.generate(
+                prompt=prompt,
+                init_image=init_image,
+                mask_image=mask_image,
+                start_schedule=denoising_strength,
+                seed=seed,
+                steps=30,
+                cfg_scale=cfg_scale,
+                width=size[0],
+                height=size[1],
+                samples=samples,
+                sampler=generation.SAMPLER_K_DPMPP_2M
+            )
+        else :
+            # Text to image
+            answers = stability_api.generate(
+                prompt=prompt,
+                seed=seed,
+                steps=30,
+                cfg_scale=cfg_scale,
+                width=size[0],
+                height=size[1],
+                samples=samples,
+                sampler=generation.SAMPLER_K_DPMPP_2M
+            )
+        # Answers are streamed, auth and connection errors only surface while iterating
+        with instrumentation.stage(instrumentation.UPSTREAM):
+            return list(answers)
+
+    def generate_artifacts(init_image, mask_image, size, samples):
+        def generate_with_key(api_key):
+            # Reuse the warm container's channel for this engine, once the
+            # key has capacity left
+            return scheduler.call('stability', api_key, lambda: client_pool.call_with_client(
+                'stability',
+                engine,
+                lambda: client_pool.get_stability_client(engine, api_key),
+                lambda stability_api: generate(stability_api, init_image, mask_image, size, samples),
+            ), deadline, priority)
+
+        instrumentation.add_metric('GeneratedPixels', size[0] * size[1] * samples, 'Count')
+        answers = secrets_cache.call_with_secret(stability_key_arn, 'STABILITY_KEY', generate_with_key)
+        return [
+            Artifact(artifact.binary, artifact.seed, artifact.finish_reason == generation.FILTER)
+            for resp in answers
+            for artifact in resp.artifacts
+            if artifact.finish_reason == generation.FILTER or artifact.type == generation.ARTIFACT_IMAGE
+        ]
+
+    def generate_stability(deadline):
+        if crop_box:
+            return generate_dirty_rect()
+        return generate_artifacts(pil_init_image, pil_mask_image, (width, height), samples)
+
+    def generate_dirty_rect():
+        left, top, right, bottom = crop_box
+        artifacts = generate_artifacts(
+            pil_init_image.crop(crop_box),
+            pil_mask_image.crop(crop_box),
+            (right - left, bottom - top),
+            samples,
         )
-    
+        return [
+            artifact if artifact.filtered
+            else Artifact(masking.composite(pil_init_image, artifact.binary, crop_box), artifact.seed, False)
+            for artifact in artifacts
+        ]
+
+    def generate_tile(tile):
+        deadline.check()
+        artifacts = generate_artifacts(tile, None, tile.size, 1)
+        if not artifacts or artifacts[-1].filtered:
+            return None
+        return artifacts[-1].binary
+
+    def generate_tiles(deadline):
+        plan = tiling.TilePlan(width, height)
+        print(f"Generating {width}x{height} as {len(plan)} tiles of {plan.tile_width}x{plan.tile_height}")
+        # Tiles are cropped from several threads
+        pil_init_image.load()
+        with ThreadPoolExecutor(max_workers=tiling.tile_concurrency) as executor:
+            png = tiling.generate_tiled(pil_init_image, plan, generate_tile, executor)
+        return [Artifact(png, seed, png is None)]
+
+    def predict_replicate(deadline):
+        # https://replicate.com/stability-ai/stable-diffusion/api#inputs
+        inputs = {
+            'prompt': prompt,
+            'num_outputs': samples,
+            'guidance_scale': cfg_scale,
+            'num_inference_steps': 30,
+        }
+        if seed:
+            inputs['seed'] = seed
+        if normalized_bytes:
+            model = replicate_models.fallback_models['img2img']
+            # Same meaning as Stability's start_schedule, the output keeps the input size
+            inputs['image'] = BytesIO(normalized_bytes)
+            inputs['prompt_strength'] = denoising_strength
+        else:
+            model = replicate_models.fallback_models['txt2img']
+            inputs['width'] = width
+            inputs['height'] = height
+        return replicate_models.predict(model['version'], inputs, deadline, priority)
+
+    def generate_replicate(deadline):
+        try:
+            output = predict_replicate(deadline)
+        except (providers.DeadlineExceeded, providers.RateLimited):
+            raise
+        except Exception as e:
+            # The safety checker fails the whole prediction
+            if 'NSFW' in str(e):
+                return [Artifact(None, seed, True)]
+            raise
+        return [Artifact(replicate_models.fetch_output(url, deadline), seed, False) for url in output]
+
+    if tiled:
+        attempts = [providers.Provider('stability', generate_tiles)]
+    else:
+        attempts = [providers.Provider('stability', generate_stability)]
+    # Replicate has no inpainting fallback and takes a single seed per prediction
+    if fallback_enabled and replicate_models.replicate_key_arn and not inpainting and not seeds and not tiled:
+        attempts.append(providers.Provider('replicate', generate_replicate))
+    try:
+        provider, artifacts = providers.call(attempts, deadline)
+    except providers.DeadlineExceeded as e:
+        print(f"Error: {e}, circuits: {providers.get_stats()}")
+        return {
+            "statusCode": 504,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': "Image generation timed out, please try again"}),
+        }
+    except providers.ProviderUnavailable as e:
+        print(f"Error: {e}, circuits: {providers.get_stats()}")
+        return {
+            "statusCode": 503,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': "Image generation is unavailable, please try again shortly"}),
+        }
+    except providers.RateLimited as e:
+        print(f"Error: {e}, circuits: {providers.get_stats()}")
+        return {
+            "statusCode": 429,
+            'headers': { 'Content-Type': 'application/json', 'Retry-After': scheduler.retry_after_header(e) },
+            "body": json.dumps({'error': "Too many image generations right now, please try again shortly"}),
+        }
+    print(f"Generated by {provider}, circuits: {providers.get_stats()}")
+    print(f"Secrets cache stats: {secrets_cache.get_stats()}")
+    print(f"Client pool: {client_pool.get_stats()}")
+    if provider != 'stability':
+        # A seed only reproduces the image on the same engine
+        cache_key = None
+
     # Handle response
-    response =  {
-        "statusCode": 500,
-        'headers': { 'Content-Type': 'application/json' },
-        "body":  json.dumps({'error': "Unknown error"}),
+    if not artifacts:
+        return {
+            "statusCode": 500,
+            'headers': { 'Content-Type': 'application/json' },
+            "body":  json.dumps({'error': "Unknown error"}),
+        }
+
+    if not batch:
+        artifact = artifacts[-1]
+        # Check for content filters
+        if any(artifact.filtered for artifact in artifacts):
+            print(FILTERED_MESSAGE)
+            return {
+                "statusCode": 500,
+                'headers': { 'Content-Type': 'application/json' },
+                "body": json.dumps({'error': FILTERED_MESSAGE, 'filtered': True})
+            }
+        result = process_artifact(artifact, output_format, output_quality, storage_mode)
+        print("Image generated successfully")
+        if cache_key:
+            generation_cache.put(cache_key, result)
+        return result_response(result, binary)
+
+    # Encode and upload the batch concurrently, a filtered image only marks its own entry
+    with ThreadPoolExecutor(max_workers=min(len(artifacts), max_samples)) as executor:
+        results = list(executor.map(
+            lambda artifact: process_artifact(artifact, output_format, output_quality, storage_mode),
+            artifacts,
+        ))
+    print(f"Generated {len(results)} images, {sum(r['filtered'] for r in results)} filtered")
+    if cache_key:
+        generation_cache.put(cache_key, {'images': results})
+    return {
+        "headers": {
+            "Content-Type": "application/json"
+        },
+        "statusCode": 200,
+        "body": json.dumps({'images': results})
     }
-    for resp in answers:
-        for artifact in resp.artifacts:
-            # Check for content filters
-            if artifact.finish_reason == generation.FILTER:
-                error_message = "Your request activated the safety filters. Please change the prompt or drawing and try again."
-                response = {
-                    "statusCode": 500,
-                    'headers': { 'Content-Type': 'application/json' },
-                    "body": json.dumps({'error': error_message, 'filtered': True})
-                }
-                print(error_message)
-                return response
-            if artifact.type == generation.ARTIFACT_IMAGE:
-                img = Image.open(BytesIO(artifact.binary))
-                img_str = get_base64_string(img)
-                response =  {
-                    "headers": {
-                        "Content-Type": "application/json"
-                    },
-                    "statusCode": 200,
-                    "body": json.dumps({'image':img_str})
-                }
-                print("Image generated successfully") 
-    return response
 
 if __name__ == '__main__':
     request = {
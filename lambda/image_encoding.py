@@ -0,0 +1,65 @@
+import base64
+import os
+from io import BytesIO
+import instrumentation
+
+# passthrough forwards the upstream bytes as-is without decoding them
+OUTPUT_FORMATS = {
+    'passthrough': None,
+    'png': 'PNG',
+    'webp': 'WEBP',
+    'jpeg': 'JPEG',
+}
+CONTENT_TYPES = {
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'JPEG': 'image/jpeg',
+}
+default_output_format = os.environ.get('OUTPUT_FORMAT', 'passthrough')
+default_output_quality = int(os.environ.get('OUTPUT_QUALITY', 80))
+
+def sniff_format(data):
+    header = bytes(data[:12])
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+def get_output_options(advanced_options):
+    # null is treated like a missing option
+    output_format = advanced_options.get('outputFormat')
+    output_format = str(default_output_format if output_format is None else output_format).lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported outputFormat: {output_format}")
+    quality = advanced_options.get('outputQuality')
+    try:
+        quality = int(default_output_quality if quality is None else quality)
+    except (TypeError, ValueError):
+        raise ValueError("outputQuality must be a number between 1 and 100")
+    if not 1 <= quality <= 100:
+        raise ValueError("outputQuality must be between 1 and 100")
+    return output_format, quality
+
+def encode_image(data, output_format='passthrough', quality=default_output_quality):
+    # Returns (encoded bytes, content type)
+    pil_format = OUTPUT_FORMATS[output_format]
+    if pil_format is None or pil_format == sniff_format(data):
+        return data, CONTENT_TYPES.get(sniff_format(data), 'application/octet-stream')
+
+    from PIL import Image
+    with instrumentation.stage(instrumentation.ENCODE):
+        image = Image.open(BytesIO(data))
+        buffered = BytesIO()
+        if pil_format == 'JPEG':
+            image.convert('RGB').save(buffered, format='JPEG', quality=quality)
+        elif pil_format == 'WEBP':
+            image.save(buffered, format='WEBP', quality=quality)
+        else:
+            image.save(buffered, format=pil_format)
+    return buffered.getvalue(), CONTENT_TYPES[pil_format]
+
+def get_base64_string(data):
+    return base64.b64encode(data).decode('utf-8')
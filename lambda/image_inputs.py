@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import os
+from urllib.parse import unquote, urlparse
+import instrumentation
+
+# Images can be sent inline as base64, as raw bytes in binary mode (see
+# binary_io) or referenced by the key/url that upload_image returned, so a
+# drawing is uploaded once and reused.
+bucket_name = os.environ.get('BUCKET_NAME')
+input_bucket_folder = "inputs"
+# Inline images of async jobs, kept apart from the public uploads
+job_input_bucket_folder = "jobs/inputs"
+readable_prefixes = ("inputs/", "results/", "jobs/inputs/")
+input_extensions = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+input_url_expiration_seconds = int(os.environ.get('INPUT_URL_EXPIRATION_SECONDS', 900))
+
+_s3 = None
+
+def get_s3():
+    global _s3
+    if _s3 is None:
+        import boto3
+        _s3 = boto3.client('s3')
+    return _s3
+
+def parse_s3_key(reference):
+    if reference.startswith('s3://'):
+        parsed = urlparse(reference)
+        if parsed.netloc != bucket_name:
+            raise ValueError("Image must be in the image bucket")
+        key = parsed.path.lstrip('/')
+    elif reference.startswith('https://'):
+        parsed = urlparse(reference)
+        # https://{bucket}.s3.amazonaws.com/{key} or https://{bucket}.s3.{region}.amazonaws.com/{key}
+        if not parsed.netloc.startswith(f"{bucket_name}.s3.") or not parsed.netloc.endswith('.amazonaws.com'):
+            raise ValueError("Image must be in the image bucket")
+        key = unquote(parsed.path.lstrip('/'))
+    else:
+        key = reference
+    if not key.startswith(readable_prefixes) or '..' in key:
+        raise ValueError(f"Invalid image key: {key}")
+    return key
+
+def get_image_key(body, field):
+    # Returns the S3 key for {field}Key / {field}Url, or None for inline images
+    reference = body.get(f"{field}Key") or body.get(f"{field}Url")
+    if not reference:
+        return None
+    return parse_s3_key(reference)
+
+def read_image(body, field):
+    # Returns the image bytes for field whether it was sent inline or by reference
+    if isinstance(body.get(field), (bytes, bytearray, memoryview)):
+        # Binary mode, already decoded
+        return body[field] or None
+    if body.get(field):
+        with instrumentation.stage(instrumentation.DECODE):
+            return base64.b64decode(body[field])
+    key = get_image_key(body, field)
+    if key is None:
+        return None
+    print(f"Reading {field} from S3 location {key}")
+    from botocore.exceptions import ClientError
+    with instrumentation.stage(instrumentation.DECODE):
+        try:
+            response = get_s3().get_object(Bucket=bucket_name, Key=key)
+        except ClientError as e:
+            # Without ListBucket S3 answers AccessDenied for missing keys too,
+            # either way the client sent a key it can't use
+            if e.response['Error']['Code'] in ('NoSuchKey', '404', 'NotFound', 'AccessDenied', '403'):
+                raise ValueError(f"Image not found: {key}")
+            raise
+        return response['Body'].read()
+
+def get_image_url(key):
+    # Lets providers that accept urls fetch the image without it passing through the lambda
+    return get_s3().generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket_name, 'Key': key},
+        ExpiresIn=input_url_expiration_seconds,
+    )
+
+def store_image(data):
+    # Content addressed so resubmitting the same drawing reuses the object.
+    # Stored as sent, the key and content type follow the sniffed format.
+    import image_encoding
+    image_format = image_encoding.sniff_format(data)
+    extension = input_extensions.get(image_format, 'bin')
+    content_type = image_encoding.CONTENT_TYPES.get(image_format, 'application/octet-stream')
+    key = f"{job_input_bucket_folder}/{hashlib.sha256(data).hexdigest()}.{extension}"
+    print(f"Storing input image in S3 location {key}")
+    with instrumentation.stage(instrumentation.UPLOAD):
+        get_s3().put_object(Bucket=bucket_name, Key=key, Body=data, ContentType=content_type)
+    return key
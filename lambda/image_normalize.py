@@ -0,0 +1,153 @@
+import hashlib
+import math
+import os
+import threading
+import unittest
+from collections import OrderedDict
+from io import BytesIO
+import instrumentation
+
+# Providers only work at limited resolutions, so canvases are shrunk to a
+# pixel budget, snapped to multiples of 64 and flattened before they are sent.
+max_pixels = int(os.environ.get('NORMALIZE_MAX_PIXELS', 1048576))
+dimension_multiple = 64
+cache_size = int(os.environ.get('NORMALIZE_CACHE_SIZE', 16))
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+def snap_dimensions(width, height, pixel_budget=max_pixels):
+    # Largest size with the same aspect ratio that fits the budget, rounded
+    # down to multiples of 64
+    scale = min(1.0, math.sqrt(pixel_budget / float(width * height)))
+    snapped_width = max(dimension_multiple, int(width * scale) // dimension_multiple * dimension_multiple)
+    snapped_height = max(dimension_multiple, int(height * scale) // dimension_multiple * dimension_multiple)
+    return snapped_width, snapped_height
+
+def is_normalized(image, pixel_budget=max_pixels, keep_alpha=False):
+    modes = ('RGB', 'L', 'RGBA', 'LA') if keep_alpha else ('RGB', 'L')
+    return (
+        image.format == 'PNG'
+        and image.mode in modes
+        and image.size == snap_dimensions(image.width, image.height, pixel_budget)
+        and 'exif' not in image.info
+    )
+
+def is_grayscale(image):
+    # Sketches are mostly black lines on white paper, stored as RGB
+    from PIL import ImageChops
+
+    if image.mode == 'L':
+        return True
+    red, green, blue = image.split()
+    return not ImageChops.difference(red, green).getbbox() and not ImageChops.difference(red, blue).getbbox()
+
+def can_forward(image, pixel_budget):
+    # Providers that resize for themselves can take the original as it is, as
+    # long as it is within budget and has no alpha or rotation to apply
+    return (
+        image.format in ('PNG', 'JPEG')
+        and image.mode in ('RGB', 'L')
+        and image.width * image.height <= pixel_budget
+        and image.getexif().get(0x0112, 1) == 1
+    )
+
+def encode_normalized(image, pixel_budget=max_pixels, keep_alpha=False, compact=False):
+    # Returns (png bytes, (width, height))
+    from PIL import Image, ImageOps
+
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+    if has_alpha and keep_alpha:
+        image = image.convert('RGBA')
+    elif has_alpha:
+        # Transparent areas of a sketch are blank paper
+        rgba = image.convert('RGBA')
+        image = Image.new('RGB', image.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel('A'))
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    size = snap_dimensions(image.width, image.height, pixel_budget)
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS)
+    if compact and image.mode == 'RGB' and is_grayscale(image):
+        # A third of the bytes for the same pixels
+        image = image.convert('L')
+
+    buffered = BytesIO()
+    # Drop metadata such as EXIF and ICC profiles
+    image.info = {}
+    image.save(buffered, format='PNG')
+    return buffered.getvalue(), size
+
+def normalize_image(data, pixel_budget=max_pixels, keep_alpha=False, compact=False):
+    # Returns (png bytes, (width, height)). With compact the result can be any
+    # size or format the provider accepts, whichever is the fewest bytes.
+    from PIL import Image
+
+    image = Image.open(BytesIO(data))
+    if is_normalized(image, pixel_budget, keep_alpha):
+        # Already in shape, forward the original bytes untouched
+        return data, image.size
+    normalized = encode_normalized(image, pixel_budget, keep_alpha, compact)
+    if compact and len(normalized[0]) >= len(data) and can_forward(image, pixel_budget):
+        # Re-encoding, e.g. a JPEG as PNG, would only make the upload bigger
+        return data, image.size
+    return normalized
+
+def normalize_cached(data, pixel_budget=max_pixels, keep_alpha=False, compact=False):
+    key = (hashlib.sha256(data).hexdigest(), pixel_budget, keep_alpha, compact)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    with instrumentation.stage(instrumentation.NORMALIZE):
+        result = normalize_image(data, pixel_budget, keep_alpha, compact)
+    with _lock:
+        _cache[key] = result
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return result
+
+def resize_mask(data, size):
+    # Masks must line up with the normalized init image
+    from PIL import Image
+
+    with instrumentation.stage(instrumentation.NORMALIZE):
+        mask = Image.open(BytesIO(data)).convert('L')
+        if mask.size != size:
+            mask = mask.resize(size, Image.BILINEAR)
+    return mask
+
+class TestSnapDimensions(unittest.TestCase):
+    def test_within_budget_is_snapped(self):
+        self.assertEqual(snap_dimensions(500, 700), (448, 640))
+
+    def test_large_canvas_keeps_aspect_ratio(self):
+        width, height = snap_dimensions(2048, 1536)
+        self.assertLessEqual(width * height, max_pixels)
+        self.assertEqual((width % 64, height % 64), (0, 0))
+        self.assertEqual((width, height), (1152, 832))
+
+    def test_stored_upload_is_shrunk_per_request(self):
+        from PIL import Image
+        # Uploads are stored at a larger budget than a plain request uses
+        stored, size = encode_normalized(Image.new('RGB', (2048, 1536), (10, 20, 30)), 2048 * 2048)
+        self.assertEqual(size, (2048, 1536))
+        self.assertEqual(normalize_image(stored, 2048 * 2048)[0], stored)
+        self.assertEqual(normalize_image(stored)[1], (1152, 832))
+
+    def test_compact_never_grows_the_upload(self):
+        from PIL import Image, ImageDraw
+        sketch = Image.new('RGB', (500, 400), (255, 255, 255))
+        ImageDraw.Draw(sketch).line([(10, 10), (490, 390)], fill=(0, 0, 0), width=4)
+        buffered = BytesIO()
+        sketch.save(buffered, format='JPEG', quality=60)
+        data = buffered.getvalue()
+        self.assertGreater(len(normalize_image(data, 512 * 512)[0]), len(data))
+        self.assertEqual(normalize_image(data, 512 * 512, compact=True), (data, (500, 400)))
+        # Too large to forward, but gray lines are encoded in a single channel
+        normalized, size = normalize_image(data, 256 * 256, compact=True)
+        self.assertEqual(size, (256, 192))
+        self.assertEqual(Image.open(BytesIO(normalized)).mode, 'L')
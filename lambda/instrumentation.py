@@ -0,0 +1,162 @@
+import functools
+import json
+import os
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+
+# Per request stage timings, flushed as one CloudWatch embedded metric format
+# (EMF) log line, plus size capped logging so base64 images never reach the logs.
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+namespace = os.environ.get('METRICS_NAMESPACE', 'AiPencil')
+metrics_enabled = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+max_field_chars = int(os.environ.get('LOG_MAX_FIELD_CHARS', 256))
+# Kept in the logs so a truncated value can still be recognized
+truncated_prefix_chars = 32
+sensitive_keys = frozenset(['authorization', 'cookie', 'x-api-key', 'token', 'api_key', 'apikey'])
+
+# Stage names shared by every handler
+SECRET_FETCH = 'SecretFetch'
+CLIENT_SETUP = 'ClientSetup'
+UPSTREAM = 'Upstream'
+# Waiting for provider capacity, see scheduler
+QUEUE = 'Queue'
+DECODE = 'Decode'
+NORMALIZE = 'Normalize'
+ENCODE = 'Encode'
+UPLOAD = 'Upload'
+TOTAL = 'Total'
+
+_lock = threading.Lock()
+_metrics = {}
+# Bumped per request, so a background call that outlives its request (e.g. a
+# hedged attempt that lost) doesn't add its time to the next one
+_request = 0
+
+def redact(value, key=None):
+    # Copy of value that is safe and small enough to log
+    if key is not None and str(key).lower() in sensitive_keys:
+        return '<redacted>'
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        if key == 'body' and value[:1] in ('{', '['):
+            # API Gateway bodies are json strings, redact the fields inside them
+            try:
+                return redact(json.loads(value))
+            except ValueError:
+                pass
+        if len(value) > max_field_chars:
+            return f"{value[:truncated_prefix_chars]}...<{len(value)} chars>"
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes>"
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    # Streams, PIL images and other objects are summarized by type
+    return f"<{type(value).__name__}>"
+
+def log(label, value):
+    print(f"{label}: {json.dumps(redact(value))}")
+
+def log_event(event):
+    log("Received event", event)
+
+def add_metric(name, value, unit='Milliseconds', request=None):
+    # Values recorded more than once in a request, e.g. by a batch, are summed
+    with _lock:
+        if request is not None and request != _request:
+            return
+        total, _ = _metrics.get(name, (0, unit))
+        _metrics[name] = (total + value, unit)
+
+def add_size(name, size):
+    add_metric(name, size, 'Bytes')
+
+@contextmanager
+def stage(name):
+    request = _request
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_metric(name, (time.perf_counter() - started) * 1000, request=request)
+
+def reset():
+    global _request
+    with _lock:
+        _metrics.clear()
+        _request += 1
+
+def get_metrics():
+    with _lock:
+        return dict(_metrics)
+
+def format_emf(function_name, metrics, properties=None):
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [['Function']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in sorted(metrics.items())],
+            }],
+        },
+        'Function': function_name,
+    }
+    record.update(properties or {})
+    record.update({name: round(value, 3) for name, (value, _) in metrics.items()})
+    return json.dumps(record)
+
+def flush(function_name, **properties):
+    metrics = get_metrics()
+    reset()
+    if metrics_enabled and metrics:
+        print(format_emf(function_name, metrics, properties))
+
+def instrument(handler):
+    # Wraps a lambda handler: resets the stage timings, times the whole
+    # request and emits the metrics once it returns
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME') or handler.__module__
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        reset()
+        status_code = None
+        try:
+            with stage(TOTAL):
+                response = handler(event, context)
+            if isinstance(response, dict):
+                status_code = response.get('statusCode')
+            return response
+        finally:
+            flush(function_name, StatusCode=status_code)
+
+    return wrapper
+
+class TestInstrumentation(unittest.TestCase):
+    def test_large_and_sensitive_fields_are_redacted(self):
+        event = {
+            'headers': {'Authorization': 'Bearer secret'},
+            'body': json.dumps({'prompt': 'a cat', 'image': 'A' * 100000}),
+        }
+        logged = json.dumps(redact(event))
+        self.assertLess(len(logged), 500)
+        self.assertNotIn('secret', logged)
+        self.assertIn('a cat', logged)
+        self.assertIn('<100000 chars>', logged)
+
+    def test_stages_are_summed_into_one_record(self):
+        reset()
+        add_metric(UPSTREAM, 10)
+        add_metric(UPSTREAM, 5)
+        add_size('OutputBytes', 2048)
+        record = json.loads(format_emf('test', get_metrics()))
+        self.assertEqual(record[UPSTREAM], 15)
+        self.assertEqual(record['OutputBytes'], 2048)
+        names = {m['Name']: m['Unit'] for m in record['_aws']['CloudWatchMetrics'][0]['Metrics']}
+        self.assertEqual(names, {UPSTREAM: 'Milliseconds', 'OutputBytes': 'Bytes'})
+        reset()
@@ -0,0 +1,58 @@
+import hmac
+import json
+import instrumentation
+import jobs
+import replicate_models
+import result_store
+
+def json_response(status_code, body):
+    return {
+        "statusCode": status_code,
+        'headers': { 'Content-Type': 'application/json' },
+        "body": json.dumps(body),
+    }
+
+def refresh_prediction(job):
+    # Poll Replicate in case the webhook hasn't arrived yet
+    prediction = replicate_models.with_client(
+        lambda replicate_client: replicate_client.predictions.get(job['predictionId'])
+    )
+    fields = replicate_models.get_controlnet_job_fields(prediction.status, prediction.output, prediction.error)
+    if fields['status'] == job['status']:
+        return job
+    return jobs.update_job(job['jobId'], **fields)
+
+def handle_webhook(event, job):
+    token = (event.get('queryStringParameters') or {}).get('token') or ''
+    if not hmac.compare_digest(token, job['token']):
+        return json_response(403, {'error': 'Invalid token'})
+    prediction = json.loads(event['body'])
+    print(f"Prediction {prediction.get('id')} for job {job['jobId']} is {prediction.get('status')}")
+    if job['status'] not in jobs.TERMINAL_STATUSES:
+        fields = replicate_models.get_controlnet_job_fields(
+            prediction.get('status'),
+            prediction.get('output'),
+            prediction.get('error'),
+        )
+        jobs.update_job(job['jobId'], **fields)
+    return json_response(200, {})
+
+@instrumentation.instrument
+def handler(event, context):
+    print(f"Received job request: {event.get('httpMethod')} {event.get('resource')}")
+    job_id = (event.get('pathParameters') or {}).get('jobId')
+    job = jobs.get_job(job_id) if job_id else None
+    if not job:
+        return json_response(404, {'error': 'Job not found'})
+
+    if event.get('httpMethod') == 'POST':
+        return handle_webhook(event, job)
+
+    if job['status'] not in jobs.TERMINAL_STATUSES and job.get('predictionId'):
+        job = refresh_prediction(job)
+
+    view = jobs.public_view(job)
+    if view.get('result') and job['kind'] == 'generate-image':
+        # Presigned result urls are only valid for a short time
+        result_store.refresh_urls(view['result'])
+    return json_response(200, view)
@@ -0,0 +1,259 @@
+import ipaddress
+import json
+import os
+import secrets
+import socket
+import threading
+import time
+import unittest
+import uuid
+from urllib import request as urllib_request
+from urllib.parse import urlparse
+
+# Submit/poll support for long running generations. Jobs live in DynamoDB,
+# or in memory when JOB_TABLE_NAME is unset so the flow can run locally.
+job_table_name = os.environ.get('JOB_TABLE_NAME')
+# "lambda" re-invokes the function asynchronously, "local" runs the work in a thread
+dispatch_mode = os.environ.get('JOB_DISPATCH', 'lambda' if job_table_name else 'local')
+job_ttl_seconds = int(os.environ.get('JOB_TTL_SECONDS', 24 * 3600))
+callback_timeout_seconds = int(os.environ.get('JOB_CALLBACK_TIMEOUT_SECONDS', 10))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+TERMINAL_STATUSES = (SUCCEEDED, FAILED)
+
+PUBLIC_FIELDS = ('jobId', 'kind', 'status', 'result', 'error', 'createdAt', 'updatedAt')
+
+class MemoryJobStore:
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def put(self, job):
+        with self._lock:
+            self._jobs[job['jobId']] = dict(job)
+
+    def update(self, job_id, fields):
+        # Returns None for a job that already finished, see update_job
+        with self._lock:
+            if self._jobs[job_id]['status'] in TERMINAL_STATUSES:
+                return None
+            self._jobs[job_id].update(fields)
+            return dict(self._jobs[job_id])
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+class DynamoJobStore:
+    def __init__(self, table_name):
+        import boto3
+        self.table = boto3.resource('dynamodb').Table(table_name)
+
+    def put(self, job):
+        self.table.put_item(Item=self._encode(job))
+
+    def update(self, job_id, fields):
+        # Returns None for a job that already finished, see update_job
+        names = {f"#{k}": k for k in fields}
+        names['#status'] = 'status'
+        values = {f":{k}": v for k, v in self._encode(fields).items()}
+        terminal = {f":terminal{i}": status for i, status in enumerate(TERMINAL_STATUSES)}
+        values.update(terminal)
+        try:
+            response = self.table.update_item(
+                Key={'jobId': job_id},
+                UpdateExpression="SET " + ", ".join(f"#{k} = :{k}" for k in fields),
+                ConditionExpression=f"NOT #status IN ({', '.join(terminal)})",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_NEW',
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return None
+        return self._decode(response['Attributes'])
+
+    def get(self, job_id):
+        response = self.table.get_item(Key={'jobId': job_id}, ConsistentRead=True)
+        item = response.get('Item')
+        return self._decode(item) if item else None
+
+    # Results are stored as JSON strings so DynamoDB never sees floats
+    def _encode(self, job):
+        encoded = dict(job)
+        if 'result' in encoded:
+            encoded['result'] = json.dumps(encoded['result'])
+        return encoded
+
+    def _decode(self, item):
+        job = dict(item)
+        if isinstance(job.get('result'), str):
+            job['result'] = json.loads(job['result'])
+        for field in ('createdAt', 'updatedAt', 'expiresAt'):
+            if field in job:
+                job[field] = int(job[field])
+        return job
+
+_store = None
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = DynamoJobStore(job_table_name) if job_table_name else MemoryJobStore()
+    return _store
+
+def check_callback_url(callback_url):
+    # Callbacks are sent from inside AWS, so a client must not be able to
+    # point them at the metadata service or anything else non-public.
+    # Checked on submit and again right before sending, the name could have
+    # been re-pointed in between.
+    parsed = urlparse(callback_url)
+    if parsed.scheme != 'https' or not parsed.hostname:
+        raise ValueError("callbackUrl must be an https url")
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or 443, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError, ValueError):
+        raise ValueError(f"callbackUrl host {parsed.hostname} does not resolve")
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"callbackUrl host {parsed.hostname} is not a public address")
+
+class NoRedirect(urllib_request.HTTPRedirectHandler):
+    # A public callback host could otherwise redirect the request anywhere
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+def create_job(kind, callback_url=None, **fields):
+    # Raises ValueError for a callback url that can't be used
+    if callback_url:
+        check_callback_url(callback_url)
+    now = int(time.time())
+    job = dict(fields)
+    job.update({
+        'jobId': str(uuid.uuid4()),
+        'kind': kind,
+        'status': QUEUED,
+        'createdAt': now,
+        'updatedAt': now,
+        'expiresAt': now + job_ttl_seconds,
+        # Guards the provider webhook url for this job
+        'token': secrets.token_urlsafe(16),
+    })
+    if callback_url:
+        job['callbackUrl'] = callback_url
+    get_store().put(job)
+    return job
+
+def update_job(job_id, **fields):
+    # Finished jobs are never changed again. The webhook, a status poll and
+    # the worker can all race to finish the same job, only the update that
+    # wins sends the callback.
+    fields['updatedAt'] = int(time.time())
+    job = get_store().update(job_id, fields)
+    if job is None:
+        print(f"Job {job_id} already finished, ignoring update to {fields.get('status')}")
+        return get_job(job_id)
+    if fields.get('status') in TERMINAL_STATUSES:
+        notify_callback(job)
+    return job
+
+def get_job(job_id):
+    return get_store().get(job_id)
+
+def public_view(job):
+    return {k: job[k] for k in PUBLIC_FIELDS if k in job}
+
+def notify_callback(job):
+    callback_url = job.get('callbackUrl')
+    if not callback_url:
+        return
+    data = json.dumps(public_view(job)).encode('utf-8')
+    callback_request = urllib_request.Request(
+        callback_url,
+        data=data,
+        headers={'Content-Type': 'application/json'},
+        method='POST',
+    )
+    try:
+        check_callback_url(callback_url)
+        opener = urllib_request.build_opener(NoRedirect)
+        with opener.open(callback_request, timeout=callback_timeout_seconds) as response:
+            print(f"Job {job['jobId']} callback returned {response.status}")
+    except Exception as e:
+        # Clients can still poll the status endpoint
+        print(f"Job {job['jobId']} callback failed: {e}")
+
+def dispatch(context, handler, event):
+    # Run handler(event) in the background and return immediately
+    if dispatch_mode == 'local':
+        threading.Thread(target=handler, args=(event, context), daemon=True).start()
+        return
+    import boto3
+    boto3.client('lambda').invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        Payload=json.dumps(event).encode('utf-8'),
+    )
+
+def get_webhook_url(event, job):
+    # Built from the API Gateway request so providers can call back into this stage
+    request_context = event.get('requestContext') or {}
+    domain_name = request_context.get('domainName')
+    if not domain_name:
+        return None
+    stage = request_context.get('stage')
+    base_url = f"https://{domain_name}/{stage}" if stage else f"https://{domain_name}"
+    return f"{base_url}/jobs/{job['jobId']}/webhook?token={job['token']}"
+
+def accepted_response(job):
+    return {
+        "statusCode": 202,
+        'headers': { 'Content-Type': 'application/json' },
+        "body": json.dumps(public_view(job)),
+    }
+
+class TestJobs(unittest.TestCase):
+    def test_local_job_lifecycle(self):
+        job = create_job('test', prompt='cat')
+        done = threading.Event()
+
+        def worker(event, context):
+            update_job(event['jobId'], status=SUCCEEDED, result={'image': 'url'})
+            done.set()
+
+        dispatch(None, worker, {'jobId': job['jobId']})
+        self.assertTrue(done.wait(5))
+        stored = public_view(get_job(job['jobId']))
+        self.assertEqual(stored['status'], SUCCEEDED)
+        self.assertEqual(stored['result'], {'image': 'url'})
+        self.assertNotIn('token', stored)
+
+    def test_callbacks_only_go_to_public_https_urls(self):
+        for url in (
+            'http://93.184.216.34/hook',
+            'https://127.0.0.1/hook',
+            'https://localhost/hook',
+            'https://169.254.169.254/latest/meta-data/',
+            'https://10.0.0.1/hook',
+            'https://[::ffff:192.168.0.1]/hook',
+            'https:///hook',
+        ):
+            with self.assertRaises(ValueError, msg=url):
+                create_job('test', url)
+        check_callback_url('https://93.184.216.34/hook')
+
+    def test_job_finishes_and_notifies_once(self):
+        from unittest import mock
+
+        job = create_job('test')
+        with mock.patch(__name__ + '.notify_callback') as notify:
+            update_job(job['jobId'], status=SUCCEEDED, result={'image': 'url'})
+            stored = update_job(job['jobId'], status=FAILED, error='late poll')
+            update_job(job['jobId'], status=RUNNING)
+        self.assertEqual(notify.call_count, 1)
+        self.assertEqual(stored['status'], SUCCEEDED)
+        self.assertEqual(get_job(job['jobId'])['status'], SUCCEEDED)
@@ -0,0 +1,308 @@
+import os
+import re
+import unittest
+from io import BytesIO
+import numpy as np
+import instrumentation
+
+# Dirty-rectangle inpainting: only the part of the canvas the mask touches,
+# plus some context around it, is sent to the inpainting engine, and the
+# result is feathered back into the untouched canvas.
+# Stability repaints the dark pixels of a mask and keeps the white ones.
+changed_below = int(os.environ.get('MASK_CHANGED_BELOW', 250))
+# Unchanged canvas kept around the edit so the model sees its surroundings
+context_margin = int(os.environ.get('INPAINT_CONTEXT_MARGIN', 64))
+feather_pixels = int(os.environ.get('INPAINT_FEATHER', 16))
+# Crops are at least the engine's native size, unless the canvas is smaller
+min_crop_size = int(os.environ.get('INPAINT_MIN_CROP', 512))
+# Above this share of the canvas the whole canvas is generated instead
+max_crop_fraction = float(os.environ.get('INPAINT_MAX_CROP_FRACTION', 0.6))
+dimension_multiple = 64
+
+# Masks can also be derived from the canvas itself (maskSource), so clients
+# send one image instead of the canvas and a full size mask. Erased pixels,
+# those more transparent than alpha_threshold, or pixels within
+# color_tolerance of a key color are repainted.
+alpha_threshold = int(os.environ.get('MASK_ALPHA_THRESHOLD', 128))
+color_tolerance = int(os.environ.get('MASK_COLOR_TOLERANCE', 16))
+# The derived mask is grown past antialiased stroke edges, then softened.
+# While the dilation is at least the feather, every erased pixel stays fully
+# repainted.
+mask_dilate_pixels = int(os.environ.get('MASK_DILATE', 4))
+mask_feather_pixels = int(os.environ.get('MASK_FEATHER', 4))
+max_mask_radius = 64
+
+def changed_bounds(mask):
+    # (left, top, right, bottom) of the pixels to repaint, None if there are none
+    return repaint_bounds(mask < changed_below)
+
+def repaint_bounds(changed):
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not len(rows):
+        return None
+    columns = np.flatnonzero(changed.any(axis=0))
+    return int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+
+def expand_axis(start, end, length, margin, min_size, multiple):
+    start = max(0, start - margin)
+    end = min(length, end + margin)
+    size = max(end - start, min(min_size, length))
+    # Engines take multiples of 64, normalized canvases already are
+    size = min(length, -(-size // multiple) * multiple)
+    start = int(round((start + end - size) / 2.0))
+    start = min(max(0, start), length - size)
+    return start, start + size
+
+def plan_crop(mask_image, margin=context_margin, min_size=min_crop_size, max_fraction=max_crop_fraction):
+    # Returns the box to generate, or None to generate the whole canvas
+    width, height = mask_image.size
+    bounds = changed_bounds(np.asarray(mask_image.convert('L')))
+    if bounds is None:
+        return None
+    left, right = expand_axis(bounds[0], bounds[2], width, margin, min_size, dimension_multiple)
+    top, bottom = expand_axis(bounds[1], bounds[3], height, margin, min_size, dimension_multiple)
+    if (right - left) * (bottom - top) > max_fraction * width * height:
+        return None
+    return left, top, right, bottom
+
+def seam_weights(box, canvas_size, feather=feather_pixels):
+    # Crop opacity, ramping up from each crop edge that lies inside the canvas
+    left, top, right, bottom = box
+
+    def ramp(start, end, length):
+        positions = np.arange(end - start, dtype=np.float32) + 0.5
+        weight = np.ones(end - start, dtype=np.float32)
+        if feather > 0 and start > 0:
+            weight = np.minimum(weight, positions / feather)
+        if feather > 0 and end < length:
+            weight = np.minimum(weight, positions[::-1] / feather)
+        return weight
+
+    return np.minimum.outer(ramp(top, bottom, canvas_size[1]), ramp(left, right, canvas_size[0]))
+
+def composite(canvas_image, crop_bytes, box, feather=feather_pixels):
+    # Returns the canvas with the generated crop blended in, as PNG bytes
+    from PIL import Image
+
+    with instrumentation.stage(instrumentation.ENCODE):
+        left, top, right, bottom = box
+        crop = Image.open(BytesIO(crop_bytes)).convert('RGB')
+        if crop.size != (right - left, bottom - top):
+            crop = crop.resize((right - left, bottom - top), Image.LANCZOS)
+        # Only the crop is blended in float, the rest of the canvas is copied
+        canvas = np.array(canvas_image.convert('RGB'))
+        weight = seam_weights(box, canvas_image.size, feather)[:, :, None]
+        region = canvas[top:bottom, left:right].astype(np.float32)
+        region += (np.asarray(crop, dtype=np.float32) - region) * weight
+        canvas[top:bottom, left:right] = np.clip(region + 0.5, 0, 255).astype(np.uint8)
+        buffered = BytesIO()
+        Image.fromarray(canvas).save(buffered, format='PNG')
+    return buffered.getvalue()
+
+def parse_mask_source(value):
+    # Returns 'alpha' or the (r, g, b) key color of a '#rrggbb' string
+    if value == 'alpha':
+        return value
+    match = re.fullmatch(r'#?([0-9a-fA-F]{6})', str(value))
+    if not match:
+        raise ValueError("maskSource must be 'alpha' or a color such as '#ff00ff'")
+    return tuple(bytes.fromhex(match.group(1)))
+
+def parse_mask_radius(value, name):
+    radius = int(value)
+    if not 0 <= radius <= max_mask_radius:
+        raise ValueError(f"{name} must be between 0 and {max_mask_radius}")
+    return radius
+
+def repaint_from_color(pixels, color, tolerance=color_tolerance):
+    # Compared a channel at a time against the key color's range, which keeps
+    # the temporaries to one boolean plane
+    repaint = np.ones(pixels.shape[:2], dtype=bool)
+    for channel, value in enumerate(color):
+        plane = pixels[:, :, channel]
+        repaint &= plane >= max(0, value - tolerance)
+        repaint &= plane <= min(255, value + tolerance)
+    return repaint
+
+def dilate_axis(repaint, radius, axis):
+    # Each step ORs in the mask shifted both ways by up to twice the distance
+    # already covered plus one, so a radius takes O(log radius) passes. Padded
+    # so pixels shifted past an edge can still be shifted back.
+    length = repaint.shape[axis]
+    padding = [(0, 0)] * repaint.ndim
+    padding[axis] = (radius, radius)
+    repaint = np.moveaxis(np.pad(repaint, padding), axis, 0)
+    covered = 0
+    while covered < radius:
+        step = min(2 * covered + 1, radius - covered)
+        grown = repaint.copy()
+        grown[step:] |= repaint[:-step]
+        grown[:-step] |= repaint[step:]
+        repaint = grown
+        covered += step
+    return np.moveaxis(repaint[radius:radius + length], 0, axis)
+
+def dilate(repaint, radius):
+    # Square structuring element, as one pass per axis
+    return dilate_axis(dilate_axis(repaint, radius, 0), radius, 1)
+
+def box_sum_axis(values, radius, axis):
+    # Sums over a 2 * radius + 1 window as shifted slices of the edge padded
+    # values, faster than a running sum for the small radii used here
+    padding = [(0, 0)] * values.ndim
+    padding[axis] = (radius, radius)
+    padded = np.moveaxis(np.pad(values.astype(np.int16), padding, mode='edge'), axis, 0)
+    length = values.shape[axis]
+    total = padded[:length].copy()
+    for shift in range(1, 2 * radius + 1):
+        total += padded[shift:shift + length]
+    return np.moveaxis(total, 0, axis)
+
+def feather_mask(repaint, radius):
+    # Returns the mask image values, 0 where the pixel is repainted. Only the
+    # bounding box of the repainted pixels grown by the radius is blurred,
+    # the rest of the mask is kept as is.
+    bounds = repaint_bounds(repaint) if radius > 0 else None
+    if bounds is None:
+        return np.logical_not(repaint).view(np.uint8) * np.uint8(255)
+    height, width = repaint.shape
+    left, top = max(0, bounds[0] - radius), max(0, bounds[1] - radius)
+    right, bottom = min(width, bounds[2] + radius), min(height, bounds[3] + radius)
+    mask = np.full(repaint.shape, 255, dtype=np.uint8)
+    window = repaint[top:bottom, left:right].view(np.uint8)
+    area = (2 * radius + 1) ** 2
+    coverage = box_sum_axis(box_sum_axis(window, radius, 0), radius, 1).astype(np.int32)
+    mask[top:bottom, left:right] = 255 - (coverage * 255 + area // 2) // area
+    return mask
+
+def soften(repaint, dilate_pixels, feather_pixels):
+    # Returns the mask image values. Only the box around the repainted pixels
+    # that the dilation and feathering can reach is processed.
+    mask = np.full(repaint.shape, 255, dtype=np.uint8)
+    bounds = repaint_bounds(repaint)
+    if bounds is None:
+        return mask
+    reach = dilate_pixels + feather_pixels
+    height, width = repaint.shape
+    left, top = max(0, bounds[0] - reach), max(0, bounds[1] - reach)
+    right, bottom = min(width, bounds[2] + reach), min(height, bounds[3] + reach)
+    window = dilate(repaint[top:bottom, left:right], dilate_pixels)
+    mask[top:bottom, left:right] = feather_mask(window, feather_pixels)
+    return mask
+
+def flatten(image, alpha):
+    # Transparent areas are blank paper, as when a canvas is normalized. Only
+    # the box around the pixels that aren't opaque is composited.
+    from PIL import Image
+
+    canvas = image.convert('RGB')
+    bounds = repaint_bounds(alpha < 255)
+    if bounds is not None:
+        region = image.crop(bounds)
+        paper = Image.new('RGB', region.size, (255, 255, 255))
+        paper.paste(region, mask=region.getchannel('A'))
+        canvas.paste(paper, bounds[:2])
+    return canvas
+
+def derive_mask(image, source, dilate_pixels=mask_dilate_pixels, feather_pixels=mask_feather_pixels):
+    # Returns (canvas to generate from, mask) for a canvas whose erased or
+    # key colored pixels mark what to repaint
+    from PIL import Image
+
+    with instrumentation.stage(instrumentation.NORMALIZE):
+        if source == 'alpha':
+            if 'A' not in image.getbands():
+                raise ValueError("maskSource alpha needs an image with an alpha channel")
+            image = image.convert('RGBA')
+            alpha = np.asarray(image.getchannel('A'))
+            repaint = alpha < alpha_threshold
+            canvas = flatten(image, alpha)
+        else:
+            canvas = image.convert('RGB')
+            repaint = repaint_from_color(np.asarray(canvas), source)
+        mask = soften(repaint, dilate_pixels, feather_pixels)
+    return canvas, Image.fromarray(mask)
+
+class TestDirtyRect(unittest.TestCase):
+    def test_crop_covers_edit_with_context(self):
+        from PIL import Image
+
+        mask = np.full((1024, 1024), 255, dtype=np.uint8)
+        mask[900:950, 40:100] = 0
+        box = plan_crop(Image.fromarray(mask))
+        left, top, right, bottom = box
+        self.assertEqual((right - left, bottom - top), (512, 512))
+        self.assertEqual(left, 0)
+        self.assertEqual(bottom, 1024)
+        # Nothing to repaint, or most of the canvas, generates the whole canvas
+        self.assertIsNone(plan_crop(Image.fromarray(np.full((1024, 1024), 255, dtype=np.uint8))))
+        self.assertIsNone(plan_crop(Image.fromarray(np.zeros((512, 512), dtype=np.uint8))))
+
+    def test_composite_only_changes_the_crop(self):
+        from PIL import Image
+
+        canvas = Image.new('RGB', (1024, 768), (10, 20, 30))
+        buffered = BytesIO()
+        Image.new('RGB', (512, 512), (200, 100, 50)).save(buffered, format='PNG')
+        box = (256, 256, 768, 768)
+        result = np.asarray(Image.open(BytesIO(composite(canvas, buffered.getvalue(), box))))
+        self.assertEqual(result[100, 100].tolist(), [10, 20, 30])
+        self.assertEqual(result[600, 500].tolist(), [200, 100, 50])
+        # Feathered at the inner edge, hard at the canvas edge
+        self.assertTrue(10 < result[600, 258, 0] < 200)
+        self.assertEqual(result[767, 500].tolist(), [200, 100, 50])
+
+class TestDerivedMask(unittest.TestCase):
+    def test_dilate_matches_square_window(self):
+        repaint = np.zeros((40, 50), dtype=bool)
+        repaint[20, 25] = True
+        repaint[0, 0] = True
+        for radius in (0, 1, 2, 5, 13):
+            grown = dilate(repaint, radius)
+            expected = np.zeros_like(repaint)
+            expected[max(0, 20 - radius):21 + radius, max(0, 25 - radius):26 + radius] = True
+            expected[:1 + radius, :1 + radius] = True
+            np.testing.assert_array_equal(grown, expected)
+
+    def test_erased_pixels_become_the_mask(self):
+        from PIL import Image
+
+        pixels = np.full((256, 256, 4), 255, dtype=np.uint8)
+        pixels[:, :, :3] = 40
+        pixels[100:140, 60:120, 3] = 0
+        canvas, mask = derive_mask(Image.fromarray(pixels), 'alpha', 4, 4)
+        mask = np.asarray(mask)
+        self.assertEqual(canvas.mode, 'RGB')
+        self.assertEqual(canvas.getpixel((80, 120)), (255, 255, 255))
+        # Erased pixels are fully repainted, far away ones kept, the edge soft
+        self.assertTrue((mask[100:140, 60:120] == 0).all())
+        self.assertEqual(mask[10, 10], 255)
+        self.assertTrue(0 < mask[97, 90] < 255)
+        self.assertEqual(changed_bounds(mask), (52, 92, 128, 148))
+
+        keyed = np.zeros((64, 64, 3), dtype=np.uint8)
+        keyed[10:20, 30:40] = (250, 0, 255)
+        _, mask = derive_mask(Image.fromarray(keyed), parse_mask_source('#ff00ff'), 0, 0)
+        self.assertEqual(changed_bounds(np.asarray(mask)), (30, 10, 40, 20))
+        with self.assertRaises(ValueError):
+            derive_mask(Image.fromarray(keyed), 'alpha')
+
+    def test_stored_upload_keeps_alpha(self):
+        from io import BytesIO
+        from PIL import Image
+        import image_normalize
+
+        # An erased canvas as upload_image stores it, then read back by imageKey
+        pixels = np.full((1536, 2048, 4), 255, dtype=np.uint8)
+        pixels[600:700, 800:1000, 3] = 0
+        buffered = BytesIO()
+        Image.fromarray(pixels).save(buffered, format='PNG')
+        stored, _ = image_normalize.normalize_image(buffered.getvalue(), 2048 * 2048, keep_alpha=True)
+        normalized, size = image_normalize.normalize_image(stored, keep_alpha=True)
+        self.assertEqual(size, (1152, 832))
+        canvas, mask = derive_mask(Image.open(BytesIO(normalized)), 'alpha')
+        self.assertEqual(canvas.size, size)
+        self.assertEqual(np.asarray(mask)[365, 506], 0)
+        # Requests without maskSource get the canvas flattened as before
+        flattened, _ = image_normalize.normalize_image(stored)
+        self.assertEqual(Image.open(BytesIO(flattened)).mode, 'RGB')
@@ -1,5 +1,19 @@
+import json
+import os
+
+# Written by scripts/build_style_thumbnails.py
+manifestPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'style_manifest.json')
+
+def loadManifest():
+    if not os.path.exists(manifestPath):
+        print(f"No style manifest at {manifestPath}, returning full size images only")
+        return {}
+    with open(manifestPath) as f:
+        return json.load(f)
+
 class PromptStyleData:
     def __init__(self):
+        self.manifest = loadManifest()
         self.s3KeyMap = {
             "None": "None/None.jpeg",
             "3-D": "3-D/3-D.jpeg",
@@ -55,13 +69,40 @@ class PromptStyleData:
         objectUrl = f"https://{bucketName}.s3.amazonaws.com/{s3Key}"
         return objectUrl
 
+    def getThumbnailForStyleKey(self, styleKey, bucketName):
+        # Responsive variants for the picker tiles, e.g.
+        # {"webp": {"src": ..., "srcset": "<url> 96w, <url> 192w"}, "placeholder": ...}
+        entry = self.manifest.get(styleKey)
+        if not entry:
+            return None
+        thumbnail = {
+            "width": entry["width"],
+            "height": entry["height"],
+            "placeholder": entry["placeholder"],
+        }
+        for imageFormat, variants in entry["variants"].items():
+            if not variants:
+                continue
+            urls = [(f"https://{bucketName}.s3.amazonaws.com/{variant['key']}", variant["width"]) for variant in variants]
+            thumbnail[imageFormat] = {
+                "src": urls[0][0],
+                "srcset": ", ".join(f"{url} {width}w" for url, width in urls),
+            }
+        return thumbnail
+
+    def addImages(self, style, bucketName):
+        style["imageUrl"] = self.getObjectUrlForStyleKey(style["key"], bucketName)
+        thumbnail = self.getThumbnailForStyleKey(style["key"], bucketName)
+        if thumbnail:
+            style["thumbnail"] = thumbnail
+
     def getPromptStyles(self, bucketName):
         promptStyles = self.getDefaultPromptStyles()
         for style in promptStyles:
-            style["imageUrl"] = self.getObjectUrlForStyleKey(style["key"], bucketName)
+            self.addImages(style, bucketName)
             for substyle in style.get("substyles", []):
                 for value in substyle["values"]:
-                    value["imageUrl"] = self.getObjectUrlForStyleKey(value["key"], bucketName)
+                    self.addImages(value, bucketName)
 
         return promptStyles
     
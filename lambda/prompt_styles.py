@@ -1,23 +1,61 @@
-import boto3
+import hashlib
 import json
 import os
+import instrumentation
 from prompt_style_data import PromptStyleData
 
 bucketName = os.environ.get('BUCKET_NAME')
-s3 = boto3.resource('s3')
+cacheMaxAge = int(os.environ.get('PROMPT_STYLES_MAX_AGE_SECONDS', 3600))
 
+# The styles only change on deploy, so the payload is built once per container
+_payload = None
+
+def getPayload():
+    global _payload
+    if _payload is None:
+        promptStyleData = PromptStyleData()
+        body = json.dumps(
+            {
+                "promptStyles": promptStyleData.getPromptStyles(bucketName)
+            },
+            separators=(',', ':'),
+        )
+        etag = '"' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:32] + '"'
+        _payload = (body, etag)
+    return _payload
+
+def isNotModified(event, etag):
+    headers = (event or {}).get('headers') or {}
+    ifNoneMatch = next((v for k, v in headers.items() if k.lower() == 'if-none-match'), None)
+    if not ifNoneMatch:
+        return False
+    tags = [tag.strip() for tag in ifNoneMatch.split(',')]
+    # Weak comparison, API Gateway marks the etag weak when it compresses the body
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
+@instrumentation.instrument
 def handler(event, context):
+    body, etag = getPayload()
+    headers = {
+        "Content-Type": "application/json",
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={cacheMaxAge}",
+    }
+    if isNotModified(event, etag):
+        print(f"Prompt styles not modified")
+        return {
+            "statusCode": 304,
+            "headers": headers,
+            "body": "",
+        }
+
     print(f"Returning prompt styles")
-    promptStyleData = PromptStyleData()
     return {
         "statusCode": 200,
-        "body": json.dumps(
-            {
-                "promptStyles": promptStyleData.getPromptStyles(bucketName)
-            }
-        ),
+        "headers": headers,
+        "body": body,
     }
-    
+
 if __name__ == '__main__':
     response = handler(None, None)
     print(response)
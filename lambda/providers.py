@@ -0,0 +1,293 @@
+import os
+import threading
+import time
+import unittest
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import instrumentation
+
+# Per request deadlines, hedged attempts across providers and a circuit
+# breaker per provider, so one slow or failing upstream can't hold a request
+# for the whole Lambda timeout.
+# API Gateway gives up on the integration after 29 seconds
+sync_deadline_seconds = float(os.environ.get('SYNC_DEADLINE_SECONDS', 28))
+job_deadline_seconds = float(os.environ.get('JOB_DEADLINE_SECONDS', 600))
+# Kept back from the provider calls for encoding and uploading the result
+post_process_seconds = float(os.environ.get('POST_PROCESS_SECONDS', 2))
+# Start the next provider when the current one hasn't answered by then
+hedge_after_seconds = float(os.environ.get('HEDGE_AFTER_SECONDS', 10))
+failure_threshold = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+reset_seconds = float(os.environ.get('CIRCUIT_RESET_SECONDS', 30))
+
+class DeadlineExceeded(Exception):
+    pass
+
+class ProviderUnavailable(Exception):
+    pass
+
+class RateLimited(Exception):
+    # The provider is at its rate limit, see scheduler. Says nothing about
+    # the provider's health, so it doesn't count against its circuit.
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded("Request deadline exceeded")
+
+def request_deadline(context=None, seconds=sync_deadline_seconds):
+    # Started at handler entry so decoding and normalizing count against it,
+    # and never past the time the Lambda itself has left
+    if context is not None:
+        seconds = min(seconds, context.get_remaining_time_in_millis() / 1000.0)
+    return Deadline(max(0.0, seconds - post_process_seconds))
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive failures or calls still
+    # running at the deadline. Once reset_seconds have passed a single trial call is let
+    # through, closing the breaker again if it succeeds.
+    def __init__(self, name, failure_threshold=failure_threshold, reset_seconds=reset_seconds):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if self.trial or time.monotonic() - self.opened_at >= self.reset_seconds:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                print(f"Circuit for {self.name} closed")
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def release_trial(self):
+        # The trial call ended without saying anything about the provider's
+        # health, e.g. it was rate limited, so let the next call try instead
+        with self._lock:
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+# One breaker per provider, shared by the requests of a warm container
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name):
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+def get_stats():
+    with _breakers_lock:
+        return {name: breaker.state() for name, breaker in _breakers.items()}
+
+class Provider:
+    # call(deadline) returns the result or raises, it should give up on its
+    # own once deadline.remaining() reaches zero where the SDK allows it
+    def __init__(self, name, call):
+        self.name = name
+        self.call = call
+
+def call(attempts, deadline, hedge_after=hedge_after_seconds):
+    # Runs the first available provider and, when it fails or hasn't answered
+    # after hedge_after seconds, the next one alongside it. Returns
+    # (provider name, result) of the first success.
+    #
+    # Calls that lose the race or outlive the deadline can't be cancelled and
+    # finish in the background, their results are dropped.
+    remaining = list(attempts)
+    pending = {}
+    errors = []
+    executor = ThreadPoolExecutor(max_workers=len(attempts))
+
+    def start_next():
+        while remaining:
+            provider = remaining.pop(0)
+            if get_breaker(provider.name).allow():
+                if pending or errors:
+                    reason = 'slow' if pending else 'failed'
+                    print(f"Starting {provider.name}, previous provider {reason}")
+                    instrumentation.add_metric('Fallbacks', 1, 'Count')
+                pending[executor.submit(provider.call, deadline)] = provider
+                return True
+            print(f"Skipping {provider.name}, circuit open")
+        return False
+
+    def abandon(slow):
+        # Losing the race to a hedge only means another provider was faster,
+        # a call still running at the deadline counts as failed
+        for provider in pending.values():
+            if slow:
+                get_breaker(provider.name).record_failure()
+            else:
+                get_breaker(provider.name).release_trial()
+        executor.shutdown(wait=False)
+
+    try:
+        if not start_next():
+            raise ProviderUnavailable("No provider available")
+        hedge_at = time.monotonic() + hedge_after
+        while pending:
+            timeout = deadline.remaining()
+            if remaining:
+                timeout = min(timeout, max(0.0, hedge_at - time.monotonic()))
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"{provider.name} failed: {e}")
+                    if isinstance(e, RateLimited):
+                        get_breaker(provider.name).release_trial()
+                    else:
+                        get_breaker(provider.name).record_failure()
+                    errors.append(e)
+                    continue
+                get_breaker(provider.name).record_success()
+                # Whatever is still running lost the race
+                abandon(slow=False)
+                return provider.name, result
+            if deadline.expired():
+                abandon(slow=True)
+                raise DeadlineExceeded("Request deadline exceeded")
+            if remaining and (not pending or time.monotonic() >= hedge_at):
+                if start_next():
+                    hedge_at = time.monotonic() + hedge_after
+    finally:
+        executor.shutdown(wait=False)
+
+    if errors:
+        raise errors[-1]
+    raise ProviderUnavailable("No provider available")
+
+class TestProviders(unittest.TestCase):
+    def setUp(self):
+        _breakers.clear()
+
+    def sleeper(self, seconds, result, calls=None):
+        def run(deadline):
+            if calls is not None:
+                calls.append(result)
+            time.sleep(seconds)
+            return result
+        return run
+
+    def test_fast_primary_is_not_hedged(self):
+        calls = []
+        name, result = call([
+            Provider('primary', self.sleeper(0, 'a', calls)),
+            Provider('fallback', self.sleeper(0, 'b', calls)),
+        ], Deadline(1), hedge_after=0.2)
+        self.assertEqual((name, result), ('primary', 'a'))
+        self.assertEqual(calls, ['a'])
+
+    def test_slow_primary_is_hedged(self):
+        started = time.monotonic()
+        name, result = call([
+            Provider('primary', self.sleeper(0.5, 'a')),
+            Provider('fallback', self.sleeper(0, 'b')),
+        ], Deadline(1), hedge_after=0.05)
+        self.assertEqual((name, result), ('fallback', 'b'))
+        self.assertLess(time.monotonic() - started, 0.3)
+        # Losing to the hedge doesn't count against the primary
+        self.assertEqual(get_breaker('primary').failures, 0)
+
+    def test_failed_primary_falls_back_immediately(self):
+        def fail(deadline):
+            raise Exception("down")
+        name, result = call([
+            Provider('primary', fail),
+            Provider('fallback', self.sleeper(0, 'b')),
+        ], Deadline(1), hedge_after=10)
+        self.assertEqual(result, 'b')
+
+    def test_deadline_bounds_the_call(self):
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            call([Provider('primary', self.sleeper(0.5, 'a'))], Deadline(0.1))
+        self.assertLess(time.monotonic() - started, 0.3)
+
+    def test_open_circuit_routes_around_provider(self):
+        breaker = get_breaker('primary')
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        self.assertEqual(breaker.state(), 'open')
+        calls = []
+        name, _ = call([
+            Provider('primary', self.sleeper(0, 'a', calls)),
+            Provider('fallback', self.sleeper(0, 'b', calls)),
+        ], Deadline(1))
+        self.assertEqual(name, 'fallback')
+        self.assertEqual(calls, ['b'])
+        with self.assertRaises(ProviderUnavailable):
+            call([Provider('primary', self.sleeper(0, 'a'))], Deadline(1))
+
+    def test_half_open_trial_closes_circuit(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_seconds=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        # Only one trial at a time
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state(), 'closed')
+
+    def test_request_deadline_fits_the_lambda(self):
+        class Context:
+            def get_remaining_time_in_millis(self):
+                return 5000
+        self.assertAlmostEqual(request_deadline().remaining(), sync_deadline_seconds - post_process_seconds, places=1)
+        self.assertAlmostEqual(request_deadline(Context()).remaining(), 5 - post_process_seconds, places=1)
+
+    def test_rate_limited_trial_is_released(self):
+        breaker = get_breaker('primary')
+        breaker.reset_seconds = 0
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        def limited(deadline):
+            raise RateLimited("slow down")
+        with self.assertRaises(RateLimited):
+            call([Provider('primary', limited)], Deadline(1))
+        # The next call gets its own trial instead of a stuck half-open circuit
+        name, _ = call([Provider('primary', self.sleeper(0, 'a'))], Deadline(1))
+        self.assertEqual(name, 'primary')
+        self.assertEqual(breaker.state(), 'closed')
@@ -0,0 +1,164 @@
+import json
+import os
+import time
+import client_pool
+import instrumentation
+import providers
+import scheduler
+import secrets_cache
+
+replicate_key_arn = os.environ.get('REPLICATE_KEY_ARN')
+poll_seconds = float(os.environ.get('REPLICATE_POLL_SECONDS', 0.5))
+
+# Pinned Replicate versions. Predictions are created directly against the
+# version id, so no models.get/versions.get lookups happen per request.
+# https://replicate.com/jagilley/controlnet-scribble/versions/435061a1b5a4c1e26740464bf786efdfa9cb3a3ac488595a2de23e143fdb0117
+CONTROLNET_SCRIBBLE = {
+    "model": "jagilley/controlnet-scribble",
+    "version": "435061a1b5a4c1e26740464bf786efdfa9cb3a3ac488595a2de23e143fdb0117",
+}
+# https://replicate.com/jagilley/controlnet/versions/8ebda4c70b3ea2a2bf86e44595afb562a2cdf85525c620f1671a78113c9f325b
+CONTROLNET = {
+    "model": "jagilley/controlnet",
+    "version": "8ebda4c70b3ea2a2bf86e44595afb562a2cdf85525c620f1671a78113c9f325b",
+}
+
+# modelType -> pinned version. Adding a model type is one entry here.
+CONTROLNET_MODELS = {
+    # More optimized verison of controlnet scribble
+    "scribble": CONTROLNET_SCRIBBLE,
+    "canny": CONTROLNET,
+    "depth": CONTROLNET,
+    "hed": CONTROLNET,
+    "normal": CONTROLNET,
+    "mlsd": CONTROLNET,
+    "seg": CONTROLNET,
+    "openpose": CONTROLNET,
+}
+
+# Stable Diffusion on Replicate, the fallback when Stability is slow or down
+# https://replicate.com/stability-ai/stable-diffusion/versions/db21e45d3f7023abc2a46ee38a23973f6dce16bb082a930b0c49861f96d1e5bf
+STABLE_DIFFUSION = {
+    "model": "stability-ai/stable-diffusion",
+    "version": "db21e45d3f7023abc2a46ee38a23973f6dce16bb082a930b0c49861f96d1e5bf",
+}
+# https://replicate.com/stability-ai/stable-diffusion-img2img/versions/15a3689ee13b0d2616e98820eca31d4c3abcd36672df6afce5cb6feb1d2a0185
+STABLE_DIFFUSION_IMG2IMG = {
+    "model": "stability-ai/stable-diffusion-img2img",
+    "version": "15a3689ee13b0d2616e98820eca31d4c3abcd36672df6afce5cb6feb1d2a0185",
+}
+
+# Also re-pinned through REPLICATE_MODEL_VERSIONS, e.g. '{"txt2img": "<model>:<version>"}'
+FALLBACK_MODELS = {
+    "txt2img": STABLE_DIFFUSION,
+    "img2img": STABLE_DIFFUSION_IMG2IMG,
+}
+
+def load_overrides():
+    # Versions can be re-pinned at deploy time without a code change, e.g.
+    # REPLICATE_MODEL_VERSIONS='{"canny": "jagilley/controlnet-canny:<version>"}'
+    overrides = json.loads(os.environ.get('REPLICATE_MODEL_VERSIONS') or '{}')
+    models = {}
+    for model_type, pinned in overrides.items():
+        model, _, version = pinned.rpartition(':')
+        models[model_type] = {"model": model, "version": version}
+    return models
+
+# Resolved once per container
+_overrides = load_overrides()
+controlnet_models = dict(CONTROLNET_MODELS, **{k: v for k, v in _overrides.items() if k not in FALLBACK_MODELS})
+fallback_models = dict(FALLBACK_MODELS, **{k: v for k, v in _overrides.items() if k in FALLBACK_MODELS})
+
+def get_controlnet_model(model_type):
+    model = controlnet_models.get(model_type)
+    if not model:
+        raise ValueError(f"Unsupported modelType: {model_type}")
+    return model
+
+def with_client(call, deadline=None, priority=None):
+    # Runs call(replicate_client) with the pooled client for the cached api
+    # token. Calls given a priority, the ones creating predictions, first wait
+    # for capacity through the scheduler, reads don't.
+    def call_with_key(api_key):
+        def call_client():
+            return client_pool.call_with_client(
+                'replicate',
+                'default',
+                lambda: client_pool.get_replicate_client(api_key),
+                call,
+            )
+        if priority is None:
+            return call_client()
+        return scheduler.call('replicate', api_key, call_client, deadline, priority)
+
+    return secrets_cache.call_with_secret(replicate_key_arn, 'REPLICATE_API_TOKEN', call_with_key)
+
+def create_prediction(replicate_client, version_id, inputs, webhook_url=None):
+    if webhook_url:
+        return replicate_client.predictions.create(
+            version=version_id,
+            input=inputs,
+            webhook=webhook_url,
+            webhook_events_filter=["completed"],
+        )
+    return replicate_client.predictions.create(version=version_id, input=inputs)
+
+def wait_for_prediction(prediction, deadline=None):
+    # prediction.wait() polls forever, with a deadline the prediction is
+    # cancelled instead so it stops billing
+    if deadline is None:
+        prediction.wait()
+        return
+    while prediction.status not in ("succeeded", "failed", "canceled"):
+        if deadline.expired():
+            print(f"Cancelling prediction {prediction.id} at the deadline")
+            try:
+                prediction.cancel()
+            except Exception as e:
+                print(f"Error cancelling prediction {prediction.id}: {e}")
+            raise providers.DeadlineExceeded(f"Prediction {prediction.id} {prediction.status} at the deadline")
+        time.sleep(min(poll_seconds, deadline.remaining()))
+        try:
+            prediction.reload()
+        except Exception as e:
+            # The prediction is still running, a throttled read just waits
+            # for the next poll
+            if not scheduler.is_rate_limited(e):
+                raise
+            print(f"Prediction {prediction.id} reload rate limited: {e}")
+
+def predict(version_id, inputs, deadline, priority):
+    # Equivalent to version.predict() without resolving the version first.
+    # Only the create goes through the scheduler: retrying anything after it,
+    # e.g. a throttled reload while polling, would start a second paid
+    # prediction while the first one keeps running.
+    def create(replicate_client):
+        # Rewind file inputs a previous attempt already consumed
+        for value in inputs.values():
+            if hasattr(value, 'seek'):
+                value.seek(0)
+        return create_prediction(replicate_client, version_id, inputs)
+
+    with instrumentation.stage(instrumentation.UPSTREAM):
+        prediction = with_client(create, deadline, priority)
+        wait_for_prediction(prediction, deadline)
+    if prediction.status != "succeeded":
+        raise Exception(prediction.error or f"Prediction {prediction.id} {prediction.status}")
+    return prediction.output
+
+def fetch_output(url, deadline):
+    # Outputs are served from replicate.delivery, no auth needed
+    import urllib.request
+
+    with instrumentation.stage(instrumentation.UPSTREAM):
+        with urllib.request.urlopen(url, timeout=max(1.0, deadline.remaining())) as response:
+            return response.read()
+
+def get_controlnet_job_fields(status, output, error):
+    # Maps a Replicate prediction status onto job fields
+    if status == "succeeded":
+        # Output is [detected input map, generated image]
+        return {"status": "succeeded", "result": {"image": output[1]}}
+    if status in ("failed", "canceled"):
+        return {"status": "failed", "error": error or f"Prediction {status}"}
+    return {"status": "running"}
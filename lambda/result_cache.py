@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+# Results of seeded generations are deterministic, so retries and re-renders
+# are served from a per-container LRU backed by a shared S3 tier.
+bucket_name = os.environ.get('BUCKET_NAME')
+cache_bucket_folder = "cache"
+ttl_seconds = int(os.environ.get('RESULT_CACHE_TTL_SECONDS', 3600))
+max_local_bytes = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+_s3 = None
+
+def get_s3():
+    global _s3
+    if _s3 is None:
+        import boto3
+        _s3 = boto3.client('s3')
+    return _s3
+
+def hash_bytes(data):
+    if data is None:
+        return None
+    return hashlib.sha256(data).hexdigest()
+
+def make_key(namespace, params):
+    # Normalize so equivalent requests map to the same key
+    normalized = json.dumps(
+        {k: v for k, v in params.items() if v is not None},
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+    return f"{namespace}/{hashlib.sha256(normalized.encode('utf-8')).hexdigest()}"
+
+class LRUCache:
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires_at = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, size, expires_at=None):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires_at or time.time() + self.ttl)
+            self.total_bytes += size
+            # Evict least recently used entries until under the size bound
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+class ResultCache:
+    def __init__(self, namespace, ttl=ttl_seconds, max_bytes=max_local_bytes):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = LRUCache(max_bytes, ttl)
+        self.stats = {'local_hits': 0, 's3_hits': 0, 'misses': 0, 'errors': 0}
+
+    def key(self, params):
+        return make_key(self.namespace, params)
+
+    def s3_key(self, key):
+        return f"{cache_bucket_folder}/{key}.json"
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.stats['local_hits'] += 1
+            return value
+
+        if bucket_name:
+            try:
+                response = get_s3().get_object(Bucket=bucket_name, Key=self.s3_key(key))
+                expires_at = float(response['Metadata'].get('expires-at', 0))
+                if expires_at > time.time():
+                    data = response['Body'].read()
+                    value = json.loads(data)
+                    self.local.put(key, value, len(data), expires_at)
+                    self.stats['s3_hits'] += 1
+                    return value
+            except Exception as e:
+                if type(e).__name__ != 'NoSuchKey':
+                    print(f"Result cache read failed: {e}")
+                    self.stats['errors'] += 1
+
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        data = json.dumps(value).encode('utf-8')
+        expires_at = time.time() + self.ttl
+        self.local.put(key, value, len(data), expires_at)
+        if not bucket_name:
+            return
+        try:
+            get_s3().put_object(
+                Bucket=bucket_name,
+                Key=self.s3_key(key),
+                Body=data,
+                ContentType='application/json',
+                Metadata={'expires-at': str(expires_at)},
+            )
+        except Exception as e:
+            # The cache is best effort, never fail a paid generation over it
+            print(f"Result cache write failed: {e}")
+            self.stats['errors'] += 1
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['local_entries'] = len(self.local)
+        stats['local_bytes'] = self.local.total_bytes
+        return stats
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_bytes=10, ttl=60)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        cache.get('a')
+        cache.put('c', 3, 4)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.total_bytes, 8)
+
+    def test_expired_entries_are_dropped(self):
+        cache = LRUCache(max_bytes=10, ttl=60)
+        cache.put('a', 1, 4, expires_at=time.time() - 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_key_ignores_param_order(self):
+        self.assertEqual(
+            make_key('ns', {'prompt': 'cat', 'seed': 1, 'mask': None}),
+            make_key('ns', {'seed': 1, 'prompt': 'cat'}),
+        )
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import instrumentation
+
+bucket_name = os.environ.get('BUCKET_NAME')
+results_bucket_folder = "results"
+url_expiration_seconds = int(os.environ.get('RESULT_URL_EXPIRATION_SECONDS', 3600))
+
+STORAGE_MODES = ('inline', 's3')
+EXTENSIONS = {
+    'image/png': 'png',
+    'image/webp': 'webp',
+    'image/jpeg': 'jpeg',
+}
+
+_s3 = None
+
+def get_s3():
+    global _s3
+    if _s3 is None:
+        import boto3
+        _s3 = boto3.client('s3')
+    return _s3
+
+def get_storage_mode(advanced_options):
+    storage_mode = str(advanced_options.get('resultStorage', 'inline')).lower()
+    if storage_mode not in STORAGE_MODES:
+        raise ValueError(f"Unsupported resultStorage: {storage_mode}")
+    return storage_mode
+
+def get_result_key(data, content_type):
+    # Content addressed, so identical results share one object
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{results_bucket_folder}/{digest}.{EXTENSIONS.get(content_type, 'bin')}"
+
+def store_result(data, content_type):
+    key = get_result_key(data, content_type)
+    print(f"Storing result in S3 location {key}")
+    with instrumentation.stage(instrumentation.UPLOAD):
+        get_s3().put_object(
+            Bucket=bucket_name,
+            Key=key,
+            Body=data,
+            ContentType=content_type,
+            # Only reachable through a presigned url that expires, and the
+            # object itself is deleted after RESULT_EXPIRATION_DAYS, so a
+            # cached copy must not outlive the url it was fetched with
+            CacheControl=f"private, max-age={url_expiration_seconds}",
+        )
+    return key
+
+def get_presigned_url(key):
+    return get_s3().generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket_name, 'Key': key},
+        ExpiresIn=url_expiration_seconds,
+    )
+
+def refresh_urls(body):
+    # Cached results outlive their presigned urls, sign them again on reuse
+    for result in body.get('images', [body]):
+        if 'key' in result:
+            result['url'] = get_presigned_url(result['key'])
+    return body
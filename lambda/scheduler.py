@@ -0,0 +1,238 @@
+import json
+import math
+import os
+import random
+import threading
+import time
+import unittest
+from decimal import Decimal
+import client_pool
+import instrumentation
+import providers
+
+# Rate limit aware scheduling of outbound provider calls. Every provider and
+# API key has a token bucket, shared by all containers through DynamoDB, or in
+# memory when RATE_LIMIT_TABLE_NAME is unset so the flow can run locally.
+# Callers wait their turn within their deadline instead of bursting into the
+# provider's 429s, and batch work (async jobs) leaves part of the bucket to
+# interactive requests. Calls the provider still rejects as rate limited or
+# overloaded are retried with jittered exponential backoff.
+rate_limit_table_name = os.environ.get('RATE_LIMIT_TABLE_NAME')
+# Requests per second and burst per provider and key, e.g.
+# PROVIDER_RATE_LIMITS='{"stability": {"rate": 10, "burst": 20}}'
+DEFAULT_RATE_LIMITS = {
+    # 150 requests per 10 seconds
+    'stability': {'rate': 15, 'burst': 30},
+    # 600 predictions created per minute
+    'replicate': {'rate': 10, 'burst': 20},
+}
+rate_limits = dict(DEFAULT_RATE_LIMITS, **json.loads(os.environ.get('PROVIDER_RATE_LIMITS') or '{}'))
+# Share of the burst that batch calls leave to interactive ones
+batch_reserve = float(os.environ.get('RATE_LIMIT_BATCH_RESERVE', 0.5))
+max_retries = int(os.environ.get('RATE_LIMIT_MAX_RETRIES', 4))
+backoff_seconds = float(os.environ.get('RATE_LIMIT_BACKOFF_SECONDS', 0.5))
+max_backoff_seconds = float(os.environ.get('RATE_LIMIT_MAX_BACKOFF_SECONDS', 8))
+bucket_ttl_seconds = 24 * 3600
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+class MemoryBucketStore:
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, reserve):
+        # Takes a token when more than reserve are left and returns 0,
+        # otherwise returns the seconds until one can be taken
+        with self._lock:
+            now = time.time()
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens >= 1 + reserve:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 + reserve - tokens) / rate
+
+class DynamoBucketStore:
+    # Same buckets, updated with a conditional write so concurrent containers
+    # never both spend the same token
+    write_attempts = 3
+
+    def __init__(self, table_name):
+        import boto3
+        self.table = boto3.resource('dynamodb').Table(table_name)
+
+    def take(self, key, rate, burst, reserve):
+        from boto3.dynamodb.conditions import Attr
+        from botocore.exceptions import ClientError
+
+        for _ in range(self.write_attempts):
+            item = self.table.get_item(Key={'bucketKey': key}, ConsistentRead=True).get('Item')
+            now = time.time()
+            if item:
+                tokens = min(burst, float(item['tokens']) + (now - float(item['updatedAt'])) * rate)
+                condition = Attr('updatedAt').eq(item['updatedAt'])
+            else:
+                tokens = burst
+                condition = Attr('bucketKey').not_exists()
+            if tokens < 1 + reserve:
+                return (1 + reserve - tokens) / rate
+            try:
+                self.table.put_item(
+                    Item={
+                        'bucketKey': key,
+                        'tokens': Decimal(str(round(tokens - 1, 3))),
+                        'updatedAt': Decimal(str(round(now, 3))),
+                        'expiresAt': int(now) + bucket_ttl_seconds,
+                    },
+                    ConditionExpression=condition,
+                )
+                return 0.0
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        # Another container won every race, try again once a token refills
+        return 1.0 / rate
+
+_store = None
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = DynamoBucketStore(rate_limit_table_name) if rate_limit_table_name else MemoryBucketStore()
+    return _store
+
+def acquire(provider, api_key, deadline, priority=INTERACTIVE):
+    # Waits for a token from the provider's bucket for this key
+    limit = rate_limits.get(provider)
+    if not limit:
+        return
+    key = f"{provider}#{client_pool.fingerprint(api_key)}"
+    rate = float(limit['rate'])
+    burst = float(limit['burst'])
+    reserve = min(batch_reserve * burst, burst - 1) if priority == BATCH else 0.0
+    while True:
+        try:
+            wait = get_store().take(key, rate, burst, reserve)
+        except Exception as e:
+            # Rate limiting is an optimization, a store outage mustn't fail requests
+            print(f"Error taking a {provider} token, continuing without: {e}")
+            return
+        if wait <= 0:
+            return
+        # Jittered so callers waiting on the same bucket don't all wake together
+        wait *= random.uniform(1, 1.5)
+        if wait > deadline.remaining():
+            raise providers.RateLimited(f"No {provider} capacity before the deadline", retry_after=wait)
+        with instrumentation.stage(instrumentation.QUEUE):
+            time.sleep(wait)
+
+def is_rate_limited(error):
+    # 429s and overload errors. Like auth errors, each SDK surfaces them
+    # differently: openai sets http_status, replicate/requests set
+    # status/status_code and grpc exposes code().
+    for attr in ('http_status', 'status_code', 'status'):
+        if getattr(error, attr, None) in (429, 503):
+            return True
+    code = getattr(error, 'code', None)
+    if callable(code):
+        try:
+            code_name = getattr(code(), 'name', '')
+        except Exception:
+            code_name = ''
+        if code_name == 'RESOURCE_EXHAUSTED':
+            return True
+    if type(error).__name__ in ('RateLimitError', 'ServiceUnavailableError'):
+        return True
+    # Older replicate clients only carry the API's message
+    message = str(error).lower()
+    return 'rate limit' in message or 'throttled' in message or 'too many requests' in message
+
+def get_retry_after(error):
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After') or headers.get('retry-after') or 0)
+    except (AttributeError, TypeError, ValueError):
+        return 0.0
+
+def retry_after_header(error):
+    # Whole seconds for the Retry-After header of a 429
+    return str(max(1, int(math.ceil(error.retry_after or 1))))
+
+def call(provider, api_key, fn, deadline, priority=INTERACTIVE):
+    # Runs fn() once the provider has capacity for this key, retrying with
+    # full jitter backoff while it answers rate limited
+    attempt = 0
+    while True:
+        acquire(provider, api_key, deadline, priority)
+        try:
+            return fn()
+        except Exception as e:
+            if isinstance(e, providers.RateLimited) or not is_rate_limited(e):
+                raise
+            instrumentation.add_metric('RateLimited', 1, 'Count')
+            cap = min(max_backoff_seconds, backoff_seconds * 2 ** attempt)
+            backoff = max(get_retry_after(e), random.uniform(0, cap))
+            attempt += 1
+            if attempt > max_retries or backoff >= deadline.remaining():
+                raise providers.RateLimited(f"{provider} is rate limiting requests: {e}", retry_after=max(1.0, backoff)) from e
+            print(f"{provider} rate limited, retry {attempt} in {backoff:.2f}s: {e}")
+            with instrumentation.stage(instrumentation.QUEUE):
+                time.sleep(backoff)
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        global _store
+        _store = MemoryBucketStore()
+        rate_limits['test'] = {'rate': 20, 'burst': 4}
+
+    def tearDown(self):
+        rate_limits.pop('test')
+
+    def test_burst_then_paced(self):
+        deadline = providers.Deadline(5)
+        started = time.monotonic()
+        for _ in range(4):
+            acquire('test', 'key', deadline)
+        self.assertLess(time.monotonic() - started, 0.03)
+        acquire('test', 'key', deadline)
+        self.assertGreater(time.monotonic() - started, 0.04)
+        # Keys have their own buckets
+        started = time.monotonic()
+        acquire('test', 'other key', deadline)
+        self.assertLess(time.monotonic() - started, 0.03)
+
+    def test_batch_leaves_headroom(self):
+        store = get_store()
+        self.assertEqual(store.take('b', 0.001, 4, 2), 0)
+        self.assertEqual(store.take('b', 0.001, 4, 2), 0)
+        # Batch waits once only the reserve is left, interactive doesn't
+        self.assertGreater(store.take('b', 0.001, 4, 2), 0)
+        self.assertEqual(store.take('b', 0.001, 4, 0), 0)
+        acquire('test', 'key', providers.Deadline(0), BATCH)
+        acquire('test', 'key', providers.Deadline(0), BATCH)
+        with self.assertRaises(providers.RateLimited):
+            acquire('test', 'key', providers.Deadline(0), BATCH)
+        acquire('test', 'key', providers.Deadline(0), INTERACTIVE)
+
+    def test_rate_limited_calls_are_retried(self):
+        class RateLimitError(Exception):
+            pass
+
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise RateLimitError("slow down")
+            return 'done'
+        self.assertEqual(call('test', 'key', flaky, providers.Deadline(5)), 'done')
+        self.assertEqual(len(calls), 3)
+
+        def always():
+            raise RateLimitError("slow down")
+        with self.assertRaises(providers.RateLimited):
+            call('test', 'key', always, providers.Deadline(0.01))
+        with self.assertRaises(ValueError):
+            call('test', 'key', lambda: int('x'), providers.Deadline(5))
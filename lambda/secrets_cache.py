@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+import unittest
+import instrumentation
+
+# Secrets are cached for the lifetime of a warm container so paid generations
+# don't pay a Secrets Manager round trip on every invocation.
+ttl_seconds = float(os.environ.get('SECRETS_TTL_SECONDS', 900))
+# Once an entry is this far into its TTL it is refreshed in the background
+# while the cached value keeps being served.
+refresh_ratio = float(os.environ.get('SECRETS_REFRESH_RATIO', 0.8))
+
+_lock = threading.Lock()
+_cache = {}
+_refreshing = set()
+_client = None
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'forced_refreshes': 0,
+    'errors': 0,
+}
+
+def get_client():
+    global _client
+    if _client is None:
+        import boto3
+        _client = boto3.client('secretsmanager')
+    return _client
+
+def fetch_secret(secret_arn):
+    response = get_client().get_secret_value(
+        SecretId=secret_arn,
+    )
+    return json.loads(response['SecretString'])
+
+def _store(secret_arn, value):
+    with _lock:
+        _cache[secret_arn] = (value, time.monotonic())
+
+def _refresh_in_background(secret_arn):
+    def refresh():
+        try:
+            _store(secret_arn, fetch_secret(secret_arn))
+            _increment('refreshes')
+        except Exception as e:
+            # Keep serving the cached value, the next miss retries synchronously
+            print(f"Background secret refresh failed: {e}")
+            _increment('errors')
+        finally:
+            with _lock:
+                _refreshing.discard(secret_arn)
+
+    with _lock:
+        if secret_arn in _refreshing:
+            return
+        _refreshing.add(secret_arn)
+    threading.Thread(target=refresh, daemon=True).start()
+
+def _increment(name):
+    with _lock:
+        _stats[name] += 1
+
+def get_secret(secret_arn, key, force_refresh=False):
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(secret_arn)
+
+    if entry and not force_refresh:
+        value, fetched_at = entry
+        age = now - fetched_at
+        if age < ttl_seconds:
+            _increment('hits')
+            if age >= ttl_seconds * refresh_ratio:
+                _refresh_in_background(secret_arn)
+            return value[key]
+
+    _increment('forced_refreshes' if force_refresh else 'misses')
+    with instrumentation.stage(instrumentation.SECRET_FETCH):
+        value = fetch_secret(secret_arn)
+    _store(secret_arn, value)
+    return value[key]
+
+def invalidate(secret_arn=None):
+    with _lock:
+        if secret_arn is None:
+            _cache.clear()
+        else:
+            _cache.pop(secret_arn, None)
+
+def is_auth_error(error):
+    # Each SDK surfaces auth failures differently: openai sets http_status,
+    # replicate/requests set status/status_code and grpc exposes code().
+    for attr in ('http_status', 'status_code', 'status'):
+        if getattr(error, attr, None) in (401, 403):
+            return True
+    code = getattr(error, 'code', None)
+    if callable(code):
+        try:
+            code_name = getattr(code(), 'name', '')
+        except Exception:
+            code_name = ''
+        if code_name in ('UNAUTHENTICATED', 'PERMISSION_DENIED'):
+            return True
+    # openai.error classes, matched by module so Python's own PermissionError
+    # (an OSError, e.g. from /tmp) is not mistaken for a rejected key
+    error_type = type(error)
+    return (error_type.__module__.split('.')[0] == 'openai'
+            and error_type.__name__ in ('AuthenticationError', 'PermissionError'))
+
+def call_with_secret(secret_arn, key, call):
+    # Run call(api_key). If the provider rejects a cached key it may have been
+    # rotated, so fetch it again and retry once.
+    try:
+        return call(get_secret(secret_arn, key))
+    except Exception as e:
+        if not is_auth_error(e):
+            raise
+        print(f"Auth error with cached secret, refreshing: {e}")
+        return call(get_secret(secret_arn, key, force_refresh=True))
+
+def get_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['cached'] = len(_cache)
+    return stats
+
+class TestSecretsCache(unittest.TestCase):
+    def setUp(self):
+        # Imported here, unittest.mock pulls in asyncio on every cold start otherwise
+        from unittest import mock
+
+        invalidate()
+        self.fetches = 0
+
+        def fake_fetch(secret_arn):
+            self.fetches += 1
+            return {'KEY': f"value-{self.fetches}"}
+
+        self.patcher = mock.patch(__name__ + '.fetch_secret', side_effect=fake_fetch)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_cached_between_calls(self):
+        self.assertEqual(get_secret('arn', 'KEY'), 'value-1')
+        self.assertEqual(get_secret('arn', 'KEY'), 'value-1')
+        self.assertEqual(self.fetches, 1)
+
+    def test_refresh_on_auth_error(self):
+        class AuthenticationError(Exception):
+            pass
+        AuthenticationError.__module__ = 'openai.error'
+
+        seen = []
+        def call(api_key):
+            seen.append(api_key)
+            if len(seen) == 1:
+                raise AuthenticationError()
+            return api_key
+
+        self.assertEqual(call_with_secret('arn', 'KEY', call), 'value-2')
+        self.assertEqual(seen, ['value-1', 'value-2'])
+
+    def test_builtin_permission_error_is_not_auth(self):
+        def call(api_key):
+            raise PermissionError('/tmp/cache')
+
+        with self.assertRaises(PermissionError):
+            call_with_secret('arn', 'KEY', call)
+        self.assertEqual(self.fetches, 1)
@@ -0,0 +1,285 @@
+import json
+import os
+import re
+import threading
+import time
+import unittest
+import zlib
+from io import BytesIO
+
+import numpy as np
+
+# Near-duplicate prompts ("a cute dog", "cute dog") reuse an earlier expansion.
+# Prompts are embedded with hashed word, word pair and character trigram
+# features, and looked up by cosine similarity in an in-memory index that is
+# snapshotted to S3 (or a local file) and loaded lazily by warm containers.
+#
+# The match is lexical, not semantic: rewordings that share most of their
+# words hit, true paraphrases ("a puppy" for "a small dog") miss. The
+# threshold has only been checked against the small sample in
+# scripts/eval_semantic_cache.py, run it on real prompt pairs before relying
+# on the hit rate or lowering it.
+threshold = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.92))
+max_entries = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', 5000))
+save_every = int(os.environ.get('SEMANTIC_CACHE_SAVE_EVERY', 10))
+snapshot_bucket = os.environ.get('SEMANTIC_CACHE_BUCKET')
+snapshot_folder = "semantic-cache"
+snapshot_dir = os.environ.get('SEMANTIC_CACHE_DIR', '/tmp')
+
+dimensions = 1024
+# Rows the index starts with, it doubles up to max_entries as entries arrive
+initial_rows = 64
+# Bump when the features change so old snapshots are discarded
+feature_version = 1
+stop_words = frozenset(['a', 'an', 'the', 'of', 'and', 'with', 'in', 'on', 'at', 'to', 'for', 'some'])
+word_weight = 1.0
+pair_weight = 0.7
+trigram_weight = 0.3
+
+_s3 = None
+
+def get_s3():
+    global _s3
+    if _s3 is None:
+        import boto3
+        _s3 = boto3.client('s3')
+    return _s3
+
+def tokenize(prompt):
+    return [word for word in re.findall(r'[a-z0-9]+', prompt.lower()) if word not in stop_words]
+
+def get_features(prompt):
+    words = tokenize(prompt)
+    features = [(word, word_weight) for word in words]
+    # Word pairs keep "dog chasing cat" apart from "cat chasing dog"
+    features += [(f"{a} {b}", pair_weight) for a, b in zip(words, words[1:])]
+    # Character trigrams soften plurals and spelling differences in longer phrases
+    for word in words:
+        padded = f" {word} "
+        features += [(padded[i:i + 3], trigram_weight) for i in range(len(padded) - 2)]
+    return features
+
+def embed(prompt):
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for feature, weight in get_features(prompt):
+        # crc32 rather than hash() so vectors are stable across processes
+        hashed = zlib.crc32(feature.encode('utf-8'))
+        sign = 1.0 if hashed & 0x80000000 else -1.0
+        vector[hashed % dimensions] += sign * weight
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+class SemanticIndex:
+    def __init__(self, capacity=max_entries):
+        self.capacity = capacity
+        self.vectors = np.zeros((min(capacity, initial_rows), dimensions), dtype=np.float32)
+        self.entries = []
+        self.keys = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _reserve(self, rows):
+        # Called with the lock held
+        if rows <= len(self.vectors):
+            return
+        grown = np.zeros((min(self.capacity, max(rows, 2 * len(self.vectors))), dimensions), dtype=np.float32)
+        grown[:len(self.entries)] = self.vectors[:len(self.entries)]
+        self.vectors = grown
+
+    def search(self, vector):
+        # Returns (score, entry) of the closest entry, or (0.0, None) if empty
+        with self._lock:
+            if not self.entries:
+                return 0.0, None
+            scores = self.vectors[:len(self.entries)] @ vector
+            index = int(np.argmax(scores))
+            return float(scores[index]), self.entries[index]
+
+    def add(self, prompt, result, vector=None):
+        if vector is None:
+            vector = embed(prompt)
+        with self._lock:
+            if prompt in self.keys:
+                return False
+            if len(self.entries) >= self.capacity:
+                # Drop the oldest tenth in one shift instead of one per insert
+                drop = max(1, self.capacity // 10)
+                for entry in self.entries[:drop]:
+                    self.keys.discard(entry['prompt'])
+                self.entries = self.entries[drop:]
+                self.vectors[:len(self.entries)] = self.vectors[drop:drop + len(self.entries)]
+            self._reserve(len(self.entries) + 1)
+            self.vectors[len(self.entries)] = vector
+            self.entries.append({'prompt': prompt, 'result': result})
+            self.keys.add(prompt)
+            return True
+
+    def merge(self, other):
+        with self._lock:
+            self._reserve(len(self.entries) + len(other.entries))
+        for i, entry in enumerate(other.entries):
+            self.add(entry['prompt'], entry['result'], other.vectors[i])
+
+    def to_bytes(self):
+        with self._lock:
+            buffered = BytesIO()
+            # Entries as utf-8 bytes, a numpy str array takes four bytes per character
+            np.savez_compressed(
+                buffered,
+                version=np.array(feature_version),
+                vectors=self.vectors[:len(self.entries)],
+                entries=np.frombuffer(json.dumps(self.entries).encode('utf-8'), dtype=np.uint8),
+            )
+            return buffered.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data, capacity=max_entries):
+        index = cls(capacity)
+        snapshot = np.load(BytesIO(data), allow_pickle=False)
+        # Every lookup of an npz member decompresses it again
+        vectors = snapshot['vectors']
+        if int(snapshot['version']) != feature_version or vectors.shape[1:] != (dimensions,):
+            print("Discarding near-duplicate cache snapshot built with different features")
+            return index
+        entries = snapshot['entries']
+        # Older snapshots stored the entries as a str array
+        entries = json.loads(entries.tobytes().decode('utf-8') if entries.dtype == np.uint8 else str(entries))
+        # Keep the newest entries if the snapshot is larger than this index
+        start = max(0, len(entries) - capacity)
+        with index._lock:
+            index._reserve(len(entries) - start)
+        for i in range(start, len(entries)):
+            index.add(entries[i]['prompt'], entries[i]['result'], vectors[i])
+        return index
+
+class SemanticCache:
+    def __init__(self, namespace, threshold=threshold):
+        self.namespace = namespace
+        self.threshold = threshold
+        self.index = None
+        self.pending = 0
+        self.stats = {'hits': 0, 'misses': 0, 'errors': 0}
+        self._lock = threading.Lock()
+
+    def snapshot_key(self):
+        return f"{snapshot_folder}/{self.namespace}.npz"
+
+    def read_snapshot(self):
+        if snapshot_bucket:
+            try:
+                response = get_s3().get_object(Bucket=snapshot_bucket, Key=self.snapshot_key())
+                return response['Body'].read()
+            except Exception as e:
+                if type(e).__name__ != 'NoSuchKey':
+                    raise
+                return None
+        path = os.path.join(snapshot_dir, self.snapshot_key())
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write_snapshot(self, data):
+        if snapshot_bucket:
+            get_s3().put_object(
+                Bucket=snapshot_bucket,
+                Key=self.snapshot_key(),
+                Body=data,
+                ContentType='application/octet-stream',
+            )
+            return
+        path = os.path.join(snapshot_dir, self.snapshot_key())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def load_index(self):
+        snapshot = None
+        try:
+            snapshot = self.read_snapshot()
+        except Exception as e:
+            print(f"Near-duplicate cache load failed: {e}")
+            self.stats['errors'] += 1
+        return SemanticIndex.from_bytes(snapshot) if snapshot else SemanticIndex()
+
+    def get_index(self):
+        # Loaded on first use so cold starts that never hit the cache skip it
+        with self._lock:
+            if self.index is None:
+                started = time.time()
+                self.index = self.load_index()
+                print(f"Loaded {len(self.index)} near-duplicate cache entries in {time.time() - started:.3f}s")
+            return self.index
+
+    def get(self, prompt):
+        score, entry = self.get_index().search(embed(prompt))
+        if entry is not None and score >= self.threshold:
+            print(f"Near-duplicate cache hit {score:.3f}: {prompt!r} ~ {entry['prompt']!r}")
+            self.stats['hits'] += 1
+            return entry['result']
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, prompt, result):
+        if not self.get_index().add(prompt, result):
+            return
+        self.pending += 1
+        if self.pending >= save_every:
+            self.save()
+
+    def save(self):
+        # Other containers write the same snapshot, merge theirs before replacing it
+        try:
+            with self._lock:
+                remote = self.load_index()
+                remote.merge(self.index)
+                self.index = remote
+                self.pending = 0
+            self.write_snapshot(self.index.to_bytes())
+        except Exception as e:
+            # Best effort, a lost snapshot only costs future hits
+            print(f"Near-duplicate cache save failed: {e}")
+            self.stats['errors'] += 1
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['entries'] = len(self.index) if self.index is not None else 0
+        return stats
+
+class TestSemanticIndex(unittest.TestCase):
+    def test_paraphrase_matches(self):
+        index = SemanticIndex(10)
+        index.add("a cute dog", {'positive': 'dog'})
+        score, entry = index.search(embed("cute dog"))
+        self.assertGreaterEqual(score, threshold)
+        self.assertEqual(entry['result'], {'positive': 'dog'})
+
+    def test_different_idea_misses(self):
+        index = SemanticIndex(10)
+        index.add("a cute dog", {'positive': 'dog'})
+        score, _ = index.search(embed("a castle at night"))
+        self.assertLess(score, threshold)
+
+    def test_snapshot_round_trip_and_eviction(self):
+        index = SemanticIndex(10)
+        for i in range(12):
+            index.add(f"prompt number {i}", {'positive': str(i)})
+        restored = SemanticIndex.from_bytes(index.to_bytes())
+        self.assertEqual(len(restored), len(index))
+        self.assertNotIn("prompt number 0", restored.keys)
+        score, entry = restored.search(embed("prompt number 11"))
+        self.assertEqual(entry['result'], {'positive': '11'})
+
+    def test_index_grows_with_its_entries(self):
+        index = SemanticIndex(1000)
+        self.assertEqual(len(index.vectors), initial_rows)
+        for i in range(200):
+            index.add(f"prompt number {i}", {'positive': str(i)})
+        self.assertLess(len(index.vectors), 1000)
+        _, entry = index.search(embed("prompt number 3"))
+        self.assertEqual(entry['result'], {'positive': '3'})
+        self.assertEqual(len(SemanticIndex.from_bytes(index.to_bytes())), 200)
@@ -1,54 +1,231 @@
 import json
-import openai
+import re
+import threading
+import time
 import unittest
 import os
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+import client_pool
+import instrumentation
+import providers
+import secrets_cache
+from result_cache import ResultCache
 
-secrets = boto3.client('secretsmanager')
 open_ai_key_arn = os.environ.get('OPEN_AI_KEY_ARN')
+completion_engine = "text-davinci-003"
+# The preamble asks for at most 350 characters, roughly 90 tokens. The budget
+# leaves some headroom and the stream is cut off once the target is reached.
+max_tokens = int(os.environ.get('TEXT_TO_TEXT_MAX_TOKENS', 160))
+max_chars = int(os.environ.get('TEXT_TO_TEXT_MAX_CHARS', 350))
+# Batches fan out over threads sharing the pooled OpenAI session, so the cap
+# should stay at or below CLIENT_HTTP_POOL_SIZE
+max_concurrency = int(os.environ.get('TEXT_TO_TEXT_MAX_CONCURRENCY', 4))
+stream_completions = os.environ.get('TEXT_TO_TEXT_STREAM', 'true').lower() == 'true'
+# Per call budget, a hung completion fails fast instead of holding the request
+request_timeout = float(os.environ.get('TEXT_TO_TEXT_TIMEOUT_SECONDS', 10))
+# A batch is answered within the API Gateway timeout, so it can only hold as
+# many prompts as the workers can expand back to back at the per call budget
+max_batch_size = int(os.environ.get(
+    'TEXT_TO_TEXT_MAX_BATCH_SIZE',
+    max_concurrency * max(1, int(providers.sync_deadline_seconds // request_timeout)),
+))
+# Expansions of popular ideas are reused, no shared tier so BUCKET_NAME is unset
+completion_cache = ResultCache(
+    'text-to-text',
+    ttl=int(os.environ.get('TEXT_TO_TEXT_CACHE_TTL_SECONDS', 24 * 3600)),
+    max_bytes=int(os.environ.get('TEXT_TO_TEXT_CACHE_MAX_BYTES', 8 * 1024 * 1024)),
+)
+# Rewordings of earlier ideas are served from the near-duplicate (lexical)
+# index, see semantic_cache
+use_semantic_cache = os.environ.get('SEMANTIC_CACHE_ENABLED', 'true').lower() == 'true'
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
 prompt_helper = ""
-def get_openai_api_key():
-    print("Get stability api key")
-    response = secrets.get_secret_value(
-        SecretId=open_ai_key_arn,
-    )
-    api_key_json = json.loads(response['SecretString'])
-    api_key = api_key_json['OPEN_AI_KEY']
-    return api_key
 
-def handler(event, context):
-    print(event)
+def get_semantic_cache():
+    # numpy is only loaded once a request misses the exact-match cache
+    global _semantic_cache
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            from semantic_cache import SemanticCache
+            _semantic_cache = SemanticCache('text-to-text')
+    return _semantic_cache
 
-    # Check the event object before processing
-    if event and ('body' in event) and 'prompt' in json.loads(event['body']):
-        # Set the API key
-        openai.api_key = get_openai_api_key()
+def normalize_prompt(prompt):
+    # "A cat." and "a  cat" are the same idea
+    return re.sub(r'\s+', ' ', prompt).strip().strip('.!').strip().lower()
 
-        # Define the mock data
-        prompt = json.loads(event['body'])['prompt']
-        
-        prompt = prompt + prompt_helper
+def truncate_prompt(text, limit=max_chars):
+    text = text.strip(" ").strip("\n")
+    if len(text) <= limit:
+        return text
+    text = text[:limit]
+    # Cut at the last complete phrase rather than mid word
+    for separator in (',', ' '):
+        index = text.rfind(separator)
+        if index > limit // 2:
+            return text[:index].strip()
+    return text
+
+def create_completion(api_key, prompt, stream=False):
+    import openai
 
-        # Call the GPT-3 API
-        response = openai.Completion.create(
-            engine="text-davinci-003",
+    return client_pool.call_with_client(
+        'openai',
+        'default',
+        lambda: client_pool.get_openai_session(api_key),
+        lambda session: openai.Completion.create(
+            engine=completion_engine,
             prompt=prompt,
-            max_tokens=2048,
-        )
-        if 'choices' in response and response['choices']:
-            # Return the generated text
-            res_text = response['choices'][0]['text']
-            pos_prompt = res_text.strip(" ").strip("\n")
-            # neg_prompt = res_text[1].strip("Negative Prompt:")
+            max_tokens=max_tokens,
+            api_key=api_key,
+            stream=stream,
+            request_timeout=request_timeout,
+        ),
+    )
+
+def read_stream(chunks, limit=max_chars):
+    # Reads streamed tokens until the character target is reached, then closes
+    # the stream so no further tokens are generated
+    started = time.time()
+    parts = []
+    length = 0
+    try:
+        for chunk in chunks:
+            if not parts:
+                print(f"First token after {time.time() - started:.3f}s")
+            if not chunk.get('choices'):
+                continue
+            text = chunk['choices'][0].get('text', '')
+            parts.append(text)
+            length += len(text)
+            if length > limit:
+                print(f"Stopping completion at {length} characters")
+                break
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+    return ''.join(parts) if parts else None
+
+def complete(api_key, prompt):
+    # Returns the completion text, or None if there was no choice
+    with instrumentation.stage(instrumentation.UPSTREAM):
+        if stream_completions:
+            return read_stream(create_completion(api_key, prompt, stream=True))
+        response = create_completion(api_key, prompt)
+    if 'choices' in response and response['choices']:
+        return response['choices'][0]['text']
+    return None
+
+class ExpansionError(Exception):
+    pass
+
+def expand_prompt(prompt):
+    # Returns {'positive', 'negative'} for one idea, from cache when possible
+    normalized_prompt = normalize_prompt(prompt)
+    cache_key = completion_cache.key({
+        'prompt': normalized_prompt,
+        'engine': completion_engine,
+        'maxTokens': max_tokens,
+        'maxChars': max_chars,
+    })
+    cached = completion_cache.get(cache_key)
+    if cached is not None:
+        print(f"Returning cached expansion, cache stats: {completion_cache.get_stats()}")
+        return cached
+    if use_semantic_cache:
+        semantic_cache = get_semantic_cache()
+        cached = semantic_cache.get(normalized_prompt)
+        print(f"Near-duplicate cache stats: {semantic_cache.get_stats()}")
+        if cached is not None:
+            completion_cache.put(cache_key, cached)
+            return cached
+
+    prompt = prompt + prompt_helper
+
+    # Call the GPT-3 API
+    res_text = secrets_cache.call_with_secret(
+        open_ai_key_arn,
+        'OPEN_AI_KEY',
+        lambda api_key: complete(api_key, prompt),
+    )
+    print(f"Secrets cache stats: {secrets_cache.get_stats()}")
+    if not res_text:
+        raise ExpansionError('Error generating response')
+    # Return the generated text
+    pos_prompt = truncate_prompt(res_text)
+    # neg_prompt = res_text[1].strip("Negative Prompt:")
+    result = {'positive': pos_prompt, 'negative': ''}
+    completion_cache.put(cache_key, result)
+    if use_semantic_cache:
+        get_semantic_cache().put(normalized_prompt, result)
+    return result
+
+def expand_or_error(prompt):
+    try:
+        return expand_prompt(prompt)
+    except ExpansionError as e:
+        return {'error': str(e)}
+    except Exception as e:
+        # One failed item must not fail the rest of the batch
+        print(f"Prompt expansion failed: {e}")
+        return {'error': str(e) or type(e).__name__}
+
+def expand_batch(prompts, deadline=None):
+    # Results come back in request order, each item is either an expansion or
+    # {'error': ...}. The thread count is the only limit on concurrent OpenAI
+    # calls from this container, keep it under the account rate limit.
+    deadline = deadline or providers.Deadline(providers.sync_deadline_seconds)
+
+    def expand_in_time(prompt):
+        # Items still queued when a call could no longer finish are failed
+        # rather than letting the whole response miss the gateway timeout
+        if deadline.remaining() < request_timeout:
+            return {'error': 'Deadline exceeded'}
+        return expand_or_error(prompt)
+
+    workers = min(len(prompts), max_concurrency)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(expand_in_time, prompts))
+
+@instrumentation.instrument
+def handler(event, context):
+    instrumentation.log_event(event)
+    body = json.loads(event['body']) if event and event.get('body') else {}
+
+    prompts = body.get('prompts')
+    if prompts is not None:
+        if (
+            not isinstance(prompts, list)
+            or not prompts
+            or len(prompts) > max_batch_size
+            or not all(isinstance(p, str) and p for p in prompts)
+        ):
             return {
-                'statusCode': 200,
-                'body': json.dumps({'positive': pos_prompt, 'negative': ''})
+                'statusCode': 400,
+                'body': json.dumps({'error': f'prompts must be a list of 1 to {max_batch_size} prompts'})
             }
-        else:
+        results = expand_batch(prompts)
+        print(f"Expanded {len(prompts)} prompts, {sum('error' in r for r in results)} failed")
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'results': results})
+        }
+
+    # Check the event object before processing
+    if 'prompt' in body:
+        try:
+            result = expand_prompt(body['prompt'])
+        except ExpansionError as e:
             return {
                 'statusCode': 500,
-                'body': json.dumps({'error': 'Error generating response'})
+                'body': json.dumps({'error': str(e)})
             }
+        return {
+            'statusCode': 200,
+            'body': json.dumps(result)
+        }
     else:
         return {
                 'statusCode': 400,
@@ -70,12 +247,35 @@ class TestGPT3APIHandler(unittest.TestCase):
         
     def test_error_response(self):
         # Set the api_key to an invalid key to force an error response
+        import openai
         openai.api_key = "invalid_key"
         event = {'body': json.dumps({'prompt': 'What is the meaning of life?'})}
         response = handler(event, None)
         self.assertEqual(response['statusCode'], 500)
         self.assertEqual(json.loads(response['body'])['error'], 'Error generating response')
 
+class TestPromptExpansion(unittest.TestCase):
+    def test_equivalent_prompts_normalize_alike(self):
+        self.assertEqual(normalize_prompt("  A   Cat. "), normalize_prompt("a cat"))
+
+    def test_long_text_is_cut_at_a_phrase(self):
+        text = "a cat, " * 60
+        truncated = truncate_prompt(text)
+        self.assertLessEqual(len(truncated), max_chars)
+        self.assertTrue(truncated.endswith("a cat"))
+
+    def test_batch_fits_the_deadline(self):
+        self.assertLessEqual(
+            max_batch_size / max_concurrency * request_timeout,
+            providers.sync_deadline_seconds,
+        )
+        results = expand_batch(['a cat', 'a dog'], providers.Deadline(request_timeout / 2))
+        self.assertEqual(results, [{'error': 'Deadline exceeded'}] * 2)
+
+    def test_stream_stops_at_character_target(self):
+        chunks = ({'choices': [{'text': 'word '}]} for _ in range(1000))
+        self.assertLessEqual(len(read_stream(chunks, limit=50)), 55)
+
 
 prompt_helper ="""
 use this information to learn about Stable diffusion Prompting, and use it to create prompts.
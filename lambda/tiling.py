@@ -0,0 +1,190 @@
+import os
+import struct
+import unittest
+import zlib
+from collections import deque
+from io import BytesIO
+import numpy as np
+import instrumentation
+
+# Tiled image to image for canvases above the provider's pixel budget. The
+# canvas is split into overlapping tiles that are generated concurrently and
+# blended back with linear feathering across each seam. The feather weights
+# of neighbouring tiles sum to one, so tiles are added straight into a float
+# band one tile row high, and rows no later tile touches are written out to a
+# streaming PNG encoder. Only that band and the tiles in flight are held,
+# never the whole grid.
+tile_size = int(os.environ.get('TILE_SIZE', 768))
+# Width of the feathered seam, at most a quarter of the tile
+tile_overlap = int(os.environ.get('TILE_OVERLAP', 128))
+tile_concurrency = int(os.environ.get('TILE_CONCURRENCY', 4))
+max_pixels = int(os.environ.get('TILED_MAX_PIXELS', 2048 * 2048))
+
+def plan_axis(length, tile, overlap):
+    # Returns (tile length, start positions, feather weights per tile) for one
+    # axis. Tiles are spread evenly so every seam gets at least `overlap`.
+    tile = min(tile, length)
+    count = 1
+    if length > tile:
+        count = -(-(length - overlap) // (tile - overlap))
+    starts = [round(i * (length - tile) / float(count - 1)) if count > 1 else 0 for i in range(count)]
+    weights = []
+    for i, start in enumerate(starts):
+        positions = np.arange(start, start + tile, dtype=np.float32) + 0.5
+        weight = np.ones(tile, dtype=np.float32)
+        if i > 0:
+            # Ramp up across the middle of the overlap with the previous tile
+            center = (start + starts[i - 1] + tile) / 2.0
+            width = min(overlap, starts[i - 1] + tile - start)
+            weight *= np.clip((positions - (center - width / 2.0)) / width, 0, 1)
+        if i < count - 1:
+            center = (starts[i + 1] + start + tile) / 2.0
+            width = min(overlap, start + tile - starts[i + 1])
+            weight *= np.clip(((center + width / 2.0) - positions) / width, 0, 1)
+        weights.append(weight)
+    return tile, starts, weights
+
+class TilePlan:
+    def __init__(self, width, height, tile=tile_size, overlap=tile_overlap):
+        if not 0 < overlap <= tile // 4:
+            raise ValueError("Tile overlap must be between 1 and a quarter of the tile size")
+        self.width = width
+        self.height = height
+        self.tile_width, self.xs, self.x_weights = plan_axis(width, tile, overlap)
+        self.tile_height, self.ys, self.y_weights = plan_axis(height, tile, overlap)
+
+    def boxes(self):
+        # (row, column, (left, top, right, bottom)) in row-major order
+        for row, y in enumerate(self.ys):
+            for column, x in enumerate(self.xs):
+                yield row, column, (x, y, x + self.tile_width, y + self.tile_height)
+
+    def __len__(self):
+        return len(self.xs) * len(self.ys)
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+class PngWriter:
+    # RGB PNG encoded a band of rows at a time
+    def __init__(self, width, height):
+        self.width = width
+        self.compressor = zlib.compressobj(6)
+        self.chunks = [
+            b'\x89PNG\r\n\x1a\n',
+            png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        ]
+
+    def write(self, rows):
+        # Sub filter, each byte minus the same channel of the pixel to its left
+        rows = rows.reshape(len(rows), self.width * 3)
+        filtered = np.empty((len(rows), 1 + self.width * 3), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:4] = rows[:, :3]
+        np.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.chunks.append(png_chunk(b'IDAT', data))
+
+    def finish(self):
+        self.chunks.append(png_chunk(b'IDAT', self.compressor.flush()))
+        self.chunks.append(png_chunk(b'IEND', b''))
+        return b''.join(self.chunks)
+
+def map_ordered(executor, fn, items, window):
+    # Like executor.map, but only `window` calls are submitted ahead of the
+    # result being consumed, so finished tiles don't pile up in memory
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def decode_tile(data, size):
+    from PIL import Image
+
+    tile = Image.open(BytesIO(data)).convert('RGB')
+    if tile.size != size:
+        tile = tile.resize(size, Image.LANCZOS)
+    return np.asarray(tile, dtype=np.float32)
+
+def blend(plan, tiles):
+    # tiles yields (row, column, tile png bytes) in row-major order, returns
+    # the blended canvas as PNG bytes
+    writer = PngWriter(plan.width, plan.height)
+    band = np.zeros((0, plan.width, 3), dtype=np.float32)
+    band_top = 0
+    current_row = None
+
+    def emit(rows):
+        writer.write(np.clip(rows + 0.5, 0, 255).astype(np.uint8))
+
+    for row, column, data in tiles:
+        if row != current_row:
+            # Rows above the new tile row are final
+            top = plan.ys[row]
+            if top > band_top:
+                emit(band[:top - band_top])
+            carried = band[top - band_top:]
+            band = np.zeros((plan.tile_height, plan.width, 3), dtype=np.float32)
+            band[:len(carried)] = carried
+            band_top = top
+            current_row = row
+        with instrumentation.stage(instrumentation.DECODE):
+            tile = decode_tile(data, (plan.tile_width, plan.tile_height))
+        weight = plan.y_weights[row][:, None] * plan.x_weights[column][None, :]
+        x = plan.xs[column]
+        band[:, x:x + plan.tile_width] += tile * weight[:, :, None]
+    emit(band[:plan.height - band_top])
+    return writer.finish()
+
+def generate_tiled(image, plan, generate_tile, executor, concurrency=tile_concurrency):
+    # generate_tile(pil tile) returns png bytes or None when the tile was
+    # filtered. Returns the PNG of the full canvas, or None if any tile was.
+    def run(box):
+        row, column, bounds = box
+        return row, column, generate_tile(image.crop(bounds))
+
+    filtered = []
+
+    def results():
+        for row, column, data in map_ordered(executor, run, plan.boxes(), concurrency * 2):
+            if data is None:
+                filtered.append((row, column))
+                return
+            yield row, column, data
+
+    png = blend(plan, results())
+    return None if filtered else png
+
+class TestTiling(unittest.TestCase):
+    def test_weights_sum_to_one(self):
+        for length in (512, 800, 1536, 2048, 2112):
+            tile, starts, weights = plan_axis(length, 768, 128)
+            total = np.zeros(length, dtype=np.float32)
+            for start, weight in zip(starts, weights):
+                self.assertEqual(len(weight), tile)
+                total[start:start + tile] += weight
+            np.testing.assert_allclose(total, 1, atol=1e-5)
+
+    def test_blended_tiles_reproduce_canvas(self):
+        from PIL import Image
+        from concurrent.futures import ThreadPoolExecutor
+
+        height, width = 1280, 1856
+        gradient = np.add.outer(np.arange(height) % 256, np.arange(width) % 256) % 256
+        canvas = Image.fromarray(np.stack([gradient] * 3, axis=-1).astype(np.uint8))
+        plan = TilePlan(width, height, 512, 64)
+        self.assertGreater(len(plan), 4)
+
+        def identity(tile):
+            buffered = BytesIO()
+            tile.save(buffered, format='PNG')
+            return buffered.getvalue()
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            png = generate_tiled(canvas, plan, identity, executor, 3)
+        result = np.asarray(Image.open(BytesIO(png)))
+        np.testing.assert_array_equal(result, np.asarray(canvas))
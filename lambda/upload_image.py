@@ -1,35 +1,130 @@
 import os
 import boto3
 import json
-from datetime import datetime
-import uuid
 import base64
+import hashlib
+import tempfile
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from io import BytesIO
+import binary_io
+import image_normalize
+import instrumentation
 
 bucket_name = os.environ.get('BUCKET_NAME')
-s3 = boto3.resource('s3')
+s3 = boto3.client('s3')
 input_bucket_folder = "inputs"
+# Bumped whenever stored uploads change shape, so canvases stored by an older
+# version (1MP, flattened) are normalized again instead of reused
+stored_format_version = 2
+# Canvases above this size are sent as a multipart upload
+multipart_threshold = int(os.environ.get('MULTIPART_THRESHOLD_BYTES', 8 * 1024 * 1024))
+# Decoded bytes are buffered in memory up to this size, then spill to /tmp
+spool_max_size = int(os.environ.get('UPLOAD_SPOOL_MAX_BYTES', 4 * 1024 * 1024))
+decode_chunk_size = 1024 * 1024  # Multiple of 4 so chunks decode independently
+transfer_config = TransferConfig(multipart_threshold=multipart_threshold)
 
-def uploadImageToS3(input_location, img_data):
-    print(f"Uploading image to S3 location {input_location}")
-    s3object = s3.Object(bucket_name, input_location)
-    s3object.put(Body=base64.b64decode(img_data), Key=input_location)
-    # Get object url
+def decode_to_file(img_data):
+    # Decode the base64 body in chunks while hashing it instead of holding a
+    # second full copy of the canvas in memory
+    digest = hashlib.sha256()
+    decoded = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+    if any(c in img_data for c in '\r\n '):
+        img_data = ''.join(img_data.split())
+    for start in range(0, len(img_data), decode_chunk_size):
+        chunk = base64.b64decode(img_data[start:start + decode_chunk_size])
+        digest.update(chunk)
+        decoded.write(chunk)
+    decoded.seek(0)
+    return decoded, digest.hexdigest()
+
+def object_exists(key):
+    try:
+        s3.head_object(Bucket=bucket_name, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def uploadImageToS3(img_data):
+    # Returns (key, public url)
+    with instrumentation.stage(instrumentation.DECODE):
+        decoded, digest = decode_to_file(img_data)
+    return storeUpload(decoded, digest)
+
+def uploadRawImageToS3(img_bytes):
+    # Binary mode, the bytes are wrapped without another copy
+    return storeUpload(BytesIO(img_bytes), hashlib.sha256(img_bytes).hexdigest())
+
+def storeUpload(decoded, digest):
+    # Content addressed by the original bytes, so the same canvas is only ever
+    # normalized and stored once
+    input_location = f"{input_bucket_folder}/{digest}.v{stored_format_version}.png"
     object_url = f"https://{bucket_name}.s3.amazonaws.com/{input_location}"
-    object_acl = s3.ObjectAcl(bucket_name, input_location)
-    response = object_acl.put(ACL='public-read')
-    print(response)
-    return object_url
+    with decoded:
+        if object_exists(input_location):
+            print(f"Image already uploaded to S3 location {input_location}")
+            return input_location, object_url
+
+        # Normalize once at upload time, every later request reuses the stored result.
+        # Uploads are kept at the tiled budget and with their alpha channel, so
+        # tiled and maskSource alpha requests can use them; each request then
+        # applies its own budget and flattens as needed.
+        # PIL is only loaded for canvases that are not already stored.
+        from PIL import Image, UnidentifiedImageError
+        import tiling
+        try:
+            image = Image.open(decoded)
+        except UnidentifiedImageError:
+            raise ValueError('image is not a supported image format')
+        if image_normalize.is_normalized(image, tiling.max_pixels, keep_alpha=True):
+            decoded.seek(0)
+            upload = decoded
+        else:
+            with instrumentation.stage(instrumentation.NORMALIZE):
+                normalized_bytes, size = image_normalize.encode_normalized(image, tiling.max_pixels, keep_alpha=True)
+            print(f"Normalized {image.width}x{image.height} upload to {size[0]}x{size[1]}")
+            upload = BytesIO(normalized_bytes)
+
+        print(f"Uploading image to S3 location {input_location}")
+        # ACL and content type are set in the same request as the upload
+        with instrumentation.stage(instrumentation.UPLOAD):
+            s3.upload_fileobj(
+                upload,
+                bucket_name,
+                input_location,
+                ExtraArgs={'ACL': 'public-read', 'ContentType': 'image/png'},
+                Config=transfer_config,
+            )
+    return input_location, object_url
 
+@instrumentation.instrument
 def handler(event, context):
-    body = json.loads(event["body"])
+    try:
+        if binary_io.is_binary(event):
+            body = binary_io.load_body(event)
+        else:
+            body = json.loads(event.get("body") or '')
 
-    # Get params
-    init_img = body['image']
+        # Get params
+        init_img = body.get('image') if isinstance(body, dict) else None
+        if not init_img:
+            raise ValueError('image is required')
 
-    input_file_name = f"{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}-{uuid.uuid4()}.png"
-    s3_input_location = f"{input_bucket_folder}/{input_file_name}"
-    # s3_img_url = f"s3://{bucket_name}/{input_bucket_folder}/{input_file_name}"
-    download_url = uploadImageToS3(s3_input_location, init_img)
+        if binary_io.is_binary(event):
+            key, download_url = uploadRawImageToS3(init_img)
+        elif isinstance(init_img, str):
+            key, download_url = uploadImageToS3(init_img)
+        else:
+            raise ValueError('image must be a base64 string')
+    except ValueError as e:
+        # Malformed bodies, bad base64 and undecodable images
+        return {
+            "statusCode": 400,
+            'headers': { 'Content-Type': 'application/json' },
+            "body": json.dumps({'error': str(e)}),
+        }
 
     # Send response
     response = {
@@ -37,7 +132,7 @@ def handler(event, context):
         "headers": {
             "Content-Type": "application/json"
         },
-        "body":  json.dumps({'url': download_url}),
+        "body":  json.dumps({'url': download_url, 'key': key}),
     }
 
-    return response
\ No newline at end of file
+    return response
@@ -1,12 +1,14 @@
-import { Duration, Stack, StackProps } from "aws-cdk-lib";
+import { existsSync } from "fs";
+import { ArnFormat, Duration, Stack, StackProps } from "aws-cdk-lib";
 import { LambdaIntegration, RestApi } from "aws-cdk-lib/aws-apigateway";
-import { AttributeType, Table } from "aws-cdk-lib/aws-dynamodb";
+import { AttributeType, BillingMode, Table } from "aws-cdk-lib/aws-dynamodb";
+import { PolicyStatement } from "aws-cdk-lib/aws-iam";
 import { Code, Function, LayerVersion, Runtime } from "aws-cdk-lib/aws-lambda";
 import { Bucket } from "aws-cdk-lib/aws-s3";
-import { BucketDeployment, Source } from "aws-cdk-lib/aws-s3-deployment";
+import { BucketDeployment, CacheControl, Source } from "aws-cdk-lib/aws-s3-deployment";
 import { ISecret, Secret } from "aws-cdk-lib/aws-secretsmanager";
 import { Construct } from "constructs";
-import { APP_NAME, OPEN_AI_SECRET_ARN, REPLICATE_KEY_ARN, STABILITY_SECRET_ARN } from './constants';
+import { APP_NAME, JOB_INPUT_EXPIRATION_DAYS, OPEN_AI_SECRET_ARN, REPLICATE_KEY_ARN, RESULT_CACHE_EXPIRATION_DAYS, RESULT_EXPIRATION_DAYS, STABILITY_SECRET_ARN } from './constants';
 import { PipelineStages } from "./stage";
 
 export interface AsycnStackProps extends StackProps {
@@ -21,11 +23,17 @@ export class AsynStack extends Stack {
     readonly imageBucket: Bucket
     readonly styleImageBucket: Bucket
     readonly styleImageBucketDeployment: BucketDeployment
+    readonly styleThumbnailBucketDeployment: BucketDeployment
     // readonly promptTable: Table
     // readonly promptStylesTable: Table
+    readonly jobTable: Table
+    readonly rateLimitTable: Table
 
     // Lambda
-    readonly lambdaDependencyLayer: LayerVersion
+    readonly imagingLayer: LayerVersion
+    readonly stabilityLayer: LayerVersion
+    readonly replicateLayer: LayerVersion
+    readonly openAiLayer: LayerVersion
     readonly generateImageLambda: Function
     readonly controlNetLambda: Function
     readonly textToTextLambda: Function
@@ -33,6 +41,7 @@ export class AsynStack extends Stack {
     readonly uploadImageLambda: Function
     // readonly feedbackLambda: Function
     readonly promptStylesLambda: Function
+    readonly jobStatusLambda: Function
 
     // Misc
     // readonly firebaseSecret: ISecret
@@ -55,11 +64,17 @@ export class AsynStack extends Stack {
         this.imageBucket = this.createImageBucket()
         this.styleImageBucket = this.createStyleImageBucket()
         this.styleImageBucketDeployment = this.createStyleImageBucketDeployment()
+        this.styleThumbnailBucketDeployment = this.createStyleThumbnailBucketDeployment()
         // this.promptTable = this.createPromptTable()
         // this.promptStylesTable = this.createPromptStylesTable()
+        this.jobTable = this.createJobTable()
+        this.rateLimitTable = this.createRateLimitTable()
 
         // Lambdas
-        this.lambdaDependencyLayer = this.createLambdaDependencyLayer()
+        this.imagingLayer = this.createLambdaLayer('imaging')
+        this.stabilityLayer = this.createLambdaLayer('stability')
+        this.replicateLayer = this.createLambdaLayer('replicate')
+        this.openAiLayer = this.createLambdaLayer('openai')
         this.generateImageLambda = this.createGenerateImageLambda()
         this.controlNetLambda = this.createControlNetLambda()
         this.textToTextLambda = this.createTextToTextLambda()
@@ -67,6 +82,7 @@ export class AsynStack extends Stack {
         // this.feedbackLambda = this.createFeedbackLambda()
         this.uploadImageLambda = this.createUploadImageLambda()
         this.promptStylesLambda = this.createPromptStylesLambda()
+        this.jobStatusLambda = this.createJobStatusLambda()
 
         // Api
         this.api = this.createApi(props.stage)
@@ -74,13 +90,41 @@ export class AsynStack extends Stack {
         // Add permissions. Needs to be after Lambdas.
         // this.userTable.grantReadWriteData(this.userLambda)
         this.stabilitySecret.grantRead(this.generateImageLambda)
+        this.replicateSecret.grantRead(this.generateImageLambda)
         this.openAiSecret.grantRead(this.textToTextLambda)
+        this.imageBucket.grantReadWrite(this.textToTextLambda, 'semantic-cache/*')
         this.replicateSecret.grantRead(this.controlNetLambda)
 
         this.imageBucket.grantPutAcl(this.uploadImageLambda)
         this.imageBucket.grantReadWrite(this.uploadImageLambda)
-        this.imageBucket.grantRead(this.controlNetLambda)
+        this.imageBucket.grantReadWrite(this.controlNetLambda)
+        this.imageBucket.grantReadWrite(this.generateImageLambda)
         // this.promptStylesTable.grantReadData(this.promptStylesLambda)
+        this.jobTable.grantReadWriteData(this.generateImageLambda)
+        this.jobTable.grantReadWriteData(this.controlNetLambda)
+        this.jobTable.grantReadWriteData(this.jobStatusLambda)
+        this.rateLimitTable.grantReadWriteData(this.generateImageLambda)
+        this.rateLimitTable.grantReadWriteData(this.controlNetLambda)
+        this.replicateSecret.grantRead(this.jobStatusLambda)
+        this.imageBucket.grantRead(this.jobStatusLambda)
+        this.grantSelfInvoke(this.generateImageLambda)
+    }
+
+    // Async jobs re-invoke the same function. The arn is built from the name
+    // (function ids double as names in this stack) because referencing the
+    // function's own arn would be a circular dependency.
+    grantSelfInvoke(lambda: Function) {
+        lambda.addToRolePolicy(new PolicyStatement({
+            actions: ['lambda:InvokeFunction'],
+            resources: [
+                this.formatArn({
+                    service: 'lambda',
+                    resource: 'function',
+                    resourceName: lambda.node.id,
+                    arnFormat: ArnFormat.COLON_RESOURCE_NAME,
+                }),
+            ],
+        }))
     }
 
     getSecret(id: string, arn: string) {
@@ -90,18 +134,44 @@ export class AsynStack extends Stack {
         return secret
     }
 
-    createLambdaDependencyLayer() {
-        return new LayerVersion(this, 'dependency-layer', {
+    // Each function only gets the layers for the SDKs it calls, see
+    // lambda/layers/<name>/requirements.txt
+    createLambdaLayer(name: string) {
+        return new LayerVersion(this, `${name}-layer`, {
             compatibleRuntimes: [
                 Runtime.PYTHON_3_7
             ],
-            code: Code.fromAsset('./lambda/layer'),
+            code: Code.fromAsset(`./lambda/layers/${name}`),
+        })
+    }
+
+    // Handler code only, the layer directories are shipped as layers
+    getLambdaCode() {
+        return Code.fromAsset('./lambda/', {
+            exclude: ['layer', 'layers', '**/__pycache__', '**/.DS_Store'],
         })
     }
 
     createImageBucket(){
         return new Bucket(this, `${APP_NAME}${this.stage}ImageBucket`, {
             bucketName: `${APP_NAME.toLowerCase()}-${this.stage.toLowerCase()}-image-bucket`,
+            lifecycleRules: [
+                {
+                    // Generated results are fetched once through presigned urls
+                    prefix: 'results/',
+                    expiration: Duration.days(RESULT_EXPIRATION_DAYS),
+                },
+                {
+                    // Result cache entries also carry their own shorter ttl
+                    prefix: 'cache/',
+                    expiration: Duration.days(RESULT_CACHE_EXPIRATION_DAYS),
+                },
+                {
+                    // Only needed until the job has run
+                    prefix: 'jobs/inputs/',
+                    expiration: Duration.days(JOB_INPUT_EXPIRATION_DAYS),
+                },
+            ],
         })
     }
 
@@ -139,20 +209,52 @@ export class AsynStack extends Stack {
         return table
     }
 
+    createJobTable() {
+        const name = `${APP_NAME}${this.stage}JobTable`
+        const table = new Table(this, name, {
+            tableName: name,
+            partitionKey: { name: 'jobId', type: AttributeType.STRING },
+            billingMode: BillingMode.PAY_PER_REQUEST,
+            timeToLiveAttribute: 'expiresAt',
+        });
+        return table
+    }
+
+    // Token buckets per provider and API key, shared by every container
+    createRateLimitTable() {
+        const name = `${APP_NAME}${this.stage}RateLimitTable`
+        const table = new Table(this, name, {
+            tableName: name,
+            partitionKey: { name: 'bucketKey', type: AttributeType.STRING },
+            billingMode: BillingMode.PAY_PER_REQUEST,
+            timeToLiveAttribute: 'expiresAt',
+        });
+        return table
+    }
+
     createGenerateImageLambda() {
         const name = `${APP_NAME}${this.stage}GenerateImageLambda`
         return new Function(this, name, {
             functionName: name,
-            code: Code.fromAsset('./lambda/'),
+            code: this.getLambdaCode(),
             runtime: Runtime.PYTHON_3_7,
             handler: "generate_image.handler",
             timeout: Duration.seconds(900),
+            // Tiled generation blends canvases of up to TILED_MAX_PIXELS in memory
+            memorySize: 1024,
             layers: [
-                this.lambdaDependencyLayer, 
+                this.imagingLayer,
+                this.stabilityLayer,
+                // Stable Diffusion on Replicate is the fallback for slow Stability requests
+                this.replicateLayer,
             ],
             environment: {
                 STABILITY_HOST: 'grpc.stability.ai:443',
                 STABILITY_KEY_ARN: this.stabilitySecret.secretFullArn?.toString() || STABILITY_SECRET_ARN,
+                REPLICATE_KEY_ARN: this.replicateSecret.secretFullArn?.toString() || REPLICATE_KEY_ARN,
+                BUCKET_NAME: this.imageBucket.bucketName,
+                JOB_TABLE_NAME: this.jobTable.tableName,
+                RATE_LIMIT_TABLE_NAME: this.rateLimitTable.tableName,
             }
         })
     }
@@ -161,15 +263,19 @@ export class AsynStack extends Stack {
         const name = `${APP_NAME}${this.stage}ControlNetLambda`
         return new Function(this, name, {
             functionName: name,
-            code: Code.fromAsset('./lambda/'),
+            code: this.getLambdaCode(),
             runtime: Runtime.PYTHON_3_7,
             handler: "controlnet.handler",
             timeout: Duration.seconds(900),
             layers: [
-                this.lambdaDependencyLayer, 
+                this.imagingLayer,
+                this.replicateLayer,
             ],
             environment: {
                 REPLICATE_KEY_ARN: this.replicateSecret.secretFullArn?.toString() || REPLICATE_KEY_ARN,
+                BUCKET_NAME: this.imageBucket.bucketName,
+                JOB_TABLE_NAME: this.jobTable.tableName,
+                RATE_LIMIT_TABLE_NAME: this.rateLimitTable.tableName,
             }
         })
     }
@@ -178,15 +284,16 @@ export class AsynStack extends Stack {
         const name = `${APP_NAME}${this.stage}TextToTextLambda`
         return new Function(this, name, {
             functionName: name,
-            code: Code.fromAsset('./lambda/'),
+            code: this.getLambdaCode(),
             runtime: Runtime.PYTHON_3_7,
             handler: "text_to_text.handler",
             timeout: Duration.seconds(900),
             layers: [
-                this.lambdaDependencyLayer, 
+                this.openAiLayer,
             ],
             environment: {
                 OPEN_AI_KEY_ARN: this.openAiSecret.secretFullArn?.toString() || OPEN_AI_SECRET_ARN,
+                SEMANTIC_CACHE_BUCKET: this.imageBucket.bucketName,
             }
         })
     }
@@ -195,12 +302,12 @@ export class AsynStack extends Stack {
         const name = `${APP_NAME}${this.stage}UploadImageLambda`
         return new Function(this, name, {
             functionName: name,
-            code: Code.fromAsset('./lambda/'),
+            code: this.getLambdaCode(),
             runtime: Runtime.PYTHON_3_7,
             handler: "upload_image.handler",
             timeout: Duration.seconds(900),
             layers: [
-                this.lambdaDependencyLayer, 
+                this.imagingLayer,
             ],
             environment: {
                 BUCKET_NAME: this.imageBucket.bucketName,
@@ -212,6 +319,30 @@ export class AsynStack extends Stack {
         return new BucketDeployment(this, `${APP_NAME}${this.stage}StyleImageBucketDeployment`, {
             sources: [Source.asset('./resources/style_images')],
             destinationBucket: this.styleImageBucket,
+            // The thumbnail deployment writes thumbnails/ into the same bucket, a
+            // pruning sync of the style images would delete them
+            exclude: ['thumbnails/*'],
+        })
+    }
+
+    createStyleThumbnailBucketDeployment() {
+        // Built by scripts/build_style_thumbnails.py, see README
+        const thumbnailPath = './resources/style_thumbnails'
+        if (!existsSync(thumbnailPath)) {
+            // The manifest in lambda/ points at these keys, deploying without them breaks every thumbnail URL
+            throw new Error(`${thumbnailPath} is missing, run npm run build:styles before deploying`)
+        }
+        return new BucketDeployment(this, `${APP_NAME}${this.stage}StyleThumbnailBucketDeployment`, {
+            sources: [Source.asset(thumbnailPath)],
+            destinationBucket: this.styleImageBucket,
+            // Keys are content hashed, so a changed thumbnail is always a new object
+            cacheControl: [
+                CacheControl.setPublic(),
+                CacheControl.maxAge(Duration.days(365)),
+                CacheControl.fromString('immutable'),
+            ],
+            // Keep the previous variants for clients still holding an older manifest
+            prune: false,
         })
     }
 
@@ -219,15 +350,31 @@ export class AsynStack extends Stack {
         const name = `${APP_NAME}${this.stage}PromptStylesLambda`
         return new Function(this, name, {
             functionName: name,
-            code: Code.fromAsset('./lambda/'),
+            code: this.getLambdaCode(),
             runtime: Runtime.PYTHON_3_7,
             handler: "prompt_styles.handler",
             timeout: Duration.seconds(15),
+            environment: {
+                BUCKET_NAME: this.styleImageBucket.bucketName,
+            }
+        })
+    }
+
+    createJobStatusLambda() {
+        const name = `${APP_NAME}${this.stage}JobStatusLambda`
+        return new Function(this, name, {
+            functionName: name,
+            code: this.getLambdaCode(),
+            runtime: Runtime.PYTHON_3_7,
+            handler: "job_status.handler",
+            timeout: Duration.seconds(30),
             layers: [
-                this.lambdaDependencyLayer, 
+                this.replicateLayer,
             ],
             environment: {
-                BUCKET_NAME: this.styleImageBucket.bucketName,
+                BUCKET_NAME: this.imageBucket.bucketName,
+                JOB_TABLE_NAME: this.jobTable.tableName,
+                REPLICATE_KEY_ARN: this.replicateSecret.secretFullArn?.toString() || REPLICATE_KEY_ARN,
             }
         })
     }
@@ -235,6 +382,17 @@ export class AsynStack extends Stack {
     createApi(stage: PipelineStages){
         const api = new RestApi(this, `${APP_NAME}${this.stage}API`, {
             description: 'API for Ai Pencil',
+            // Let API Gateway gzip larger JSON responses such as the prompt styles
+            minimumCompressionSize: 1024,
+            // Raw image and multipart requests, and image responses for Accept: image/*.
+            // Keep in sync with lambda/binary_io.py
+            binaryMediaTypes: [
+                'image/png',
+                'image/jpeg',
+                'image/webp',
+                'application/octet-stream',
+                'multipart/form-data',
+            ],
             deployOptions: {
                 stageName: stage.toString().toLowerCase(),
             },
@@ -244,6 +402,8 @@ export class AsynStack extends Stack {
                     'X-Amz-Date',
                     'Authorization',
                     'X-Api-Key',
+                    'If-None-Match',
+                    'X-Params',
                 ],
                 allowMethods: ['POST', 'GET'],
                 allowCredentials: true,
@@ -258,6 +418,8 @@ export class AsynStack extends Stack {
         const textToTextEndpoint = api.root.addResource('text-to-text');
         const uploadImageEndpoint = api.root.addResource('upload-image');
         const promptStylesEndpoint = api.root.addResource('prompt-styles');
+        const jobEndpoint = api.root.addResource('jobs').addResource('{jobId}');
+        const jobWebhookEndpoint = jobEndpoint.addResource('webhook');
         // const feedbackEndpoint = inferenceApi.root.addResource('feedback');
 
         // userEndpoint.addMethod('POST', new LambdaIntegration(this.userLambda));
@@ -268,6 +430,8 @@ export class AsynStack extends Stack {
         uploadImageEndpoint.addMethod('POST', new LambdaIntegration(this.uploadImageLambda));
         // feedbackEndpoint.addMethod('POST', new LambdaIntegration(this.feedbackLambda));
         promptStylesEndpoint.addMethod('GET', new LambdaIntegration(this.promptStylesLambda));
+        jobEndpoint.addMethod('GET', new LambdaIntegration(this.jobStatusLambda));
+        jobWebhookEndpoint.addMethod('POST', new LambdaIntegration(this.jobStatusLambda));
         return api
     }
 }
\ No newline at end of file
@@ -4,4 +4,13 @@ export const FIREBASE_SECRET_ARN = "arn:aws:secretsmanager:us-east-1:15839196797
 export const STABILITY_SECRET_ARN = "arn:aws:secretsmanager:us-east-1:158391967973:secret:STABILITY_KEY-ATcQZJ"
 export const OPEN_AI_SECRET_ARN = "arn:aws:secretsmanager:us-east-1:158391967973:secret:OPEN_AI_KEY-IaGbo4"
 export const SD_API_SECRET_ARN = "arn:aws:secretsmanager:us-east-1:158391967973:secret:SD_API_KEY-JKyxk9"
-export const REPLICATE_KEY_ARN = "arn:aws:secretsmanager:us-east-1:158391967973:secret:REPLICATE_API_TOKEN-YpYaGs"
\ No newline at end of file
+export const REPLICATE_KEY_ARN = "arn:aws:secretsmanager:us-east-1:158391967973:secret:REPLICATE_API_TOKEN-YpYaGs"
+
+// Generated images stored in the image bucket are deleted after this many days
+export const RESULT_EXPIRATION_DAYS = 7
+
+// Cached results for seeded generations are deleted after this many days
+export const RESULT_CACHE_EXPIRATION_DAYS = 1
+
+// Images passed inline to async jobs are deleted after this many days
+export const JOB_INPUT_EXPIRATION_DAYS = 1
\ No newline at end of file
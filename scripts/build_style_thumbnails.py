@@ -0,0 +1,162 @@
+"""Builds the style picker thumbnails and their manifest.
+
+Run before deploying whenever resources/style_images changes:
+
+    python3 scripts/build_style_thumbnails.py
+
+Writes content-hashed WebP (and AVIF, when Pillow supports it) variants
+to resources/style_thumbnails/thumbnails/ and the manifest that
+prompt_style_data reads to lambda/style_manifest.json.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+from io import BytesIO
+
+from PIL import Image, features
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_DIR = os.path.join(ROOT, 'resources', 'style_images')
+OUTPUT_DIR = os.path.join(ROOT, 'resources', 'style_thumbnails')
+MANIFEST_PATH = os.path.join(ROOT, 'lambda', 'style_manifest.json')
+THUMBNAIL_FOLDER = 'thumbnails'
+
+# Tiles are shown at roughly 96px, the larger widths cover 2x and 3x screens
+WIDTHS = (96, 192, 288)
+QUALITY = {'webp': 75, 'avif': 55}
+BLURHASH_COMPONENTS = (4, 3)
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+def encode83(value, length):
+    return ''.join(
+        BASE83[(value // (83 ** (length - i))) % 83]
+        for i in range(1, length + 1)
+    )
+
+def srgb_to_linear(value):
+    v = value / 255.0
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+def linear_to_srgb(value):
+    v = max(0.0, min(1.0, value))
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def sign_pow(value, exponent):
+    return math.copysign(abs(value) ** exponent, value)
+
+def blurhash(image, components=BLURHASH_COMPONENTS):
+    # https://github.com/woltapp/blurhash/blob/master/Algorithm.md
+    components_x, components_y = components
+    small = image.convert('RGB').resize((32, 32), Image.BILINEAR)
+    width, height = small.size
+    pixels = [tuple(srgb_to_linear(c) for c in pixel) for pixel in small.getdata()]
+
+    factors = []
+    for j in range(components_y):
+        for i in range(components_x):
+            normalisation = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                basis_y = math.cos(math.pi * j * y / height)
+                for x in range(width):
+                    basis = basis_y * math.cos(math.pi * i * x / width)
+                    pixel = pixels[y * width + x]
+                    r += basis * pixel[0]
+                    g += basis * pixel[1]
+                    b += basis * pixel[2]
+            scale = normalisation / float(width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = encode83((components_x - 1) + (components_y - 1) * 9, 1)
+    if ac:
+        actual_max = max(abs(c) for factor in ac for c in factor)
+        quantised_max = int(max(0, min(82, math.floor(actual_max * 166 - 0.5))))
+        maximum_value = (quantised_max + 1) / 166.0
+        result += encode83(quantised_max, 1)
+    else:
+        maximum_value = 1.0
+        result += encode83(0, 1)
+
+    result += encode83((linear_to_srgb(dc[0]) << 16) + (linear_to_srgb(dc[1]) << 8) + linear_to_srgb(dc[2]), 4)
+    for factor in ac:
+        quantised = [
+            int(max(0, min(18, math.floor(sign_pow(c / maximum_value, 0.5) * 9 + 9.5))))
+            for c in factor
+        ]
+        result += encode83(quantised[0] * 19 * 19 + quantised[1] * 19 + quantised[2], 2)
+    return result
+
+def slugify(style_key):
+    return ''.join(c if c.isalnum() else '-' for c in style_key).strip('-').lower()
+
+def get_formats():
+    formats = ['webp']
+    if features.check('avif'):
+        formats.append('avif')
+    else:
+        print("Pillow was built without AVIF support, only writing WebP thumbnails")
+    return formats
+
+def build_variants(style_key, image, formats, output_dir):
+    variants = {image_format: [] for image_format in formats}
+    for width in WIDTHS:
+        if width > image.width:
+            break
+        height = round(image.height * width / float(image.width))
+        resized = image.resize((width, height), Image.LANCZOS)
+        for image_format in formats:
+            buffered = BytesIO()
+            resized.save(buffered, format=image_format.upper(), quality=QUALITY[image_format])
+            data = buffered.getvalue()
+            # Hash in the name so the objects can be cached forever
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            key = f"{THUMBNAIL_FOLDER}/{slugify(style_key)}-{width}.{digest}.{image_format}"
+            path = os.path.join(output_dir, key)
+            with open(path, 'wb') as f:
+                f.write(data)
+            variants[image_format].append({'key': key, 'width': width, 'height': height, 'bytes': len(data)})
+    return variants
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default=SOURCE_DIR)
+    parser.add_argument('--output', default=OUTPUT_DIR)
+    parser.add_argument('--manifest', default=MANIFEST_PATH)
+    args = parser.parse_args()
+
+    thumbnail_dir = os.path.join(args.output, THUMBNAIL_FOLDER)
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    # Old hashed variants are dropped so the deployment only carries current ones
+    for name in os.listdir(thumbnail_dir):
+        os.remove(os.path.join(thumbnail_dir, name))
+
+    formats = get_formats()
+    manifest = {}
+    for style_key in sorted(os.listdir(args.source)):
+        style_dir = os.path.join(args.source, style_key)
+        if not os.path.isdir(style_dir):
+            continue
+        files = [name for name in os.listdir(style_dir) if not name.startswith('.')]
+        if not files:
+            continue
+        with Image.open(os.path.join(style_dir, files[0])) as original:
+            image = original.convert('RGB')
+        manifest[style_key] = {
+            'width': image.width,
+            'height': image.height,
+            'placeholder': blurhash(image),
+            'variants': build_variants(style_key, image, formats, args.output),
+        }
+        print(f"Built thumbnails for {style_key}")
+
+    with open(args.manifest, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f"Wrote {len(manifest)} styles to {args.manifest}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Offline evaluation of the text_to_text near-duplicate cache.
+
+The cache matches prompts on hashed lexical features, so the built-in
+sample only shows the threshold behaves on obvious rewordings. Run it with
+pairs taken from real prompt logs before changing the threshold.
+
+Scores labelled prompt pairs with the same embedding the Lambda uses and
+reports, per similarity threshold, the hit rate on pairs that should share
+an expansion and the false-match rate on pairs that should not:
+
+    python3 scripts/eval_semantic_cache.py --pairs pairs.jsonl
+
+Each line of the pairs file is {"a": "...", "b": "...", "same": true}.
+Without --pairs a small built-in sample is used.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda'))
+
+import semantic_cache  # noqa: E402
+
+SAMPLE_PAIRS = [
+    ("a cute dog", "cute dog", True),
+    ("a cat", "the cat", True),
+    ("cat", "cats", True),
+    ("a castle at night", "castle at night", True),
+    ("a red sports car", "red sports car", True),
+    ("an astronaut riding a horse", "astronaut riding horse", True),
+    ("a dog in the snow", "dog in snow", True),
+    ("sunset over the ocean", "a sunset over an ocean", True),
+    ("a cute dog", "a cute cat", False),
+    ("a dog chasing a cat", "a cat chasing a dog", False),
+    ("a red car", "a blue car", False),
+    ("a castle at night", "a castle at noon", False),
+    ("portrait of an old man", "portrait of a young woman", False),
+    ("a forest", "a desert", False),
+    ("underwater city", "city in the clouds", False),
+]
+
+def load_pairs(path):
+    if not path:
+        return SAMPLE_PAIRS
+    with open(path) as f:
+        return [(p['a'], p['b'], bool(p['same'])) for p in map(json.loads, f) if p]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pairs', help="jsonl file of labelled prompt pairs")
+    parser.add_argument('--thresholds', default="0.80,0.85,0.88,0.90,0.92,0.94,0.96,0.98")
+    parser.add_argument('--show-errors', action='store_true', help="print misclassified pairs at the configured threshold")
+    args = parser.parse_args()
+
+    pairs = load_pairs(args.pairs)
+    scored = [
+        (float(semantic_cache.embed(a) @ semantic_cache.embed(b)), a, b, same)
+        for a, b, same in pairs
+    ]
+    positives = [score for score, _, _, same in scored if same]
+    negatives = [score for score, _, _, same in scored if not same]
+    print(f"{len(positives)} matching pairs, {len(negatives)} non-matching pairs")
+    print(f"{'threshold':>9}  {'hit rate':>8}  {'false match':>11}")
+    for threshold in (float(t) for t in args.thresholds.split(',')):
+        hit_rate = sum(s >= threshold for s in positives) / float(len(positives) or 1)
+        false_rate = sum(s >= threshold for s in negatives) / float(len(negatives) or 1)
+        marker = '  <- configured' if abs(threshold - semantic_cache.threshold) < 1e-9 else ''
+        print(f"{threshold:>9.2f}  {hit_rate:>8.1%}  {false_rate:>11.1%}{marker}")
+
+    if args.show_errors:
+        for score, a, b, same in sorted(scored):
+            if (score >= semantic_cache.threshold) != same:
+                print(f"{'missed' if same else 'false match'} {score:.3f}: {a!r} / {b!r}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Reports the import time of each Lambda handler module.
+
+Every handler is imported in a fresh interpreter with `python -X importtime`,
+with the same layers on the path as in lib/async-stack.ts, so the numbers
+approximate the import part of a cold start:
+
+    python3 scripts/import_report.py
+    python3 scripts/import_report.py --budget-ms 300 --top 5
+
+Build the layers first (see README) to include their packages. With
+--budget-ms the script exits non-zero when any handler is over budget, so it
+can run in CI to catch cold-start regressions.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT, 'lambda')
+LAYERS_DIR = os.path.join(LAMBDA_DIR, 'layers')
+SITE_PACKAGES = os.path.join('python', 'lib', 'python3.7', 'site-packages')
+
+# handler module -> layers, keep in sync with lib/async-stack.ts
+HANDLERS = {
+    'generate_image': ['imaging', 'stability', 'replicate'],
+    'controlnet': ['imaging', 'replicate'],
+    'text_to_text': ['openai'],
+    'upload_image': ['imaging'],
+    'prompt_styles': [],
+    'job_status': ['replicate'],
+}
+
+def get_python_path(layers):
+    paths = [LAMBDA_DIR]
+    for layer in layers:
+        site_packages = os.path.join(LAYERS_DIR, layer, SITE_PACKAGES)
+        if os.path.isdir(site_packages):
+            paths.append(site_packages)
+    return os.pathsep.join(paths)
+
+def parse_importtime(stderr):
+    # Lines look like "import time:  self [us] | cumulative | <indent>package"
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+def measure(module, layers):
+    env = dict(os.environ, PYTHONPATH=get_python_path(layers), AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        cwd=LAMBDA_DIR,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    imports = parse_importtime(result.stderr)
+    error = None
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1]
+    # Top level imports add up to the whole import, nested ones are included
+    total_us = sum(cumulative for _, depth, _, cumulative in imports if depth == 0)
+    packages = defaultdict(int)
+    for name, _, self_us, _ in imports:
+        packages[name.split('.')[0]] += self_us
+    return {
+        'module': module,
+        'total_ms': total_us / 1000.0,
+        'packages_ms': {name: us / 1000.0 for name, us in packages.items()},
+        'error': error,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('handlers', nargs='*', default=list(HANDLERS), help="handler modules to measure")
+    parser.add_argument('--top', type=int, default=3, help="heaviest packages to list per handler")
+    parser.add_argument('--budget-ms', type=float, help="fail when a handler takes longer to import")
+    parser.add_argument('--json', action='store_true', help="print the raw report as json")
+    args = parser.parse_args()
+
+    reports = [measure(module, HANDLERS.get(module, [])) for module in args.handlers]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            heaviest = sorted(report['packages_ms'].items(), key=lambda item: -item[1])[:args.top]
+            print(f"{report['module']:<16} {report['total_ms']:>8.1f} ms  " + ", ".join(f"{name} {ms:.1f}" for name, ms in heaviest))
+            if report['error']:
+                print(f"{'':<16} import failed: {report['error']}")
+
+    failed = [r for r in reports if r['error'] or (args.budget_ms and r['total_ms'] > args.budget_ms)]
+    if args.budget_ms and failed:
+        print(f"Over the {args.budget_ms:.0f} ms budget or failing: {', '.join(r['module'] for r in failed)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()